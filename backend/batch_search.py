@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Search many query files against one spectral library from the command line, without the FastAPI server.
+
+Example:
+    python batch_search.py --library library.msp --query "data/**/*.mzML" "data/*.mgf" --output results --cores 8
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from entropy_search import SEARCH_TYPES, EntropySearch
+from result_export import get_output_file
+
+
+def get_query_files(all_pattern):
+    """
+    Expand the glob patterns, "**" matches any directories. A pattern without match is used as a file name.
+    """
+    all_file_query, all_resolved = [], set()
+    for pattern in all_pattern:
+        for file_query in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+            file_query = Path(file_query)
+            if file_query.is_dir() or file_query.resolve() in all_resolved:
+                continue
+            all_resolved.add(file_query.resolve())
+            all_file_query.append(file_query)
+    return all_file_query
+
+
+def search_files(all_file_query, file_library, path_output, parameters, cores=1, parallel_files=1, resume=False):
+    """
+    Load the library once, then search the query files, parallel_files files at the same time, each with
+    cores // parallel_files processes. The hits of each file are written to its own file in path_output.
+
+    :param parameters: A dict of "top_n", "ms1_tolerance_in_da", "ms2_tolerance_in_da", "charge" and "search_types".
+    :return: A dict of the summary of each file and the total throughput.
+    """
+    path_output = Path(path_output)
+    all_file_output = [get_output_file(path_output, x) for x in all_file_query]
+    duplicated_file_output = sorted({str(x) for x in all_file_output if all_file_output.count(x) > 1})
+    if duplicated_file_output:
+        raise ValueError(f"Query files with the same name would write to the same output files: {duplicated_file_output}")
+
+    start_time = time.perf_counter()
+    library_loader = EntropySearch(parameters["ms2_tolerance_in_da"])
+    library_loader.load_spectral_library(file_library, cores=cores)
+    library_time = time.perf_counter() - start_time
+    print(f"Library loaded in {library_time:.1f} seconds")
+
+    print_lock = threading.Lock()
+    cores_per_file = max(1, cores // max(1, parallel_files))
+
+    def search_one_file(file_query):
+        entropy_search = EntropySearch(parameters["ms2_tolerance_in_da"])
+        entropy_search.set_spectral_library(library_loader.spectral_library, library_loader.path_index)
+        file_start_time = time.perf_counter()
+        try:
+            if not Path(file_query).is_file():
+                raise FileNotFoundError(f"{file_query} is not found.")
+            entropy_search.search_file(
+                file_query,
+                parameters["top_n"],
+                parameters["ms1_tolerance_in_da"],
+                parameters["ms2_tolerance_in_da"],
+                charge=parameters["charge"],
+                cores=cores_per_file,
+                path_output=path_output,
+                search_types=parameters["search_types"],
+                resume=resume,
+            )
+            status = entropy_search.status
+            state, message = ("error", status["message"]) if status["error"] else ("finished", "")
+        except Exception as e:
+            state, message = "error", f"Error: {e}"
+        file_time = time.perf_counter() - file_start_time
+        summary = {
+            "file_query": str(file_query),
+            "file_output": str(get_output_file(path_output, file_query)),
+            "state": state,
+            "message": message,
+            "spectra_num": len(entropy_search.all_spectra),
+            "time_in_seconds": file_time,
+            "spectra_per_second": len(entropy_search.all_spectra) / file_time if file_time > 0 else None,
+        }
+        with print_lock:
+            print(f"{state}: {file_query}, {summary['spectra_num']} spectra in {file_time:.1f} seconds {message}")
+        return summary
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel_files), thread_name_prefix="search_file") as executor:
+        all_file_summary = list(executor.map(search_one_file, all_file_query))
+
+    total_time = time.perf_counter() - start_time
+    spectra_num = sum(x["spectra_num"] for x in all_file_summary)
+    return {
+        "file_library": [str(x) for x in file_library] if isinstance(file_library, (list, tuple)) else str(file_library),
+        "parameters": parameters,
+        "cores": cores,
+        "parallel_files": parallel_files,
+        "library_load_time_in_seconds": library_time,
+        "total_time_in_seconds": total_time,
+        "file_num": len(all_file_summary),
+        "failed_file_num": sum(x["state"] != "finished" for x in all_file_summary),
+        "spectra_num": spectra_num,
+        "spectra_per_second": spectra_num / (total_time - library_time) if total_time > library_time else None,
+        "files": all_file_summary,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search query files against a spectral library with entropy similarity.")
+    parser.add_argument("--library", required=True, nargs="+", help="The library file or its index (.esi), several files are searched together as shards")
+    parser.add_argument("--query", required=True, nargs="+", help="Query files or glob patterns, such as 'data/**/*.mzML'")
+    parser.add_argument("--output", required=True, help="Directory for the result of each query file and summary.json")
+    parser.add_argument("--ms1-tolerance-in-da", type=float, default=0.01)
+    parser.add_argument("--ms2-tolerance-in-da", type=float, default=0.02)
+    parser.add_argument("--top-n", type=int, default=100)
+    parser.add_argument("--charge", type=int, default=0, help="Search all query spectra with this charge, 0 uses the charge of each spectrum")
+    parser.add_argument("--search-types", nargs="+", choices=SEARCH_TYPES, help="The search types to run, all by default")
+    parser.add_argument("--cores", type=int, default=multiprocessing.cpu_count(), help="Number of processes in total, all CPU cores by default")
+    parser.add_argument("--parallel-files", type=int, default=1, help="Number of query files searched at the same time, they share the processes")
+    parser.add_argument("--resume", action="store_true", help="Continue the searches killed before from their checkpoints")
+    args = parser.parse_args()
+
+    all_file_query = get_query_files(args.query)
+    if not all_file_query:
+        parser.error("No query file is found.")
+    file_library = [Path(x) for x in args.library] if len(args.library) > 1 else Path(args.library[0])
+    parameters = {
+        "top_n": args.top_n,
+        "ms1_tolerance_in_da": args.ms1_tolerance_in_da,
+        "ms2_tolerance_in_da": args.ms2_tolerance_in_da,
+        "charge": args.charge,
+        "search_types": args.search_types,
+    }
+    summary = search_files(all_file_query, file_library, args.output, parameters, cores=args.cores, parallel_files=args.parallel_files, resume=args.resume)
+
+    file_summary = Path(args.output) / "summary.json"
+    file_summary.parent.mkdir(parents=True, exist_ok=True)
+    file_summary.write_text(json.dumps(summary, indent=2))
+    print(
+        f"{summary['spectra_num']} spectra in {summary['file_num']} files searched in {summary['total_time_in_seconds']:.1f} seconds, "
+        f"{summary['failed_file_num']} files failed, summary is written to {file_summary}"
+    )
+    return 1 if summary["failed_file_num"] else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Benchmark the index build, index load and search throughput on synthetic spectra, the results are printed as JSON.
+
+Example:
+    python benchmark.py --library-size 100000 --query-num 2000 --output benchmark.json
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from entropy_search import SEARCH_TYPES, EntropySearch
+from index_cache import IndexCache
+from result_cache import ResultCache
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def generate_spectra(spectra_num, peaks_per_spectrum, mz_min, mz_max, mz_distribution, random_state):
+    """
+    Generate random spectra, each with a precursor m/z and peaks_per_spectrum peaks below it.
+
+    :param mz_distribution: "uniform", or "lognormal" with more peaks at low m/z, like real MS/MS spectra.
+    :return: A list of (precursor_mz, peaks).
+    """
+    all_spec = []
+    for _ in range(spectra_num):
+        precursor_mz = random_state.uniform(mz_min + 10, mz_max)
+        if mz_distribution == "uniform":
+            mz = random_state.uniform(mz_min, precursor_mz - 2, size=peaks_per_spectrum)
+        elif mz_distribution == "lognormal":
+            mz = mz_min + random_state.lognormal(0, 0.6, size=peaks_per_spectrum) / 4 * (precursor_mz - 2 - mz_min)
+            mz = mz[mz < precursor_mz - 2]
+        else:
+            raise ValueError(f"Unknown m/z distribution: {mz_distribution}")
+        intensity = random_state.pareto(1.5, size=len(mz)) + 0.01
+        peaks = np.column_stack([np.round(np.sort(mz), 4), np.round(intensity / intensity.max() * 100, 2)])
+        all_spec.append((precursor_mz, peaks))
+    return all_spec
+
+
+def generate_queries(all_library_spec, query_num, library_fraction, peaks_per_spectrum, mz_min, mz_max, mz_distribution, random_state):
+    """
+    Generate query spectra, library_fraction of them are library spectra with m/z noise and part of peaks dropped,
+    so they have identity hits, the others are random spectra.
+    """
+    library_query_num = int(round(query_num * library_fraction))
+    all_query = []
+    for i in random_state.choice(len(all_library_spec), size=min(library_query_num, len(all_library_spec)), replace=False):
+        precursor_mz, peaks = all_library_spec[i]
+        peaks = peaks[random_state.random(len(peaks)) < 0.8].copy()
+        peaks[:, 0] += random_state.normal(0, 0.003, size=len(peaks))
+        all_query.append((precursor_mz + random_state.normal(0, 0.002), peaks))
+    all_query += generate_spectra(query_num - len(all_query), peaks_per_spectrum, mz_min, mz_max, mz_distribution, random_state)
+    return [all_query[i] for i in random_state.permutation(len(all_query))]
+
+
+def write_mgf(file_output, all_spec, name_prefix):
+    with open(file_output, "w") as f:
+        for i, (precursor_mz, peaks) in enumerate(all_spec):
+            f.write(f"BEGIN IONS\nTITLE={name_prefix}{i}\nPEPMASS={precursor_mz:.5f}\nPRECURSORTYPE=[M+H]+\n")
+            f.write("".join(f"{mz:.4f}\t{intensity:.2f}\n" for mz, intensity in peaks))
+            f.write("END IONS\n")
+
+
+def get_peak_rss_in_mb():
+    """
+    The peak resident set size since the benchmark started, None if it is not available on this platform.
+    The values are peaks over the whole lifetime, so a stage only shows a larger value if it used more memory than
+    all stages before it.
+
+    :return: A dict of "lifetime_peak_rss_in_mb" of this process, and "children_peak_rss_in_mb" of the largest
+             finished child process, such as the processes building the index with --cores.
+    """
+    if resource is None:
+        return {"lifetime_peak_rss_in_mb": None, "children_peak_rss_in_mb": None}
+    # ru_maxrss is in bytes on macOS, and in kilobytes on Linux
+    unit = 1024**2 if sys.platform == "darwin" else 1024
+    return {
+        "lifetime_peak_rss_in_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        "children_peak_rss_in_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit,
+    }
+
+
+def summarize_latency(all_latency):
+    all_latency = np.asarray(all_latency, dtype=np.float64)
+    return {
+        "spectra_num": len(all_latency),
+        "spectra_per_second": len(all_latency) / all_latency.sum() if all_latency.sum() > 0 else None,
+        "latency_p50_in_ms": float(np.percentile(all_latency, 50) * 1000) if len(all_latency) else None,
+        "latency_p99_in_ms": float(np.percentile(all_latency, 99) * 1000) if len(all_latency) else None,
+    }
+
+
+def run_benchmark(parameters, path_work):
+    """
+    Generate the spectra, then time the index build, index load, search_one_spectrum for each search type and
+    search_file_single_core.
+
+    :return: A dict of the parameters, the environment and the results of each stage.
+    """
+    path_work = Path(path_work)
+    random_state = np.random.default_rng(parameters["seed"])
+    spectra_parameters = (parameters["peaks_per_spectrum"], parameters["mz_min"], parameters["mz_max"], parameters["mz_distribution"], random_state)
+    report = {
+        "parameters": parameters,
+        "environment": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform()},
+        "results": {},
+    }
+    results = report["results"]
+
+    start_time = time.perf_counter()
+    all_library_spec = generate_spectra(parameters["library_size"], *spectra_parameters)
+    all_query = generate_queries(all_library_spec, parameters["query_num"], parameters["library_query_fraction"], *spectra_parameters)
+    file_library, file_query = path_work / "library.mgf", path_work / "query.mgf"
+    write_mgf(file_library, all_library_spec, "library_")
+    write_mgf(file_query, all_query, "query_")
+    del all_library_spec
+    results["generate"] = {"time_in_seconds": time.perf_counter() - start_time}
+
+    # Build the index in an empty cache, the result cache is disabled so all spectra are searched.
+    index_cache = IndexCache(path_work / "index_cache")
+    entropy_search = EntropySearch(parameters["ms2_tolerance_in_da"], index_cache=index_cache, result_cache=ResultCache(max_size_in_bytes=0))
+    start_time = time.perf_counter()
+    entropy_search._build_spectral_library(file_library, cores=parameters["cores"])
+    build_time = time.perf_counter() - start_time
+    results["build_index"] = {
+        "time_in_seconds": build_time,
+        "spectra_per_second": parameters["library_size"] / build_time,
+        **get_peak_rss_in_mb(),
+    }
+
+    path_index = entropy_search.path_index
+    start_time = time.perf_counter()
+    entropy_search = EntropySearch(parameters["ms2_tolerance_in_da"], index_cache=index_cache, result_cache=ResultCache(max_size_in_bytes=0))
+    entropy_search._read_spectral_library_index(path_index)
+    results["load_index"] = {"time_in_seconds": time.perf_counter() - start_time, **get_peak_rss_in_mb()}
+
+    search_parameters = (parameters["top_n"], parameters["ms1_tolerance_in_da"], parameters["ms2_tolerance_in_da"])
+    all_latency_query = all_query[: parameters["latency_query_num"]]
+    results["search_one_spectrum"] = {}
+    for search_type in SEARCH_TYPES:
+        all_latency = []
+        for i, (precursor_mz, peaks) in enumerate(all_latency_query):
+            spec = {"precursor_mz": precursor_mz, "peaks": peaks.astype(np.float32), "_scan_number": i + 1}
+            start_time = time.perf_counter()
+            entropy_search.search_one_spectrum(spec, *search_parameters, search_types=[search_type])
+            all_latency.append(time.perf_counter() - start_time)
+        results["search_one_spectrum"][search_type] = {**summarize_latency(all_latency), **get_peak_rss_in_mb()}
+
+    start_time = time.perf_counter()
+    entropy_search.search_file_single_core(file_query, *search_parameters)
+    search_time = time.perf_counter() - start_time
+    results["search_file_single_core"] = {
+        "spectra_num": len(entropy_search.all_spectra),
+        "time_in_seconds": search_time,
+        "spectra_per_second": len(entropy_search.all_spectra) / search_time,
+        **get_peak_rss_in_mb(),
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Entropy Search on synthetic spectra.")
+    parser.add_argument("--library-size", type=int, default=10000, help="Number of library spectra")
+    parser.add_argument("--query-num", type=int, default=1000, help="Number of query spectra searched by search_file_single_core")
+    parser.add_argument("--latency-query-num", type=int, default=200, help="Number of query spectra searched one by one for each search type")
+    parser.add_argument("--library-query-fraction", type=float, default=0.5, help="Fraction of query spectra made from library spectra")
+    parser.add_argument("--peaks-per-spectrum", type=int, default=30)
+    parser.add_argument("--mz-min", type=float, default=50)
+    parser.add_argument("--mz-max", type=float, default=1000)
+    parser.add_argument("--mz-distribution", choices=["uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--ms1-tolerance-in-da", type=float, default=0.01)
+    parser.add_argument("--ms2-tolerance-in-da", type=float, default=0.02)
+    parser.add_argument("--top-n", type=int, default=100)
+    parser.add_argument("--cores", type=int, default=1, help="Number of processes to build the index")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--path-work", help="Directory for the generated files and the index, a temporary directory by default")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    parameters = {k: v for k, v in vars(args).items() if k not in {"path_work", "output"}}
+    if args.path_work:
+        Path(args.path_work).mkdir(parents=True, exist_ok=True)
+        report = run_benchmark(parameters, args.path_work)
+    else:
+        with tempfile.TemporaryDirectory(prefix="entropy_search_benchmark_") as path_work:
+            report = run_benchmark(parameters, path_work)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,59 @@
 #!/usr/bin/env python3
 import copy
+import functools
 import hashlib
-import json
+import multiprocessing as mp
+import os
 import pickle
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
-from ms_entropy import FlashEntropySearch, read_one_spectrum, standardize_spectrum
+from identity_search import clean_query_peaks, search_identity_sparse
+from index_cache import IndexCache, touch_index
+from library_builder import build_spectral_library_index
+from library_index import INDEX_FORMAT_VERSION, is_spectral_library_index, read_index_information
+from library_partition import (
+    PartitionedLibrary,
+    check_charge_partition,
+    get_default_charge_partition,
+    get_library_charge_partition,
+    get_partition_charge,
+    read_partitioned_library,
+)
+from library_update import MAX_DELTA_SPECTRA_NUM, append_library_spectra, delete_library_spectra, get_delta_spectra_num, merge_library_delta
+from metrics import REGISTRY, SEARCHED_SPECTRA, STAGE_DURATION
+from query_reader import parse_spectrum, read_query_spectra
+from result_cache import CACHED_HIT_DTYPE, ResultCache, get_result_cache_key
+from result_export import ResultWriter, get_output_file
+from result_store import ResultStore, get_hit_rank
+from search_checkpoint import SearchCheckpoint, get_checkpoint_file
+from search_events import SearchEventLog
+from sharded_library import ShardedLibrary, combine_library_shards, get_shard_name
+from sparse_search import search_sparse
 
 __VERSION__ = "2.0.0"
 
+SEARCH_TYPES = ["identity_search", "open_search", "neutral_loss_search", "hybrid_search"]
+# Number of query spectra searched together
+_SEARCH_BLOCK_SIZE = 256
+# Number of spectrum results cached by get_one_spectrum_result
+_RESULT_VIEW_CACHE_SIZE = 256
+# The search fails if the worker processes return no result in this time, can be changed with this environment variable.
+ENV_WORKER_TIMEOUT_IN_SECONDS = "ENTROPY_SEARCH_WORKER_TIMEOUT_IN_SECONDS"
+DEFAULT_WORKER_TIMEOUT_IN_SECONDS = 600
+
 
 def worker_search_one_spectrum(function, parameters_global, queue_input, queue_output):
+    # Drop the metrics copied from the parent process, the worker only sends its own metrics back with the results
+    REGISTRY.export_state(reset=True)
     for parameters in iter(queue_input.get, None):
         try:
             result = function(*parameters, *parameters_global)
@@ -22,14 +64,41 @@ def worker_search_one_spectrum(function, parameters_global, queue_input, queue_o
 
 
 class EntropySearch:
-    def __init__(self, ms2_tolerance_in_da) -> None:
+    def __init__(self, ms2_tolerance_in_da, index_cache=None, result_cache=None, charge_partition=None) -> None:
+        """
+        :param charge_partition: How the library index built by this object is partitioned by the precursor charge,
+                                 see library_partition.CHARGE_PARTITIONS. An index read from disk keeps its own partition.
+        """
+        if charge_partition is None:
+            charge_partition = get_default_charge_partition()
+        check_charge_partition(charge_partition)
         self.ms2_tolerance_in_da = ms2_tolerance_in_da
+        self.charge_partition = charge_partition
+        self.index_cache = index_cache
+        self.result_cache = result_cache
+        # Identifies the content of the library in the keys of the result cache, None disables the result cache.
+        self.library_key = None
         self.spectral_library = None
+        self.path_index = None
         self.all_spectra = []
         self.scan_number_to_index = {}
+        self.result_store = None
+        self.result_writer = None
+        self.search_types = None
+        # The checkpoint of the running search, and the blocks saved in it which are not restored yet
+        self.checkpoint = None
+        self.checkpoint_blocks = {}
+        # The blocks finished by the running search, followed by the clients of /stream
+        self.event_log = SearchEventLog()
+        # The views of spectrum results returned by get_one_spectrum_result, the result_generation is increased
+        # when all cached views become invalid.
+        self.result_view_cache = OrderedDict()
+        self.result_generation = 0
+        self._result_view_lock = threading.Lock()
         self.all_processes = []
         self.queue_input = None
         self.queue_output = None
+        self.cancelled = False
 
         # Status
         # 1. When program starts, status is ready: False, running: False, error: False
@@ -44,170 +113,479 @@ class EntropySearch:
             "message": "",  # Message to display
         }
 
-    def search_one_spectrum(self, spec, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da):
-        spec = _parse_spectrum(spec)
-        result = {
-            "scan": spec["scan"],
-            "query_name": spec["name"],
-            "precursor_mz": spec["precursor_mz"],
-            "charge": spec["charge"],
-            "rt": spec["rt"],
-        }
-        if spec["precursor_mz"] <= 0 or len(spec["peaks"]) == 0 or spec["charge"] not in self.spectral_library:
-            for search_type in ["identity_search", "open_search", "neutral_loss_search", "hybrid_search"]:
-                result[search_type] = []
-                result[search_type + "-score"] = 0
-        else:
-            entropy_search = self.spectral_library[spec["charge"]]
-            entropy_search_result = entropy_search.search(
-                precursor_mz=spec["precursor_mz"],
-                peaks=spec["peaks"],
-                ms1_tolerance_in_da=ms1_tolerance_in_da,
-                ms2_tolerance_in_da=ms2_tolerance_in_da,
-                method="all",
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The memory-mapped index is read again by the new process instead of being copied.
+        if self.path_index is not None:
+            state["spectral_library"] = None
+        state["result_view_cache"] = OrderedDict()
+        state["checkpoint"] = None
+        state["checkpoint_blocks"] = {}
+        del state["_result_view_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._result_view_lock = threading.Lock()
+        if self.path_index is not None:
+            self.spectral_library = read_partitioned_library(self.path_index)
+
+    def search_one_spectrum(self, spec, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types=None):
+        spec = self._set_query_charge(parse_spectrum(spec))
+        batch_result = self.search_spectra([spec], top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types=search_types)
+        return self._convert_batch_result_to_spectrum_results([spec], batch_result)[0]
+
+    def search_spectra(self, all_spec, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types=None):
+        """
+        Search a block of query spectra and select the top N library spectra for each query and each search type.
+
+        :param search_types: The search types to run, a subset of SEARCH_TYPES. None means all search types.
+
+        :return: A dict of arrays with the same length, one element for each hit:
+                    "query_idx": The index of the query spectrum in all_spec.
+                    "library_idx": The index of the library spectrum.
+                    "score": The similarity score.
+                    "search_type": The index of the search type in SEARCH_TYPES.
+                 The hits are sorted by query_idx, search_type, then descending score.
+        """
+        all_spec = [self._set_query_charge(parse_spectrum(spec)) for spec in all_spec]
+        all_result = []
+        for charge in sorted({spec["charge"] for spec in all_spec}):
+            try:
+                entropy_search = self.spectral_library[charge]
+            except KeyError:
+                continue
+            query_idx = np.array(
+                [i for i, spec in enumerate(all_spec) if spec["charge"] == charge and spec["precursor_mz"] > 0 and len(spec["peaks"]) > 0],
+                dtype=np.int64,
             )
+            if len(query_idx) == 0:
+                continue
+            if isinstance(entropy_search, ShardedLibrary):
+                all_result.append(_search_library_shards(entropy_search, all_spec, query_idx, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types))
+            else:
+                all_result.append(_search_library(entropy_search, all_spec, query_idx, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types))
+
+        result = _concatenate_results(all_result)
+        order = np.lexsort((-result["score"], result["search_type"], result["query_idx"]))
+        return {k: v[order] for k, v in result.items()}
+
+    def _set_query_charge(self, spec, charge=None):
+        """
+        Set the charge of a parsed query spectrum to the partition of the library it searches.
+
+        :param charge: If it is not 0 or None, it is used instead of the charge of the spectrum.
+        """
+        if charge:
+            spec["charge"] = charge
+        spec["charge"] = get_partition_charge(spec["charge"], get_library_charge_partition(self.spectral_library))
+        return spec
+
+    def search_spectra_with_cache(self, all_spec, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types=None):
+        """
+        The same as search_spectra, but the hits of the spectra searched before with the same library and parameters
+        are read from self.result_cache, only the other spectra are searched and their hits are saved to the cache.
+
+        :param all_spec: The parsed query spectra.
+        """
+        if self.result_cache is None or not self.result_cache.enabled or self.library_key is None:
+            return self.search_spectra(all_spec, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types)
+
+        parameters = self._get_search_parameters(top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types)
+        start_time = time.perf_counter()
+        all_key = {}
+        for i, spec in enumerate(all_spec):
+            if spec["precursor_mz"] > 0 and len(spec["peaks"]) > 0:
+                peaks = clean_query_peaks(spec["precursor_mz"], spec["peaks"])
+                all_key[i] = get_result_cache_key(peaks, spec["precursor_mz"], dict(parameters, charge=spec["charge"]))
+        try:
+            all_cached_hits = self.result_cache.get_many(list(all_key.values()))
+        except sqlite3.Error as e:
+            self.event_log.add_warning(f"The result cache can not be read: {e}")
+            all_cached_hits = {}
+        STAGE_DURATION.observe(time.perf_counter() - start_time, stage="result_cache")
+
+        # Search the spectra not in the cache
+        searched_idx = np.array([i for i, key in all_key.items() if key not in all_cached_hits], dtype=np.int64)
+        result = self.search_spectra([all_spec[i] for i in searched_idx], top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types)
+        result["query_idx"] = searched_idx[result["query_idx"]]
+        start_time = time.perf_counter()
+        hit_idx_start = np.searchsorted(result["query_idx"], searched_idx, side="left")
+        hit_idx_end = np.searchsorted(result["query_idx"], searched_idx, side="right")
+        all_new_hits = {}
+        for i, start, end in zip(searched_idx, hit_idx_start, hit_idx_end):
+            hits = np.zeros(end - start, dtype=CACHED_HIT_DTYPE)
+            for name in CACHED_HIT_DTYPE.names:
+                hits[name] = result[name][start:end]
+            all_new_hits[all_key[i]] = hits
+        try:
+            self.result_cache.put_many(all_new_hits)
+        except sqlite3.Error as e:
+            self.event_log.add_warning(f"The result cache can not be written: {e}")
+        STAGE_DURATION.observe(time.perf_counter() - start_time, stage="result_cache")
+
+        # Add the cached hits
+        all_result = [result]
+        for i, key in all_key.items():
+            hits = all_cached_hits.get(key)
+            if hits is not None:
+                all_result.append({"query_idx": np.full(len(hits), i, dtype=np.int64), **{name: hits[name] for name in CACHED_HIT_DTYPE.names}})
+        result = _concatenate_results(all_result)
+        order = np.lexsort((-result["score"], result["search_type"], result["query_idx"]))
+        return {k: v[order] for k, v in result.items()}
+
+    def _get_search_parameters(self, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types):
+        """
+        The library and the parameters which decide the hits of a query spectrum, used in the keys of the result cache
+        and the checkpoint.
+        """
+        return {
+            "library": self.library_key,
+            "top_n": top_n,
+            "ms1_tolerance_in_da": ms1_tolerance_in_da,
+            "ms2_tolerance_in_da": ms2_tolerance_in_da,
+            "search_types": SEARCH_TYPES if search_types is None else [x for x in SEARCH_TYPES if x in search_types],
+        }
 
-            for search_type, score_array in entropy_search_result.items():
-                # Select top N results
-                if top_n < len(score_array):
-                    top_n_idx = np.argpartition(score_array, -top_n)[-top_n:]
-                    top_n_score = score_array[top_n_idx]
-                else:
-                    top_n_idx = np.arange(len(score_array))
-                    top_n_score = score_array
-
-                # Filter by score > 0
-                selected_idx = top_n_score > 0
-                top_n_idx = top_n_idx[selected_idx]
-                top_n_score = top_n_score[selected_idx]
+    def _search_block(self, spec_idx_start, all_spec, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types=None):
+        """
+        Search a block in a worker process, the metrics of the worker since the last block and the warnings of the worker
+        are returned with the results.
+        """
+        batch_result = self.search_spectra_with_cache(all_spec, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types)
+        return spec_idx_start, batch_result, REGISTRY.export_state(reset=True), self.event_log.get_warnings()
 
+    def _convert_batch_result_to_spectrum_results(self, all_spec, batch_result):
+        all_results = []
+        for spec in all_spec:
+            result = {
+                "scan": spec["scan"],
+                "query_name": spec["name"],
+                "precursor_mz": spec["precursor_mz"],
+                "charge": spec["charge"],
+                "rt": spec["rt"],
+            }
+            for search_type in SEARCH_TYPES:
+                result[search_type] = []
+                result[search_type + "-score"] = 0
+            all_results.append(result)
+
+        for query_idx, library_idx, score, search_type_idx in zip(
+            batch_result["query_idx"], batch_result["library_idx"], batch_result["score"], batch_result["search_type"]
+        ):
+            result = all_results[query_idx]
+            search_type = SEARCH_TYPES[search_type_idx]
+            # The hits are sorted by descending score, so the first one is the best one
+            if len(result[search_type]) == 0:
+                result[search_type + "-score"] = score
                 # Assign name when search_type is identity_search
-                if search_type == "identity_search" and len(top_n_idx) > 0:
-                    # Select the max score
-                    max_idx = np.argmax(top_n_score)
-                    # Get the library spectrum
-                    library_spec = entropy_search.abstract_library_spectra[top_n_idx[max_idx]]
-                    # Assign name
+                if search_type == "identity_search":
+                    library_spec = self.spectral_library[result["charge"]].abstract_library_spectra[library_idx]
                     result["name"] = library_spec["library-name"]
                     result["adduct"] = library_spec["library-precursor_type"]
+            result[search_type].append([result["scan"], library_idx, score])
+        return all_results
 
-                result[search_type] = [[spec["scan"], i, score_array[i]] for i in top_n_idx]
+    def _merge_batch_result(self, spec_idx_start, all_spec, batch_result, save_checkpoint=True):
+        """
+        Save the hits of a block to the result store, and the best score of each search type to the query spectra.
+
+        :param save_checkpoint: Also save the hits to the checkpoint of the running search.
+        """
+        start_time = time.perf_counter()
+        for spec in all_spec:
+            spec.setdefault("query_name", spec["name"])
+            for search_type in SEARCH_TYPES:
+                spec[search_type + "-score"] = 0
+        # The hits are sorted by descending score, so the first one is the best one
+        is_best = get_hit_rank(batch_result["query_idx"], batch_result["search_type"]) == 0
+        for query_idx, library_idx, score, search_type_idx in zip(
+            batch_result["query_idx"][is_best], batch_result["library_idx"][is_best], batch_result["score"][is_best], batch_result["search_type"][is_best]
+        ):
+            spec = all_spec[query_idx]
+            search_type = SEARCH_TYPES[search_type_idx]
+            spec[search_type + "-score"] = score
+            # Assign name when search_type is identity_search
+            if search_type == "identity_search":
+                library_spec = self.spectral_library[spec["charge"]].abstract_library_spectra[library_idx]
+                spec["name"] = library_spec["library-name"]
+                spec["adduct"] = library_spec["library-precursor_type"]
+        # The spectra are marked as searched after the best scores are set
+        self.result_store.add_batch_result(spec_idx_start, len(all_spec), batch_result)
+
+        if self.result_writer is not None:
+            self.result_writer.add_batch_result(all_spec, batch_result, self.spectral_library)
+        if save_checkpoint and self.checkpoint is not None:
+            self.checkpoint.add_block(spec_idx_start, len(all_spec), batch_result)
+        self.event_log.add_block(spec_idx_start, len(all_spec))
+        SEARCHED_SPECTRA.inc(len(all_spec))
+        STAGE_DURATION.observe(time.perf_counter() - start_time, stage="merge_result")
+
+    def _restore_block(self, spec_idx_start, all_spec):
+        """
+        Merge the hits of a block saved in the checkpoint of a resumed search, return False if the block is not saved.
+        """
+        saved_block = self.checkpoint_blocks.pop(spec_idx_start, None)
+        if saved_block is None or saved_block[0] != len(all_spec):
+            return False
+        self._merge_batch_result(spec_idx_start, all_spec, saved_block[1], save_checkpoint=False)
+        return True
 
-                if len(top_n_score) > 0:
-                    result[search_type + "-score"] = np.max(top_n_score)
-                else:
-                    result[search_type + "-score"] = 0
-        return result
+    def get_spectra(
+        self,
+        offset=0,
+        limit=None,
+        rt_range=None,
+        precursor_mz_range=None,
+        score_range=None,
+        score_type="identity_search",
+        sort_by=None,
+        descending=False,
+    ):
+        """
+        Get the query spectra without peaks, filtered, sorted and paginated.
+
+        :param rt_range, precursor_mz_range, score_range: (min, max), None means no limit. The score_range filters
+                                                          the spectra by the best score of score_type.
+        :param sort_by: "scan", "rt", "precursor_mz" or "<search type>-score", None keeps the order in the query file.
+        :return: The number of spectra after filtering, and the list of spectra in the page.
+        """
+        if score_type not in SEARCH_TYPES:
+            raise ValueError(f"Unknown search type: {score_type}")
+        if sort_by is not None and sort_by not in ["scan", "rt", "precursor_mz"] + [x + "-score" for x in SEARCH_TYPES]:
+            raise ValueError(f"Can not sort by {sort_by}")
+
+        all_spectra = [spec for spec in self.all_spectra[:] if len(spec.get("peaks", [])) > 0]
+        selected = np.ones(len(all_spectra), dtype=bool)
+        for key, value_range in (("rt", rt_range), ("precursor_mz", precursor_mz_range), (score_type + "-score", score_range)):
+            if value_range is None:
+                continue
+            values = np.array([spec.get(key, 0) for spec in all_spectra], dtype=np.float64)
+            if value_range[0] is not None:
+                selected &= values >= value_range[0]
+            if value_range[1] is not None:
+                selected &= values <= value_range[1]
+        all_idx = np.flatnonzero(selected)
+
+        if sort_by is not None:
+            values = np.array([all_spectra[i].get(sort_by, 0) for i in all_idx], dtype=np.float64)
+            all_idx = all_idx[np.argsort(-values if descending else values, kind="stable")]
+
+        total_num = len(all_idx)
+        all_idx = all_idx[offset : None if limit is None else offset + limit]
+        return total_num, [_get_spectrum_without_peaks(all_spectra[i]) for i in all_idx]
+
+    def get_block_spectra(self, spec_idx_start, spec_num):
+        """
+        Get the query spectra of a searched block without peaks, with the best score of each search type.
+        """
+        return [_get_spectrum_without_peaks(spec) for spec in self.all_spectra[spec_idx_start : spec_idx_start + spec_num]]
 
     def get_one_library_spectrum(self, charge, library_idx):
         return self.spectral_library[charge][library_idx]
 
     def get_one_spectrum_result(self, scan_number, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da):
+        """
+        Get the query spectrum with the top N library spectra of each search type. If the spectrum is not searched
+        yet while the search is running, it is searched now.
+
+        The results are cached, a cached result is used until the spectrum is searched, or the results or the library
+        are changed.
+        """
         spec_idx = self.scan_number_to_index[scan_number]
-        spectrum_result = None
+        is_searched = self.result_store is not None and self.result_store.is_searched(spec_idx)
+        key = (scan_number, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da)
+        version = (self.result_generation, is_searched)
+        with self._result_view_lock:
+            cached = self.result_view_cache.get(key)
+            if cached is not None and cached[0] == version:
+                self.result_view_cache.move_to_end(key)
+                return copy.copy(cached[1])
+
         spectrum_result = copy.copy(self.all_spectra[spec_idx])
-        if self.status["running"]:
-            spectrum_result.update(self.search_one_spectrum(spectrum_result, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da))
+        all_hits = {}
+        if is_searched:
+            for search_type in SEARCH_TYPES:
+                hits = self.result_store.get_hits(spec_idx, search_type)[:top_n]
+                all_hits[search_type] = zip(hits["library_idx"].tolist(), hits["score"].tolist())
+        elif self.status["running"]:
+            spectrum_result.update(self.search_one_spectrum(spectrum_result, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, self.search_types))
+            for search_type in SEARCH_TYPES:
+                all_hits[search_type] = [(library_idx, score) for _, library_idx, score in spectrum_result[search_type]]
+        else:
+            for search_type in SEARCH_TYPES:
+                all_hits[search_type] = []
 
-        search_type_keys = ["identity_search", "open_search", "neutral_loss_search", "hybrid_search"]
-        for search_type in search_type_keys:
+        for search_type in SEARCH_TYPES:
             new_data = []
-            for query_idx, library_idx, score in spectrum_result[search_type]:
+            for library_idx, score in all_hits[search_type]:
                 library_spec = self.spectral_library[spectrum_result["charge"]].abstract_library_spectra[library_idx]
                 new_data.append([library_spec, score])
             spectrum_result[search_type] = new_data
 
-        return spectrum_result
-
-    # def search_file(self, file_query, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, charge=None, cores=2):
-    #     # Search spectra
-    #     all_results = []
-    #     file_query = Path(file_query)
-    #     self.status = {
-    #         "ready": False,
-    #         "running": True,
-    #         "error": False,
-    #         "message": f"Start reading {file_query.name}..."
-    #     }
-
-    #     try:
-    #         if charge == 0:
-    #             charge = None
-    #         if charge is not None:
-    #             charge = str(charge).strip()
-    #             if charge == "":
-    #                 charge = None
-    #         if cores > 0:
-    #             self.queue_input, self.queue_output = mp.Queue(), mp.Queue()
-    #             queue_input_num = 0
-
-    #             self.all_processes = [
-    #                 mp.Process(
-    #                     target=worker_search_one_spectrum,
-    #                     args=(self.search_one_spectrum, (top_n, ms1_tolerance_in_da, ms2_tolerance_in_da,),
-    #                           self.queue_input, self.queue_output)) for _ in range(cores)]
-    #             for p in self.all_processes:
-    #                 p.start()
-
-    #             for spec in read_one_spectrum(file_query):
-    #                 try:
-    #                     if spec.pop("_ms_level", 2) != 2:
-    #                         continue
-    #                     if charge is not None:
-    #                         spec["charge"] = charge
-    #                     spec['peaks'] = np.array(spec['peaks']).astype(np.float32)
-    #                     self.queue_input.put((spec,))
-    #                     self.all_spectra.append(spec)
-    #                     self.scan_number_to_index[spec["_scan_number"]] = len(self.all_spectra) - 1
-    #                     queue_input_num += 1
-    #                 except Exception as e:
-    #                     continue
-
-    #                 if queue_input_num % 1000 == 0:
-    #                     self.status["message"] = f"Reading {file_query.name}... {queue_input_num} spectra read"
-
-    #             # Set ready to display results signal
-    #             self.status["ready"] = True
-    #             for _ in range(cores):
-    #                 self.queue_input.put(None)
-
-    #             total_spec_num = queue_input_num
-    #             while queue_input_num > 0:
-    #                 cur_result = self.queue_output.get()
-    #                 queue_input_num -= 1
-    #                 # Merge results into original file
-    #                 if cur_result is not None:
-    #                     spec_idx = self.scan_number_to_index[cur_result["scan"]]
-    #                     self.all_spectra[spec_idx].update(cur_result)
-
-    #                 processed_spec_num = total_spec_num - queue_input_num
-    #                 if processed_spec_num % 100 == 0:
-    #                     self.status["message"] = f"{processed_spec_num} spectra searched, about {queue_input_num} remaining"
-    #                     # print(f"Total: {total_spec_num}, Processed: {processed_spec_num}, Remaining: {queue_input_num}")
-
-    #             for p in self.all_processes:
-    #                 p.join()
-
-    #             self.all_processes = []
-
-    #         # Set success finished signal
-    #         self.status = {
-    #             "ready": True,
-    #             "running": False,
-    #             "error": False,
-    #             "message": f"",
-    #         }
-    #         return all_results
-    #     except Exception as e:
-    #         import traceback
-    #         traceback.print_exc()
-    #         self.status = {
-    #             "ready": False,
-    #             "message": f"Error: {e}",
-    #             "error": True,
-    #             "running": False,
-    #         }
-    #         return []
+        with self._result_view_lock:
+            self.result_view_cache[key] = (version, spectrum_result)
+            self.result_view_cache.move_to_end(key)
+            while len(self.result_view_cache) > _RESULT_VIEW_CACHE_SIZE:
+                self.result_view_cache.popitem(last=False)
+        return copy.copy(spectrum_result)
+
+    def search_file(
+        self, file_query, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, charge=None, cores=1, path_output=None, search_types=None, resume=False
+    ):
+        """
+        Search all spectra in file_query, the results are saved in self.all_spectra and self.result_store.
+
+        The results are also saved to a checkpoint while searching, which is removed when the search is finished.
+
+        :param path_output: If set, the hits are also written to a Parquet or CSV file while searching,
+                            see result_export.get_output_file for the file name.
+        :param search_types: The search types to run, a subset of SEARCH_TYPES. None means all search types,
+                             the search types not run have no hits.
+        :param resume: Continue from the checkpoint of the same search killed or cancelled before, the query file is
+                       read again, but the blocks saved in the checkpoint are not searched again.
+        """
+        if search_types is not None:
+            unknown_search_types = set(search_types) - set(SEARCH_TYPES)
+            if unknown_search_types:
+                raise ValueError(f"Unknown search types: {sorted(unknown_search_types)}")
+        self.search_types = search_types
+        self.result_generation += 1
+        if self.result_cache is None:
+            self.result_cache = ResultCache()
+        self.library_key = self._get_library_key()
+        if self.path_index is not None:
+            touch_index(self.path_index)
+        if path_output:
+            self.result_writer = ResultWriter(get_output_file(path_output, file_query), SEARCH_TYPES)
+        self._open_checkpoint(file_query, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types, resume)
+        self.event_log.reset()
+        try:
+            if cores is None or cores <= 1:
+                return self.search_file_single_core(file_query, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, charge=charge, cores=1, search_types=search_types)
+            return self._search_file_multi_core(file_query, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, charge=charge, cores=cores, search_types=search_types)
+        finally:
+            if self.result_writer is not None:
+                self.result_writer.close()
+                self.result_writer = None
+            if self.checkpoint is not None:
+                is_finished = self.status["ready"] and not self.status["running"] and not self.status["error"] and not self.cancelled
+                self.checkpoint.close(remove=is_finished)
+                self.checkpoint = None
+                self.checkpoint_blocks = {}
+            self.event_log.close()
+
+    def _open_checkpoint(self, file_query, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types, resume):
+        """
+        Open the checkpoint of the search, the checkpoint is not used for a library without index on disk.
+        """
+        self.checkpoint, self.checkpoint_blocks = None, {}
+        if self.library_key is None:
+            return
+        try:
+            parameters = self._get_search_parameters(top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types)
+            checkpoint = SearchCheckpoint(get_checkpoint_file(file_query, parameters))
+            self.checkpoint_blocks = checkpoint.open(resume)
+            self.checkpoint = checkpoint
+        except Exception:
+            traceback.print_exc()
+
+    def _search_file_multi_core(self, file_query, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, charge=None, cores=1, search_types=None):
+        # Search spectra
+        file_query = Path(file_query)
+        if self.result_store is None:
+            self.result_store = ResultStore(SEARCH_TYPES, top_n)
+        self.status = {"ready": False, "running": True, "error": False, "message": f"Start reading {file_query.name}..."}
+
+        try:
+            # Move the index to shared memory, so the workers will not copy the library. This is skipped for memory-mapped index.
+            for entropy_search in self.spectral_library.values():
+                entropy_search.save_memory_for_multiprocessing()
+
+            # The workers only need the library, use a light copy of this object to avoid sending the queues and results.
+            searcher = EntropySearch(self.ms2_tolerance_in_da)
+            searcher.spectral_library = self.spectral_library
+            searcher.path_index = self.path_index
+            searcher.result_cache = self.result_cache
+            searcher.library_key = self.library_key
+
+            mp_context = _get_multiprocessing_context()
+            self.queue_input, self.queue_output = mp_context.Queue(), mp_context.Queue()
+            self.all_processes = [
+                mp_context.Process(
+                    target=worker_search_one_spectrum,
+                    args=(searcher._search_block, (top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types), self.queue_input, self.queue_output),
+                    daemon=True,
+                )
+                for _ in range(cores)
+            ]
+            for p in self.all_processes:
+                p.start()
+
+            # Send spectra to the workers in blocks
+            queue_input_num = 0
+            spec_num = 0
+            for spec_idx_start, all_spec in self._read_spectra_in_blocks(file_query, charge=charge, cores=cores):
+                if self.cancelled:
+                    break
+                if self._restore_block(spec_idx_start, all_spec):
+                    continue
+                self.queue_input.put((spec_idx_start, all_spec))
+                queue_input_num += 1
+                spec_num += len(all_spec)
+
+            # Set ready to display results signal
+            self.status["ready"] = True
+            for _ in range(cores):
+                self.queue_input.put(None)
+
+            total_block_num = queue_input_num
+            worker_timeout = float(os.environ.get(ENV_WORKER_TIMEOUT_IN_SECONDS, DEFAULT_WORKER_TIMEOUT_IN_SECONDS))
+            last_result_time = time.monotonic()
+            while queue_input_num > 0:
+                if self.cancelled:
+                    self._kill_processes()
+                    self.status = {"ready": True, "running": False, "error": False, "message": "Cancelled"}
+                    return []
+                try:
+                    cur_result = self.queue_output.get(timeout=1)
+                except queue.Empty:
+                    if not self.status["running"]:
+                        # Stopped by user
+                        return []
+                    if not any(p.is_alive() for p in self.all_processes):
+                        raise RuntimeError("All search processes exited unexpectedly.")
+                    for p in self.all_processes:
+                        if p.exitcode not in (None, 0):
+                            raise RuntimeError(f"A search process exited unexpectedly with exit code {p.exitcode}.")
+                    if time.monotonic() - last_result_time > worker_timeout:
+                        raise RuntimeError(f"The search processes returned no result in {worker_timeout:g} seconds.")
+                    continue
+                last_result_time = time.monotonic()
+                queue_input_num -= 1
+                # Merge results into original file
+                if cur_result is not None:
+                    spec_idx_start, batch_result, metrics_state, all_warning = cur_result
+                    REGISTRY.merge_state(metrics_state)
+                    for warning in all_warning:
+                        self.event_log.add_warning(warning)
+                    all_spec = self.all_spectra[spec_idx_start : spec_idx_start + _SEARCH_BLOCK_SIZE]
+                    self._merge_batch_result(spec_idx_start, all_spec, batch_result)
+
+                processed_block_num = total_block_num - queue_input_num
+                self.status["message"] = f"{min(processed_block_num * _SEARCH_BLOCK_SIZE, spec_num)} spectra searched, about {queue_input_num * _SEARCH_BLOCK_SIZE} remaining"
+
+            for p in self.all_processes:
+                p.join(worker_timeout)
+            self._kill_processes()
+
+            # Set success finished signal
+            self.status = {"ready": True, "running": False, "error": False, "message": ""}
+        except Exception as e:
+            traceback.print_exc()
+            self._kill_processes()
+            self.status = {"ready": False, "running": False, "error": True, "message": f"Error: {e}"}
+        return []
 
     def stop(self, timeout=None):
         self.status = {
@@ -233,11 +611,12 @@ class EntropySearch:
         if self.queue_input is not None:
             while not self.queue_input.empty():
                 self.queue_input.get()
-        self.queue_input.close()
-        self.queue_input = None
+            self.queue_input.close()
+            self.queue_input = None
 
-        self.queue_output.close()
-        self.queue_output = None
+        if self.queue_output is not None:
+            self.queue_output.close()
+            self.queue_output = None
 
         self.status = {
             "ready": False,
@@ -246,46 +625,46 @@ class EntropySearch:
             "running": False,
         }
 
+    def cancel(self):
+        """
+        Cancel the running search, the results searched before cancelling are kept.
+        """
+        self.cancelled = True
+        self.status["message"] = "Cancelling..."
+
     def exit(self):
         self.stop(0.1)
-        # Kill all processes
+        self._kill_processes()
+
+    def _kill_processes(self):
         for p in self.all_processes:
             try:
-                p.kill()
-                p.join()
+                if p.is_alive():
+                    p.kill()
+                p.join(1)
             except:
                 pass
         self.all_processes = []
+        # No process reads the input queue any more, the blocks left in it are dropped instead of blocking the exit
+        if self.queue_input is not None:
+            self.queue_input.cancel_join_thread()
 
-    def search_file_single_core(self, file_query, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, charge=None, cores=1):
+    def search_file_single_core(self, file_query, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, charge=None, cores=1, search_types=None):
         # Search spectra
         file_query = Path(file_query)
         all_results = []
+        if self.result_store is None:
+            self.result_store = ResultStore(SEARCH_TYPES, top_n)
         self.status = {"ready": False, "running": True, "error": False, "message": f"Start reading {file_query.name}..."}
-        for spec_num, spec in enumerate(read_one_spectrum(file_query)):
+        for spec_idx_start, all_spec in self._read_spectra_in_blocks(file_query, charge=charge, cores=cores):
+            if self.cancelled:
+                self.status = {"ready": True, "running": False, "error": False, "message": "Cancelled"}
+                return all_results
+            if self._restore_block(spec_idx_start, all_spec):
+                continue
             try:
-                if spec_num % 100 == 0:
-                    self.status["message"] = f"Reading {file_query.name}... {spec_num} spectra read"
-                if spec.pop("_ms_level", 2) != 2:
-                    continue
-                spec["charge"] = 0
-                # if charge is not None:
-                #     spec["charge"] = charge
-                spec["peaks"] = np.array(spec["peaks"]).astype(np.float32)
-                self.all_spectra.append(spec)
-                self.scan_number_to_index[spec["_scan_number"]] = len(self.all_spectra) - 1
-
-                # if spec.pop("_ms_level", 2) != 2:
-                #     continue
-                # spec['peaks'] = np.array(spec['peaks']).astype(np.float32)
-
-                cur_result = self.search_one_spectrum(spec, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da)
-                if cur_result is not None:
-                    spec_idx = self.scan_number_to_index[cur_result["scan"]]
-                    self.all_spectra[spec_idx].update(cur_result)
-                # all_results.append(result)
-                # # if len(all_results) > 100:
-                # #     break
+                batch_result = self.search_spectra_with_cache(all_spec, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types)
+                self._merge_batch_result(spec_idx_start, all_spec, batch_result)
             except Exception as e:
                 continue
 
@@ -297,193 +676,333 @@ class EntropySearch:
         }
         return all_results
 
-    def load_spectral_library(self, file_library) -> None:
-        file_library = Path(file_library)
+    def _read_spectra_in_blocks(self, file_query, charge=None, cores=1):
+        """
+        Read the MS/MS spectra from the query file into self.all_spectra, and yield them in blocks of _SEARCH_BLOCK_SIZE spectra.
+        The spectra are parsed by cores processes with query_reader.read_query_spectra while the blocks are searched.
+
+        :param charge: If it is not 0 or None, all query spectra are searched with this charge.
+        """
+        spec_idx_start = len(self.all_spectra)
+        spec_num = 0
+        for all_spec in read_query_spectra(file_query, cores=cores, mp_context=_get_multiprocessing_context()):
+            for spec in all_spec:
+                self._set_query_charge(spec, charge)
+                self.all_spectra.append(spec)
+                self.scan_number_to_index[spec["scan"]] = len(self.all_spectra) - 1
+                if len(self.all_spectra) - spec_idx_start == _SEARCH_BLOCK_SIZE:
+                    yield spec_idx_start, self.all_spectra[spec_idx_start:]
+                    spec_idx_start = len(self.all_spectra)
+            spec_num += len(all_spec)
+            self.status["message"] = f"Reading {file_query.name}... {spec_num} spectra read"
+
+        if len(self.all_spectra) > spec_idx_start:
+            yield spec_idx_start, self.all_spectra[spec_idx_start:]
+
+    def load_spectral_library(self, file_library, cores=1) -> None:
+        """
+        Load the spectral library, the index is built if it is not in the index cache.
+
+        :param file_library: A library file, or a list of library files. Each file in the list is a shard, which is
+                             indexed and cached on its own, and all shards are searched together.
+        """
         self.status = {
             "ready": False,
             "running": True,
             "error": False,
             "message": "Start loading spectral library...",
         }
+        if isinstance(file_library, (list, tuple)):
+            if len(file_library) != 1:
+                self._load_library_shards(file_library, cores=cores)
+                return
+            file_library = file_library[0]
 
+        file_library = Path(file_library)
         self.status["message"] = f"Loading {file_library.name}..."
         # Check if the library is already indexed
-        self._build_spectral_library(file_library)
-
-        # # Enable support for multiple cores
-        # for entropy_search in self.spectral_library.values():
-        #     entropy_search.save_memory_for_multiprocessing()
+        self._build_spectral_library(file_library, cores=cores)
+
+    def _load_library_shards(self, all_file_library, cores=1):
+        all_shard_name, all_spectral_library, all_path_index, all_charge_partition = [], [], [], []
+        for file_library in all_file_library:
+            file_library = Path(file_library)
+            self.status["message"] = f"Loading {file_library.name}..."
+            self._build_spectral_library(file_library, cores=cores)
+            all_shard_name.append(get_shard_name(self.path_index) if self.path_index is not None else file_library.stem)
+            all_spectral_library.append(getattr(self.spectral_library, "all_partition", self.spectral_library))
+            all_path_index.append(self.path_index)
+            all_charge_partition.append(get_library_charge_partition(self.spectral_library))
+        if len(set(all_charge_partition)) > 1:
+            raise ValueError(f"The library files are partitioned by charge in different ways: {all_charge_partition}, please index them again.")
+        self.spectral_library = PartitionedLibrary(combine_library_shards(all_shard_name, all_spectral_library), all_charge_partition[0])
+        # The shards can be read again by the search processes only if all of them are indexed by this version.
+        self.path_index = all_path_index if all(x is not None for x in all_path_index) else None
+
+    def get_index_key(self, file_library):
+        """
+        Get the key of the index for file_library, the same library file and parameters always get the same key.
+        For a list of library files, the key is calculated from the keys of all files.
+        """
+        if isinstance(file_library, (list, tuple)):
+            if len(file_library) != 1:
+                all_index_key = [self.get_index_key(x) for x in file_library]
+                return hashlib.sha256(",".join(all_index_key).encode()).hexdigest()[:32]
+            file_library = file_library[0]
+        file_library = Path(file_library)
+        if file_library.suffix == ".esi":
+            return file_library.stem
+        if self.index_cache is None:
+            self.index_cache = IndexCache()
+        return self.index_cache.get_index_key(
+            file_library,
+            {
+                "ms2_tolerance_in_da": self.ms2_tolerance_in_da,
+                "charge_partition": self.charge_partition,
+                "version": __VERSION__,
+                "index_format": INDEX_FORMAT_VERSION,
+            },
+        )
+
+    def _get_library_key(self):
+        """
+        Get the key of the library in the result cache: the path and the version of each library index, the version
+        changes when the index is rebuilt or updated. The result cache is not used for a library without index on disk.
+        """
+        if self.path_index is None:
+            return None
+        try:
+            all_library_key = []
+            for path_index in self.path_index if isinstance(self.path_index, list) else [self.path_index]:
+                path_index = Path(path_index).resolve()
+                generation = read_index_information(path_index).get("generation", 0)
+                all_library_key.append(f"{path_index}:{generation}:{(path_index / 'information.json').stat().st_mtime_ns}")
+            return ",".join(all_library_key)
+        except Exception:
+            return None
+
+    def set_spectral_library(self, spectral_library, path_index=None):
+        """
+        Use a spectral library which is already loaded by another EntropySearch object.
+        """
+        self.result_generation += 1
+        self.spectral_library = spectral_library
+        self.path_index = path_index
 
-    def _build_spectral_library(self, file_library):
-        # Calculate hash of file_library
-        index_hash = hashlib.md5(json.dumps({"ms2_tolerance_in_da": self.ms2_tolerance_in_da, "version": __VERSION__}).encode()).hexdigest()[:6]
+    def append_library_spectra(self, file_library):
+        """
+        Append the spectra in file_library to the loaded library index, the library index of existing spectra is not changed.
+        When the appended spectra exceed MAX_DELTA_SPECTRA_NUM, they are merged into the main index in the background.
+        An index in the index cache is copied before its first update, and path_index is changed to the copy.
 
+        :return: A dict of {charge: list of the library index of the appended spectra}, the charge is the partition.
+        """
+        path_index = self._get_path_index_for_update()
+        file_library = Path(file_library)
+        all_library_idx = append_library_spectra(
+            path_index,
+            file_library,
+            functools.partial(
+                _parse_library_spectrum, library_name=file_library.stem, charge_partition=get_library_charge_partition(self.spectral_library)
+            ),
+        )
+        self._read_spectral_library_index(path_index)
+        if get_delta_spectra_num(path_index) >= MAX_DELTA_SPECTRA_NUM:
+            threading.Thread(target=self._merge_library_delta, args=(path_index,), daemon=True).start()
+        return {charge: self.spectral_library.get_library_idx(charge, library_idx) for charge, library_idx in all_library_idx.items()}
+
+    def delete_library_spectra(self, all_library_idx):
+        """
+        Mark the library spectra as deleted, they are not returned by later searches, but the reported results can
+        still show them. An index in the index cache is copied before its first update, as in append_library_spectra.
+
+        :param all_library_idx: The library index of the spectra, which also tells the partition of each spectrum.
+        """
+        path_index = self._get_path_index_for_update()
+        all_partition_library_idx = {}
+        for library_idx in all_library_idx:
+            partition, library_idx = self.spectral_library.locate(library_idx)
+            all_partition_library_idx.setdefault(partition, []).append(library_idx)
+        for partition, partition_library_idx in all_partition_library_idx.items():
+            delete_library_spectra(path_index, partition, partition_library_idx)
+        self._read_spectral_library_index(path_index)
+
+    def _merge_library_delta(self, path_index):
+        try:
+            if merge_library_delta(path_index, MAX_DELTA_SPECTRA_NUM) and self.path_index == path_index:
+                self._read_spectral_library_index(path_index)
+        except Exception:
+            traceback.print_exc()
+
+    def _get_path_index_for_update(self):
+        if self.path_index is None:
+            raise ValueError("Only the library index generated by this version can be updated, please load the library again.")
+        if isinstance(self.path_index, list):
+            raise ValueError("A sharded library can not be updated, please update each library file on its own.")
+        # The index in the cache should match its library file, so the spectra are updated in a copy of it
+        if self.index_cache is None:
+            self.index_cache = IndexCache()
+        if self.index_cache.is_cached(self.path_index):
+            self._read_spectral_library_index(self.index_cache.fork(self.path_index))
+        return self.path_index
+
+    def _build_spectral_library(self, file_library, cores=1):
         # Check if the library is already indexed
         if file_library.suffix == ".esi":
             try:
-                with open(file_library, "rb") as f:
-                    self.spectral_library = pickle.load(f)
+                self._read_spectral_library_index(file_library)
                 return True
             except:
                 pass
 
-        # Check if the library is existed
-        file_library_index = file_library.parent / (file_library.name + "." + index_hash + ".esi")
-        library_name = ".".join(file_library_index.stem.split(".")[:-2])
-        if file_library_index.exists():
+        # Check if the library is existed in the index cache, the key is calculated from the content of file_library
+        library_name = file_library.stem
+        self.status["message"] = f"Checking {file_library.name}..."
+        index_key = self.get_index_key(file_library)
+        file_library_index = self.index_cache.lookup(index_key)
+        if file_library_index is not None:
             try:
-                with open(file_library_index, "rb") as f:
-                    self.spectral_library = pickle.load(f)
+                self._read_spectral_library_index(file_library_index)
                 return True
             except:
                 pass
+        file_library_index = self.index_cache.get_index_path(index_key)
+
+        build_spectral_library_index(
+            file_library,
+            file_library_index,
+            self.ms2_tolerance_in_da,
+            functools.partial(_parse_library_spectrum, library_name=library_name, charge_partition=self.charge_partition),
+            information={"library_name": library_name, "version": __VERSION__, "charge_partition": self.charge_partition},
+            cores=cores,
+            mp_context=_get_multiprocessing_context(),
+            status=self.status,
+        )
+        self._read_spectral_library_index(file_library_index)
+        self.index_cache.evict(keep=[index_key])
+        return True
 
-        spectral_library = {0: []}
-        spectral_number = 0
-        # Read spectra
-        for spec in read_one_spectrum(file_library):
-            try:
-                # spec_raw = spec
-                spec["peaks"] = np.array(spec["peaks"]).astype(np.float32)
-                spec = _parse_spectrum(spec)
+    def _read_spectral_library_index(self, path_index):
+        self.result_generation += 1
+        if is_spectral_library_index(path_index):
+            self.spectral_library = read_partitioned_library(path_index)
+            self.path_index = Path(path_index)
+        else:
+            # Index generated by the old version, which is a pickled dict of {charge: FlashEntropySearch}
+            with open(path_index, "rb") as f:
+                self.spectral_library = pickle.load(f)
+            self.path_index = None
+
+
+def _search_library(entropy_search, all_spec, query_idx, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types=None):
+    """
+    Search the query spectra all_spec[query_idx] against one library, and select the top N library spectra for each
+    query and each search type. The return value has the same format as EntropySearch.search_spectra, but is not sorted.
+
+    The searches only return the library spectra with score > 0, so the top N is selected from these candidates
+    instead of from a score array as long as the library.
+
+    :param search_types: The search types to run, None means all SEARCH_TYPES.
+    """
+    search_types = SEARCH_TYPES if search_types is None else search_types
+    all_query_idx, all_library_idx, all_score, all_search_type = [], [], [], []
+    if len(entropy_search.precursor_mz_array) == 0:
+        return _concatenate_results([])
+    all_other_search_type = [x for x in SEARCH_TYPES if x in search_types and x != "identity_search"]
+    for i in query_idx:
+        spec = all_spec[i]
+        time_0 = time.perf_counter()
+        peaks = clean_query_peaks(spec["precursor_mz"], spec["peaks"])
+        time_1 = time.perf_counter()
+        STAGE_DURATION.observe(time_1 - time_0, stage="clean_peaks")
+        result = {}
+        if "identity_search" in search_types:
+            result["identity_search"] = search_identity_sparse(entropy_search, spec["precursor_mz"], peaks, ms1_tolerance_in_da, ms2_tolerance_in_da)
+            time_0, time_1 = time_1, time.perf_counter()
+            STAGE_DURATION.observe(time_1 - time_0, stage="identity_search")
+        if all_other_search_type:
+            result.update(search_sparse(entropy_search, spec["precursor_mz"], peaks, ms2_tolerance_in_da, all_other_search_type))
+            time_0, time_1 = time_1, time.perf_counter()
+            STAGE_DURATION.observe(time_1 - time_0, stage="sparse_search")
+
+        for search_type, (library_idx, score) in result.items():
+            if len(score) > top_n:
+                selected = np.argpartition(score, -top_n)[-top_n:]
+                library_idx, score = library_idx[selected], score[selected]
+            all_query_idx.append(np.full(len(score), i, dtype=np.int64))
+            all_library_idx.append(library_idx.astype(np.int64))
+            all_score.append(score)
+            all_search_type.append(np.full(len(score), SEARCH_TYPES.index(search_type), dtype=np.uint8))
+        STAGE_DURATION.observe(time.perf_counter() - time_1, stage="top_n")
+    return _concatenate_results(
+        [{"query_idx": q, "library_idx": l, "score": s, "search_type": t} for q, l, s, t in zip(all_query_idx, all_library_idx, all_score, all_search_type)]
+    )
 
-                if spec["precursor_mz"] <= 0 or len(spec["peaks"]) == 0 or spec.get("_ms_level", 2) != 2:
-                    continue
 
-                charge = 0
-                # if charge not in spectral_library:
-                #     spectral_library[charge] = []
+def _search_library_shards(sharded_library, all_spec, query_idx, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types=None):
+    """
+    Search all shards in parallel, each shard returns its own top N, then merge them into the top N of all shards.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(sharded_library.all_shard)), thread_name_prefix="search_shard") as executor:
+        all_shard_result = list(
+            executor.map(
+                lambda shard: (_search_library_shards if isinstance(shard, ShardedLibrary) else _search_library)(
+                    shard, all_spec, query_idx, top_n, ms1_tolerance_in_da, ms2_tolerance_in_da, search_types
+                ),
+                sharded_library.all_shard,
+            )
+        )
+    for shard_idx, shard_result in enumerate(all_shard_result):
+        shard_result["library_idx"] += sharded_library.shard_offset[shard_idx]
+    result = _concatenate_results(all_shard_result)
+
+    # Sort the hits of each query and search type by descending score, and keep the first N of each group
+    order = np.lexsort((-result["score"], result["search_type"], result["query_idx"]))
+    result = {k: v[order] for k, v in result.items()}
+    rank = get_hit_rank(result["query_idx"], result["search_type"])
+    return {k: v[rank < top_n] for k, v in result.items()}
+
+
+def _get_spectrum_without_peaks(spec):
+    return {k: v.item() if isinstance(v, np.generic) else v for k, v in spec.items() if k != "peaks"}
+
+
+def _concatenate_results(all_result):
+    all_result = [x for x in all_result if len(x["query_idx"]) > 0]
+    if len(all_result) == 0:
+        return {
+            "query_idx": np.zeros(0, dtype=np.int64),
+            "library_idx": np.zeros(0, dtype=np.int64),
+            "score": np.zeros(0, dtype=np.float32),
+            "search_type": np.zeros(0, dtype=np.uint8),
+        }
+    return {k: np.concatenate([x[k] for x in all_result]) for k in all_result[0]}
 
-                all_spec_keys = list(spec.keys())
-                all_spec_keys.remove("peaks")
-                all_spec_keys.remove("precursor_mz")
-                all_spec_keys.remove("_ms_level")
-                for k in all_spec_keys:
-                    spec["library-" + k] = spec.pop(k)
-                spec["library-file_name"] = library_name
 
-                spectral_library[charge].append(spec)
-                spectral_number += 1
+def _parse_library_spectrum(spec, library_name, charge_partition="none"):
+    spec["peaks"] = np.array(spec["peaks"]).astype(np.float32)
+    spec = parse_spectrum(spec)
 
-                if spectral_number % 1000 == 0:
-                    self.status["message"] = f"Loading {spectral_number} spectra from {library_name}..."
-            except:
-                continue
+    if spec["precursor_mz"] <= 0 or len(spec["peaks"]) == 0 or spec.get("_ms_level", 2) != 2:
+        return None
 
-        # Build index
-        self.status["message"] = f"Building index for {library_name}, this may take up to 10 minutes depending on the size of the library..."
-        for charge, spectra in spectral_library.items():
-            entropy_search = FlashEntropySearch(max_ms2_tolerance_in_da=self.ms2_tolerance_in_da)
-            all_library_spectra = entropy_search.build_index(all_spectra_list=spectra, min_ms2_difference_in_da=2 * self.ms2_tolerance_in_da)
-            # Generate abstract spectra information
-            all_library_spectra_abstract = []
-            for spec in all_library_spectra:
-                spec_abstract = {
-                    "library-id": spec.get("library-id", spec.get("library-scan", "")),
-                    "precursor_mz": spec["precursor_mz"],
-                    "library-name": spec["library-name"],
-                    "library-precursor_type": spec["library-precursor_type"],
-                    "library-idx": len(all_library_spectra_abstract),
-                }
-                all_library_spectra_abstract.append(spec_abstract)
-            entropy_search.abstract_library_spectra = all_library_spectra_abstract
-
-            spectral_library[charge] = entropy_search
-
-        self.status["message"] = f"Saving index for {library_name}..."
-        # Save index
-        with open(file_library_index, "wb") as f:
-            pickle.dump(spectral_library, f)
-        self.spectral_library = spectral_library
-        return True
+    charge = get_partition_charge(spec["charge"], charge_partition)
 
+    all_spec_keys = list(spec.keys())
+    all_spec_keys.remove("peaks")
+    all_spec_keys.remove("precursor_mz")
+    all_spec_keys.remove("_ms_level")
+    for k in all_spec_keys:
+        spec["library-" + k] = spec.pop(k)
+    spec["library-file_name"] = library_name
+    return charge, spec
 
-def _parse_spectrum(spec):
-    def convert_float(x):
-        try:
-            f = float(x)
-            if np.isnan(f):
-                return -1
-            else:
-                return f
-        except:
-            return -1
 
-    def convert_precursor_mz(x):
-        try:
-            f = float(x)
-            if np.isnan(f):
-                return -1
-            else:
-                return f
-        except:
-            try:
-                return float(x.split()[0])
-            except:
-                return -1
-
-    spec = standardize_spectrum(
-        spec,
-        standardize_info={
-            "id": [["db#"], "", str],
-            "scan": [["_scan_number"], -1, int],
-            "name": [["title"], "", str],
-            "rt": [["retentiontime"], -1, convert_float],
-            "precursor_mz": [["precursormz", "pepmass"], -1, convert_precursor_mz],
-            "ion_mode": [["ionmode"], "", str],
-            "precursor_type": [["precursortype"], "", str],
-            "charge": [[], "", str],
-            "name": [["title"], "", str],
-        },
-    )
+def _get_multiprocessing_context():
+    # The main process runs many threads, a forked worker may inherit a lock held by one of them and never finish.
+    # With forkserver, the workers are forked from a process without these threads, and read the memory-mapped index
+    # again by its path.
+    if sys.platform.startswith("linux"):
+        return mp.get_context("forkserver")
+    return mp.get_context()
 
-    charge = 0
-    # if spec["charge"]:
-    #     if spec["charge"][-1] in {"+", "-"}:
-    #         c = spec["charge"][-1]
-    #         try:
-    #             charge = int(spec["charge"][:-1])
-    #             if c == "-":
-    #                 charge = -charge
-    #         except:
-    #             charge = 0
-    #     else:
-    #         try:
-    #             charge = int(spec["charge"])
-    #         except:
-    #             charge = 0
-
-    # # Infer precursor charge from ion mode
-    # if (charge == 0) and (ion_mode := spec["ion_mode"]):
-    #     charge = {"n": -1, "p": 1}.get(ion_mode[0].lower(), "")
-
-    # # Guess precursor charge from adduct
-    # if (charge == 0) and (len(spec["precursor_type"]) > 0):
-    #     charge = {"+": 1, "-": -1}.get(spec["precursor_type"][-1], "")
-
-    spec["charge"] = charge
-    return spec
-
-
-if __name__ == "__main__":
-    para = {
-        "ms1_tolerance_in_da": 0.01,
-        "ms2_tolerance_in_da": 0.02,
-        "top_n": 10,
-        "cores": 1,
-        "file_query": r"/p/github/EntropySearch/test/test_2.mzML",
-        # "file_library": r"/p/github/EntropySearch/test/MoNA-export-All_Spectra.msp",
-        # "file_query": r"/p/FastEntropySearch/gui/test/input/test.mgf",
-        "file_library": r"/p/FastEntropySearch/gui/test/input/test.mgf",
-        "file_output": r"/p/github/EntropySearch/test/result.csv",
-    }
-    entropy_search = EntropySearch(para["ms2_tolerance_in_da"])
-    entropy_search.load_spectral_library(Path(para["file_library"]))
-    all_results = entropy_search.search_file_single_core(
-        Path(para["file_query"]), para["top_n"], para["ms1_tolerance_in_da"], para["ms2_tolerance_in_da"], cores=para["cores"]
-    )
-    a = 1
-    # test = entropy_search.get_one_spectrum_result(5, para["top_n"], para["ms1_tolerance_in_da"], para["ms2_tolerance_in_da"])
-    # print(test)
-    # test2 = entropy_search.get_one_library_spectrum(charge=1, library_idx=1489)
-    # print(test2)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import numpy as np
+from ms_entropy import FlashEntropySearch, clean_spectrum
+
+# The peaks of the library grouped by spectrum: the peaks of spectrum i are
+# spectrum_peaks_mz[spectrum_peaks_idx_start[i] : spectrum_peaks_idx_start[i + 1]], sorted by m/z.
+SPECTRUM_PEAKS_INDEX_NAMES = ["spectrum_peaks_idx_start", "spectrum_peaks_mz", "spectrum_peaks_intensity"]
+
+
+def build_spectrum_peaks_index(entropy_search):
+    """
+    Group the peaks in the index of a FlashEntropySearch object by spectrum, the intensity is already weighted.
+
+    :return: A list of arrays in the order of SPECTRUM_PEAKS_INDEX_NAMES.
+    """
+    index = dict(zip(entropy_search.entropy_search.index_names, entropy_search.entropy_search.index))
+    all_ions_spec_idx = np.asarray(index["all_ions_spec_idx"])
+    # The peaks in the index are sorted by m/z, a stable sort keeps them sorted by m/z in each spectrum
+    order = np.argsort(all_ions_spec_idx, kind="stable")
+    spectra_num = len(entropy_search.precursor_mz_array)
+    idx_start = np.concatenate([[0], np.cumsum(np.bincount(all_ions_spec_idx, minlength=spectra_num))]).astype(np.uint64)
+    return [idx_start, np.asarray(index["all_ions_mz"])[order], np.asarray(index["all_ions_intensity"])[order]]
+
+
+def get_spectrum_peaks_index(entropy_search):
+    """
+    Get the spectrum peaks index of a FlashEntropySearch object, it is built the first time if it is not read from disk.
+    """
+    spectrum_peaks_index = getattr(entropy_search, "spectrum_peaks_index", None)
+    if spectrum_peaks_index is None:
+        spectrum_peaks_index = build_spectrum_peaks_index(entropy_search)
+        entropy_search.spectrum_peaks_index = spectrum_peaks_index
+    return spectrum_peaks_index
+
+
+def clean_query_peaks(precursor_mz, peaks):
+    """
+    Clean the query peaks with the default parameters of FlashEntropySearch.search.
+    """
+    return clean_spectrum(
+        peaks=peaks,
+        min_mz=0,
+        max_mz=precursor_mz - 1.6,
+        noise_threshold=0.01,
+        min_ms2_difference_in_da=0.05,
+        max_peak_num=None,
+        normalize_intensity=True,
+    )
+
+
+def search_identity_sparse(library, precursor_mz, peaks, ms1_tolerance_in_da, ms2_tolerance_in_da):
+    """
+    Identity search which only scores the library spectra with precursor m/z in the MS1 tolerance window, the scores
+    are the same as FlashEntropySearch.identity_search up to float32 rounding.
+
+    :param library: A FlashEntropySearch object, or an object with the method search_identity_sparse.
+    :param peaks: The query peaks cleaned by clean_query_peaks.
+    :return: The library index and the score of the library spectra with score > 0.
+    """
+    if not isinstance(library, FlashEntropySearch):
+        return library.search_identity_sparse(precursor_mz, peaks, ms1_tolerance_in_da, ms2_tolerance_in_da)
+
+    entropy_search = library
+    spec_idx_min = int(np.searchsorted(entropy_search.precursor_mz_array, precursor_mz - ms1_tolerance_in_da, side="left"))
+    spec_idx_max = int(np.searchsorted(entropy_search.precursor_mz_array, precursor_mz + ms1_tolerance_in_da, side="right"))
+    if spec_idx_min >= spec_idx_max or len(peaks) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    idx_start, all_peaks_mz, all_peaks_intensity = get_spectrum_peaks_index(entropy_search)
+    peak_idx_min, peak_idx_max = int(idx_start[spec_idx_min]), int(idx_start[spec_idx_max])
+    library_mz = np.asarray(all_peaks_mz[peak_idx_min:peak_idx_max])
+    library_intensity = np.asarray(all_peaks_intensity[peak_idx_min:peak_idx_max])
+    library_spec_idx = np.repeat(np.arange(spec_idx_min, spec_idx_max), np.diff(idx_start[spec_idx_min : spec_idx_max + 1]).astype(np.int64))
+
+    peaks = entropy_search.entropy_search._preprocess_peaks(peaks)
+    # The same m/z range as FlashEntropySearchCore.search, which calculates the range for each peak
+    query_mz_min = np.array([mz - ms2_tolerance_in_da for mz in peaks[:, 0]])
+    query_mz_max = np.array([mz + ms2_tolerance_in_da for mz in peaks[:, 0]])
+    query_intensity = peaks[:, 1]
+
+    # The query peaks are separated by more than 2 * ms2_tolerance_in_da, so each library peak matches at most one query peak
+    query_peak_idx = np.searchsorted(query_mz_min, library_mz, side="right") - 1
+    matched = query_peak_idx >= 0
+    matched[matched] = library_mz[matched] <= query_mz_max[query_peak_idx[matched]]
+    intensity_a = query_intensity[query_peak_idx[matched]].astype(np.float64)
+    intensity_b = library_intensity[matched].astype(np.float64)
+    intensity_ab = intensity_a + intensity_b
+    modified_value = intensity_ab * np.log2(intensity_ab) - intensity_a * np.log2(intensity_a) - intensity_b * np.log2(intensity_b)
+    # Summed in float64, so the scores can differ from FlashEntropySearchCore in the last bit of float32
+    score = np.bincount(library_spec_idx[matched] - spec_idx_min, weights=modified_value, minlength=spec_idx_max - spec_idx_min).astype(np.float32)
+    selected = score > 0
+    return np.arange(spec_idx_min, spec_idx_max, dtype=np.int64)[selected], score[selected]
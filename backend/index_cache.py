@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+# The cache directory and its size limit can be changed with these environment variables.
+ENV_CACHE_DIR = "ENTROPY_SEARCH_CACHE_DIR"
+ENV_CACHE_SIZE_IN_GB = "ENTROPY_SEARCH_CACHE_SIZE_IN_GB"
+DEFAULT_CACHE_SIZE_IN_GB = 50
+
+_HASH_CHUNK_SIZE = 8 * 1024 * 1024
+_QUICK_HASH_SIZE = 1024 * 1024
+
+
+class IndexCache:
+    """
+    A shared cache of built library indexes. Each index is stored in <path_cache>/<key>.esi, where the key is
+    calculated from the content of the library file and the parameters used to build the index, so the same
+    library at different paths shares one index, and a modified library never reuses a stale index.
+
+    When the total size exceeds max_size_in_bytes, the least recently used indexes are removed. An index with
+    appended or deleted spectra no longer matches its library file, so it is a copy in <path_cache>/updated/<id>.esi,
+    which is not removed, see fork.
+    """
+
+    def __init__(self, path_cache=None, max_size_in_bytes=None) -> None:
+        if path_cache is None:
+            path_cache = get_cache_dir()
+        if max_size_in_bytes is None:
+            max_size_in_bytes = float(os.environ.get(ENV_CACHE_SIZE_IN_GB, DEFAULT_CACHE_SIZE_IN_GB)) * 1024**3
+        self.path_cache = Path(path_cache)
+        self.max_size_in_bytes = max_size_in_bytes
+        self.path_cache.mkdir(parents=True, exist_ok=True)
+        self.file_hash_record = self.path_cache / "file_hash.json"
+
+    def get_index_key(self, file_library, parameters: dict) -> str:
+        key = json.dumps({"library_hash": self.get_file_hash(file_library), **parameters}, sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+    def get_index_path(self, key) -> Path:
+        return self.path_cache / (key + ".esi")
+
+    def lookup(self, key):
+        """
+        Return the path of the index if it is cached, otherwise None. The index is marked as recently used.
+        """
+        path_index = self.get_index_path(key)
+        if not path_index.exists():
+            return None
+        touch_index(path_index)
+        return path_index
+
+    def is_cached(self, path_index) -> bool:
+        """
+        Check if path_index is an index in the cache, whose key is calculated from the content of its library file.
+        """
+        return Path(path_index).resolve().parent == self.path_cache.resolve()
+
+    def fork(self, path_index) -> Path:
+        """
+        Copy an index to a new path with a random id, so the copy can be updated while the cached index still
+        matches its library file.
+
+        :return: The path of the copy.
+        """
+        path_fork = self.path_cache / "updated" / (uuid.uuid4().hex + ".esi")
+        path_fork.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = path_fork.parent / f"{path_fork.name}.{os.getpid()}.tmp"
+        shutil.copytree(path_index, path_tmp)
+        os.replace(path_tmp, path_fork)
+        return path_fork
+
+    def get_file_hash(self, file_library) -> str:
+        """
+        Get the SHA-256 of the file content. The full hash is only calculated when the size, modification time or
+        the hash of the first and last 1 MB of the file has changed since the last calculation.
+        """
+        file_library = Path(file_library).resolve()
+        stat = file_library.stat()
+        quick_hash = _calculate_quick_hash(file_library, stat.st_size)
+
+        all_records = self._read_file_hash_record()
+        record = all_records.get(str(file_library))
+        if record is not None and record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns and record["quick_hash"] == quick_hash:
+            return record["hash"]
+
+        file_hash = _calculate_file_hash(file_library)
+        all_records = self._read_file_hash_record()
+        all_records[str(file_library)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "quick_hash": quick_hash, "hash": file_hash}
+        self._write_file_hash_record(all_records)
+        return file_hash
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used indexes until the total size of the cache is under the limit.
+
+        :param keep: The keys of indexes that should not be removed.
+        """
+        keep = {self.get_index_path(key) for key in keep}
+        all_index = []
+        for path_index in self.path_cache.glob("*.esi"):
+            try:
+                all_index.append((path_index.stat().st_mtime, get_size(path_index), path_index))
+            except OSError:
+                continue
+
+        total_size = sum(x[1] for x in all_index)
+        for _, size, path_index in sorted(all_index, key=lambda x: x[0]):
+            if total_size <= self.max_size_in_bytes:
+                break
+            if path_index in keep:
+                continue
+            shutil.rmtree(path_index, ignore_errors=True)
+            total_size -= size
+
+    def _read_file_hash_record(self):
+        try:
+            with open(self.file_hash_record, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_file_hash_record(self, all_records):
+        file_tmp = self.file_hash_record.parent / f"{self.file_hash_record.name}.{os.getpid()}.tmp"
+        with open(file_tmp, "w") as f:
+            json.dump(all_records, f)
+        os.replace(file_tmp, self.file_hash_record)
+
+
+def get_cache_dir():
+    """
+    The directory of the index cache, also used for the result cache, the checkpoints and the profiles of the jobs.
+    It is ENTROPY_SEARCH_CACHE_DIR if it is set, otherwise ~/.cache/entropy_search.
+    """
+    return Path(os.environ.get(ENV_CACHE_DIR) or Path.home() / ".cache" / "entropy_search")
+
+
+def touch_index(path_index):
+    """
+    Mark an index, or the indexes of all shards if path_index is a list, as recently used. The indexes in use are
+    marked each time they are searched, so evict removes them after the indexes which are not in use.
+    """
+    for path in path_index if isinstance(path_index, list) else [path_index]:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+
+def _calculate_file_hash(file_input):
+    file_hash = hashlib.sha256()
+    with open(file_input, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _calculate_quick_hash(file_input, file_size):
+    file_hash = hashlib.md5(str(file_size).encode())
+    with open(file_input, "rb") as f:
+        file_hash.update(f.read(_QUICK_HASH_SIZE))
+        if file_size > _QUICK_HASH_SIZE:
+            f.seek(max(_QUICK_HASH_SIZE, file_size - _QUICK_HASH_SIZE))
+            file_hash.update(f.read(_QUICK_HASH_SIZE))
+    return file_hash.hexdigest()
+
+
+def get_size(path):
+    if path.is_file():
+        return path.stat().st_size
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
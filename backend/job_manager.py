@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from entropy_search import EntropySearch
+from index_cache import get_cache_dir
+
+# The number of searches running at the same time, and the number of finished jobs kept in memory.
+ENV_MAX_RUNNING_JOBS = "ENTROPY_SEARCH_MAX_RUNNING_JOBS"
+ENV_MAX_FINISHED_JOBS = "ENTROPY_SEARCH_MAX_FINISHED_JOBS"
+DEFAULT_MAX_RUNNING_JOBS = 2
+DEFAULT_MAX_FINISHED_JOBS = 20
+
+
+class SearchJob:
+    """
+    One search of a query file against a spectral library, with its own status and results.
+
+    The job state is one of "queued", "running", "finished", "cancelled" or "error".
+    """
+
+    def __init__(self, info: dict) -> None:
+        self.job_id = uuid.uuid4().hex[:12]
+        self.info = info
+        self.state = "queued"
+        self.created_time = time.time()
+        self.finished_time = None
+        self.profile_file = None
+        self.entropy_search = EntropySearch(info["ms2_tolerance_in_da"])
+        self.entropy_search.status["message"] = "Waiting for other searches to finish..."
+
+    @property
+    def status(self):
+        return self.entropy_search.status
+
+    def run(self, library_registry):
+        """
+        Run the job, with cProfile if the job is submitted with profile=True. Only the job thread is profiled, the
+        search processes of a multi-core search are not.
+        """
+        if not self.info.get("profile"):
+            return self._run(library_registry)
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(self._run, library_registry)
+        finally:
+            try:
+                profile_file = get_cache_dir() / "profiles" / f"{self.job_id}.prof"
+                profile_file.parent.mkdir(parents=True, exist_ok=True)
+                profiler.dump_stats(profile_file)
+                self.profile_file = profile_file
+            except Exception:
+                traceback.print_exc()
+
+    def get_profile(self, sort_by="cumulative", limit=50):
+        """
+        Get the profile of the job as the text of pstats, the profile file can also be opened with other tools.
+        """
+        if self.profile_file is None:
+            raise ValueError(f"Job {self.job_id} is not profiled or not finished.")
+        stream = io.StringIO()
+        stream.write(f"Profile file: {self.profile_file}\n")
+        pstats.Stats(str(self.profile_file), stream=stream).sort_stats(sort_by).print_stats(limit)
+        return stream.getvalue()
+
+    def _run(self, library_registry):
+        if self.state == "cancelled":
+            return
+        self.state = "running"
+        print(f"Start searching job {self.job_id}: {self.info}")
+        entropy_search = self.entropy_search
+        try:
+            library_id = self.info.get("library_id")
+            if not library_id:
+                library_id = library_registry.load(
+                    self.info["file_library"], self.info["ms2_tolerance_in_da"], entropy_search=entropy_search, cores=self.info["cores"]
+                )
+            library = library_registry.get(library_id)
+            if self.info["ms2_tolerance_in_da"] > library["ms2_tolerance_in_da"]:
+                raise ValueError(f"The MS2 tolerance is larger than the MS2 tolerance used to load the library: {library['ms2_tolerance_in_da']}")
+            entropy_search.set_spectral_library(library["spectral_library"], library["path_index"])
+
+            if not entropy_search.cancelled:
+                entropy_search.search_file(
+                    self.info["file_query"],
+                    self.info["top_n"],
+                    self.info["ms1_tolerance_in_da"],
+                    self.info["ms2_tolerance_in_da"],
+                    charge=self.info["charge"],
+                    cores=self.info["cores"],
+                    path_output=self.info.get("path_output"),
+                    search_types=self.info.get("search_types") or None,
+                    resume=self.info.get("resume", False),
+                )
+        except Exception as e:
+            traceback.print_exc()
+            entropy_search.status = {"ready": False, "running": False, "error": True, "message": f"Error: {e}"}
+
+        if entropy_search.cancelled:
+            self.state = "cancelled"
+            entropy_search.status.update({"running": False, "message": "Cancelled"})
+        elif entropy_search.status["error"]:
+            self.state = "error"
+        else:
+            self.state = "finished"
+        self.finished_time = time.time()
+        print(f"Finish searching job {self.job_id}: {self.state}")
+
+    def cancel(self):
+        self.entropy_search.cancel()
+        if self.state == "queued":
+            self.state = "cancelled"
+            self.finished_time = time.time()
+            self.entropy_search.status = {"ready": False, "running": False, "error": False, "message": "Cancelled"}
+
+    def summary(self):
+        status = self.status
+        return {
+            "job_id": self.job_id,
+            "state": self.state,
+            "file_query": self.info["file_query"],
+            "file_library": self.info["file_library"],
+            "library_id": self.info.get("library_id", ""),
+            "created_time": self.created_time,
+            "finished_time": self.finished_time,
+            "profile_file": str(self.profile_file) if self.profile_file is not None else "",
+            "status": status["message"],
+            "is_ready": status["ready"],
+            "is_running": status["running"],
+            "is_error": status["error"],
+        }
+
+
+class JobManager:
+    """
+    Run search jobs in a bounded thread pool, at most max_running_jobs searches run at the same time,
+    the other jobs wait in the queue.
+    """
+
+    def __init__(self, library_registry, max_running_jobs=None, max_finished_jobs=None) -> None:
+        if max_running_jobs is None:
+            max_running_jobs = int(os.environ.get(ENV_MAX_RUNNING_JOBS, DEFAULT_MAX_RUNNING_JOBS))
+        if max_finished_jobs is None:
+            max_finished_jobs = int(os.environ.get(ENV_MAX_FINISHED_JOBS, DEFAULT_MAX_FINISHED_JOBS))
+        self.library_registry = library_registry
+        self.max_finished_jobs = max_finished_jobs
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_running_jobs), thread_name_prefix="search_job")
+        self.all_jobs = {}
+        self.latest_job_id = None
+        self._lock = threading.Lock()
+
+    def submit(self, info: dict) -> SearchJob:
+        job = SearchJob(info)
+        with self._lock:
+            self.all_jobs[job.job_id] = job
+            self.latest_job_id = job.job_id
+            self._remove_old_jobs()
+        self.executor.submit(job.run, self.library_registry)
+        return job
+
+    def get(self, job_id=None) -> SearchJob:
+        """
+        Get the job by id, or the latest submitted job if job_id is None.
+        """
+        with self._lock:
+            if job_id is None:
+                job_id = self.latest_job_id
+            job = self.all_jobs.get(job_id)
+        if job is None:
+            raise KeyError(f"Job {job_id} is not found.")
+        return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        job.cancel()
+        return job
+
+    def list_jobs(self):
+        with self._lock:
+            return [job.summary() for job in self.all_jobs.values()]
+
+    def exit(self):
+        with self._lock:
+            all_jobs = list(self.all_jobs.values())
+        for job in all_jobs:
+            try:
+                job.cancel()
+                job.entropy_search.exit()
+            except Exception as e:
+                print("Error found when exiting: ", e)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _remove_old_jobs(self):
+        all_finished_jobs = sorted(
+            (job for job in self.all_jobs.values() if job.finished_time is not None and job.job_id != self.latest_job_id), key=lambda x: x.finished_time
+        )
+        for job in all_finished_jobs[: max(0, len(all_finished_jobs) - self.max_finished_jobs)]:
+            self.all_jobs.pop(job.job_id)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+from identity_search import build_spectrum_peaks_index, get_spectrum_peaks_index
+from library_index import OffsetRecords, write_spectral_library
+from ms_entropy import FlashEntropySearch
+from query_reader import get_raw_chunk_tasks
+
+# The same as the default value of FlashEntropySearch.build_index
+_MAX_INDEXED_MZ = 1500.00005
+
+
+def build_spectral_library_index(
+    file_library, path_index, ms2_tolerance_in_da, parse_library_spectrum, information=None, cores=1, mp_context=None, status=None
+):
+    """
+    Build the index for a spectral library file and write it to path_index with write_spectral_library.
+
+    The library is read as a stream and cut into chunks. Each chunk is parsed, cleaned and converted to compact arrays,
+    then all chunks are merged into the final index, so the peak memory is close to the size of the final index.
+    With several cores, a plain .mgf, .msp or .mzML file is cut into blocks of bytes, each worker process reads and
+    processes a block by itself and saves the chunk to a temporary directory. With one core, the chunks are processed
+    in the current process and kept in memory.
+
+    :param parse_library_spectrum: A function that takes a spectrum from read_one_spectrum, returns (charge, spectrum)
+                                   or None if the spectrum should be skipped.
+    :param cores: The number of worker processes, 1 means processing all chunks in the current process.
+    :param status: The status dict of EntropySearch, its "message" is updated with the progress.
+    """
+    path_index = Path(path_index)
+    if status is None:
+        status = {}
+    path_index.parent.mkdir(parents=True, exist_ok=True)
+    path_tmp = None
+    if cores > 1:
+        path_tmp = Path(tempfile.mkdtemp(prefix=path_index.name + ".", suffix=".chunks", dir=path_index.parent))
+    try:
+        all_chunks = _process_library_file(file_library, path_tmp, ms2_tolerance_in_da, parse_library_spectrum, cores, mp_context, status)
+
+        status["message"] = f"Building index for {Path(file_library).name}, this may take up to 10 minutes depending on the size of the library..."
+        all_charges = sorted({charge for chunk in all_chunks for charge in chunk})
+        if len(all_charges) == 0:
+            raise ValueError(f"No valid MS/MS spectrum found in {file_library}")
+        spectral_library = {}
+        for charge in all_charges:
+            spectral_library[charge] = merge_library_chunks([chunk.pop(charge) for chunk in all_chunks if charge in chunk], ms2_tolerance_in_da)
+
+        status["message"] = f"Saving index for {Path(file_library).name}..."
+        write_spectral_library(path_index, spectral_library, information)
+    finally:
+        if path_tmp is not None:
+            shutil.rmtree(path_tmp, ignore_errors=True)
+
+
+def _process_library_file(file_library, path_tmp, ms2_tolerance_in_da, parse_library_spectrum, cores, mp_context, status):
+    all_chunks = []
+    spectral_number = 0
+
+    if cores <= 1:
+        for read_chunk, args in get_raw_chunk_tasks(file_library, cores):
+            spectral_number_chunk, chunk = process_raw_library_chunk(read_chunk, args, None, ms2_tolerance_in_da, parse_library_spectrum)
+            all_chunks.append(chunk)
+            spectral_number += spectral_number_chunk
+            status["message"] = f"Loading {spectral_number} spectra from {Path(file_library).name}..."
+        return all_chunks
+
+    # Keep at most 2 chunks for each worker in memory
+    all_futures = {}
+
+    def collect(all_done):
+        nonlocal spectral_number
+        for future in all_done:
+            spectral_number_chunk, chunk = future.result()
+            all_chunks.append((all_futures.pop(future), chunk))
+            spectral_number += spectral_number_chunk
+        status["message"] = f"Loading {spectral_number} spectra from {Path(file_library).name}..."
+
+    with ProcessPoolExecutor(max_workers=cores, mp_context=mp_context) as executor:
+        for chunk_id, (read_chunk, args) in enumerate(get_raw_chunk_tasks(file_library, cores)):
+            if len(all_futures) >= 2 * cores:
+                done, _ = wait(all_futures, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(
+                process_raw_library_chunk, read_chunk, args, path_tmp / str(chunk_id), ms2_tolerance_in_da, parse_library_spectrum
+            )
+            all_futures[future] = chunk_id
+        collect(list(all_futures))
+
+    # Keep the order of chunks the same as in the library file
+    return [chunk for _, chunk in sorted(all_chunks, key=lambda x: x[0])]
+
+
+def process_raw_library_chunk(read_chunk, args, path_chunk, ms2_tolerance_in_da, parse_library_spectrum):
+    """
+    Read a chunk of library spectra with read_chunk(*args), a task from query_reader.get_raw_chunk_tasks, then
+    process it with process_library_chunk.
+
+    :return: (the number of spectra read, the result of process_library_chunk)
+    """
+    all_spec = read_chunk(*args)
+    return len(all_spec), process_library_chunk(all_spec, path_chunk, ms2_tolerance_in_da, parse_library_spectrum)
+
+
+def process_library_chunk(all_spec, path_chunk, ms2_tolerance_in_da, parse_library_spectrum):
+    """
+    Parse and clean one chunk of library spectra, convert them to compact arrays for each charge.
+
+    :param path_chunk: The chunk of each charge is saved to path_chunk/charge_{charge}, or kept in memory if it is None.
+    :return: A dict of {charge: path of the saved chunk, or the chunk as a dict of arrays}
+    """
+    entropy_search = FlashEntropySearch(max_ms2_tolerance_in_da=ms2_tolerance_in_da)
+    all_spec_by_charge = {}
+    for spec in all_spec:
+        try:
+            parsed = parse_library_spectrum(spec)
+            if parsed is None:
+                continue
+            charge, spec = parsed
+            spec["peaks"] = entropy_search.clean_spectrum_for_search(
+                peaks=spec["peaks"], precursor_mz=spec["precursor_mz"], min_ms2_difference_in_da=2 * ms2_tolerance_in_da
+            )
+            if len(spec["peaks"]) > 0:
+                all_spec_by_charge.setdefault(charge, []).append(spec)
+        except:
+            continue
+
+    result = {}
+    for charge, all_spec in all_spec_by_charge.items():
+        all_peaks = [entropy_search.entropy_search._preprocess_peaks(spec["peaks"]) for spec in all_spec]
+        peaks_num = np.array([len(peaks) for peaks in all_peaks], dtype=np.int64)
+        all_peaks = np.concatenate(all_peaks).astype(np.float32)
+        chunk = {
+            # The precursor m/z is kept as float64 to sort the spectra in the same order as FlashEntropySearch.build_index
+            "precursor_mz": np.array([spec["precursor_mz"] for spec in all_spec], dtype=np.float64),
+            "peaks_num": peaks_num,
+            "peaks_mz": all_peaks[:, 0],
+            "peaks_intensity": all_peaks[:, 1],
+            "metadata": OffsetRecords.from_list(all_spec),
+            "abstract_library_spectra": OffsetRecords.from_list([_get_abstract_library_spectrum(spec) for spec in all_spec]),
+        }
+        result[charge] = chunk if path_chunk is None else _save_chunk(chunk, path_chunk / f"charge_{charge}")
+    return result
+
+
+def _save_chunk(chunk, path_data):
+    path_data.mkdir(parents=True)
+    for name, value in chunk.items():
+        if isinstance(value, OffsetRecords):
+            value.save(path_data, name)
+        else:
+            np.save(path_data / f"{name}.npy", value)
+    return path_data
+
+
+def _load_chunk(chunk):
+    """
+    Load a chunk saved by process_library_chunk or save_library_chunk_from_index, a chunk kept in memory is returned as is.
+    The peaks are memory-mapped, so they are only read when they are merged.
+    """
+    if isinstance(chunk, dict):
+        return chunk
+    path_data = Path(chunk)
+    chunk = {
+        "precursor_mz": np.load(path_data / "precursor_mz.npy"),
+        "peaks_num": np.load(path_data / "peaks_num.npy"),
+        "peaks_mz": np.load(path_data / "peaks_mz.npy", mmap_mode="r"),
+        "peaks_intensity": np.load(path_data / "peaks_intensity.npy", mmap_mode="r"),
+        "metadata": OffsetRecords.load(path_data, "metadata"),
+        "abstract_library_spectra": OffsetRecords.load(path_data, "abstract_library_spectra"),
+    }
+    if (path_data / "library_idx.npy").exists():
+        chunk["library_idx"] = np.load(path_data / "library_idx.npy")
+    return chunk
+
+
+def merge_library_chunks(all_chunk, ms2_tolerance_in_da):
+    """
+    Merge the chunks into one FlashEntropySearch object, the spectra are sorted by precursor m/z.
+    Each chunk is the path of a saved chunk or a chunk kept in memory, from process_library_chunk.
+
+    If the chunks have library_idx, which is the stable index of each spectrum, the merged object has a library_idx
+    array with the stable index of each spectrum after sorting. Otherwise the library_idx is None, which means the
+    stable index is the same as the position after sorting.
+    """
+    all_chunk = [_load_chunk(chunk) for chunk in all_chunk]
+    all_precursor_mz = [chunk["precursor_mz"] for chunk in all_chunk]
+    all_peaks_num = [chunk["peaks_num"] for chunk in all_chunk]
+    chunk_spectra_num = np.array([len(x) for x in all_precursor_mz], dtype=np.int64)
+    chunk_spectra_start = np.concatenate([[0], np.cumsum(chunk_spectra_num)])
+    precursor_mz = np.concatenate(all_precursor_mz)
+    total_spectra_num = len(precursor_mz)
+    total_peaks_num = int(sum(np.sum(x) for x in all_peaks_num))
+
+    # order[i] is the position in the library file of the i-th spectrum after sorting, new_spec_idx is the reverse
+    order = np.argsort(precursor_mz, kind="stable")
+    new_spec_idx = np.empty(total_spectra_num, dtype=np.uint32)
+    new_spec_idx[order] = np.arange(total_spectra_num, dtype=np.uint32)
+
+    entropy_search = FlashEntropySearch(max_ms2_tolerance_in_da=ms2_tolerance_in_da)
+    entropy_search.library_idx = None
+    if all("library_idx" in chunk for chunk in all_chunk):
+        entropy_search.library_idx = np.concatenate([chunk["library_idx"] for chunk in all_chunk])[order].astype(np.int64)
+    core = entropy_search.entropy_search
+    core.total_spectra_num = total_spectra_num
+    core.total_peaks_num = total_peaks_num
+
+    # Collect the peaks of all chunks, the same as FlashEntropySearchCore._merge_all_spectra_to_peak_data
+    dtype_peak_data = np.dtype(
+        [("ion_mz", np.float32), ("nl_mass", np.float32), ("intensity", np.float32), ("spec_idx", np.uint32), ("peak_idx", np.uint64)], align=True
+    )
+    peak_data = np.zeros(total_peaks_num, dtype=dtype_peak_data)
+    peak_idx = 0
+    for i, chunk in enumerate(all_chunk):
+        peaks_mz = chunk["peaks_mz"]
+        peak_data_item = peak_data[peak_idx : peak_idx + len(peaks_mz)]
+        peak_data_item["ion_mz"] = peaks_mz
+        peak_data_item["nl_mass"] = np.repeat(all_precursor_mz[i].astype(np.float32), all_peaks_num[i]) - peaks_mz
+        peak_data_item["intensity"] = chunk["peaks_intensity"]
+        peak_data_item["spec_idx"] = np.repeat(new_spec_idx[chunk_spectra_start[i] : chunk_spectra_start[i + 1]], all_peaks_num[i])
+        peak_idx += len(peaks_mz)
+    core.index = core._generate_index_from_peak_data(peak_data, _MAX_INDEXED_MZ, append=False)
+    del peak_data
+    entropy_search.spectrum_peaks_index = build_spectrum_peaks_index(entropy_search)
+
+    # Reorder the metadata and the abstract information
+    entropy_search.precursor_mz_array = precursor_mz[order].astype(np.float32)
+    all_metadata = [chunk["metadata"] for chunk in all_chunk]
+    all_abstract = [chunk["abstract_library_spectra"] for chunk in all_chunk]
+    chunk_id = np.repeat(np.arange(len(all_chunk)), chunk_spectra_num)
+    metadata_len = np.concatenate([np.diff(x.loc).astype(np.uint64) for x in all_metadata])
+    entropy_search.metadata_loc = np.concatenate([[0], np.cumsum(metadata_len[order])]).astype(np.uint64)
+    entropy_search.metadata = np.empty(int(entropy_search.metadata_loc[-1]), dtype=np.uint8)
+    all_abstract_bytes = []
+    for idx, spec_idx in enumerate(order):
+        c = chunk_id[spec_idx]
+        local_idx = spec_idx - chunk_spectra_start[c]
+        metadata = all_metadata[c]
+        entropy_search.metadata[entropy_search.metadata_loc[idx] : entropy_search.metadata_loc[idx + 1]] = metadata.data[
+            metadata.loc[local_idx] : metadata.loc[local_idx + 1]
+        ]
+        spec_abstract = all_abstract[c][local_idx]
+        spec_abstract["library-idx"] = idx if entropy_search.library_idx is None else int(entropy_search.library_idx[idx])
+        all_abstract_bytes.append(pickle.dumps(spec_abstract))
+    abstract_loc = np.cumsum(np.array([0] + [len(x) for x in all_abstract_bytes], dtype=np.uint64)).astype(np.uint64)
+    entropy_search.abstract_library_spectra = OffsetRecords(np.frombuffer(b"".join(all_abstract_bytes), dtype=np.uint8), abstract_loc)
+    return entropy_search
+
+
+def save_library_chunk_from_index(entropy_search, path_chunk):
+    """
+    Save a FlashEntropySearch object built by merge_library_chunks as a chunk, so it can be merged with other chunks.
+    The chunk has library_idx.npy with the stable index of each spectrum.
+    """
+    path_chunk = Path(path_chunk)
+    path_chunk.mkdir(parents=True)
+    spectra_num = len(entropy_search.precursor_mz_array)
+    np.save(path_chunk / "precursor_mz.npy", np.asarray(entropy_search.precursor_mz_array, dtype=np.float64))
+
+    # The peaks grouped by spectrum, the intensity is already weighted
+    idx_start, peaks_mz, peaks_intensity = get_spectrum_peaks_index(entropy_search)
+    np.save(path_chunk / "peaks_num.npy", np.diff(np.asarray(idx_start, dtype=np.int64)))
+    np.save(path_chunk / "peaks_mz.npy", np.asarray(peaks_mz))
+    np.save(path_chunk / "peaks_intensity.npy", np.asarray(peaks_intensity))
+
+    library_records = getattr(entropy_search, "library_records", None)
+    if library_records is None:
+        library_records = OffsetRecords(entropy_search.metadata, entropy_search.metadata_loc)
+    library_records.save(path_chunk, "metadata")
+    entropy_search.abstract_library_spectra.save(path_chunk, "abstract_library_spectra")
+    library_idx = getattr(entropy_search, "library_idx", None)
+    if library_idx is None:
+        library_idx = np.arange(spectra_num, dtype=np.int64)
+    np.save(path_chunk / "library_idx.npy", np.asarray(library_idx, dtype=np.int64))
+    return path_chunk
+
+
+def _get_abstract_library_spectrum(spec):
+    return {
+        "library-id": spec.get("library-id", spec.get("library-scan", "")),
+        "precursor_mz": spec["precursor_mz"],
+        "library-name": spec["library-name"],
+        "library-precursor_type": spec["library-precursor_type"],
+        "library-file_name": spec.get("library-file_name", ""),
+        "library-idx": -1,
+    }
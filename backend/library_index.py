@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+import json
+import os
+import pickle
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from identity_search import SPECTRUM_PEAKS_INDEX_NAMES, search_identity_sparse
+from ms_entropy import FlashEntropySearch
+from sparse_search import search_sparse
+
+# Version of the on-disk index layout, change it when the layout changes.
+INDEX_FORMAT_VERSION = 1
+
+# The number of full library records kept in memory by each segment can be changed with this environment variable.
+ENV_LIBRARY_RECORD_CACHE_SIZE = "ENTROPY_SEARCH_LIBRARY_RECORD_CACHE_SIZE"
+DEFAULT_LIBRARY_RECORD_CACHE_SIZE = 256
+# The name of the files of the full library records in a segment directory
+LIBRARY_RECORDS_NAME = "metadata"
+
+
+class OffsetRecords:
+    """
+    A read-only list of python objects, stored as pickled bytes in one uint8 array with an offset array.
+    The arrays can be memory-mapped, then only the requested records are read from disk.
+    """
+
+    def __init__(self, data, loc) -> None:
+        self.data = data
+        self.loc = loc
+
+    @classmethod
+    def from_list(cls, all_records):
+        all_records_bytes = [pickle.dumps(record) for record in all_records]
+        loc = np.cumsum(np.array([0] + [len(x) for x in all_records_bytes], dtype=np.uint64)).astype(np.uint64)
+        data = np.frombuffer(b"".join(all_records_bytes), dtype=np.uint8)
+        return cls(data, loc)
+
+    def __len__(self):
+        return len(self.loc) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("Record index out of range.")
+        return pickle.loads(self.data[int(self.loc[idx]) : int(self.loc[idx + 1])].tobytes())
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def save(self, path_data, name):
+        np.save(path_data / f"{name}.npy", np.asarray(self.data))
+        np.save(path_data / f"{name}_loc.npy", np.asarray(self.loc))
+
+    @classmethod
+    def load(cls, path_data, name, mmap_mode="r"):
+        return cls(np.load(path_data / f"{name}.npy", mmap_mode=mmap_mode), np.load(path_data / f"{name}_loc.npy", mmap_mode=mmap_mode))
+
+
+class LibraryRecordStore:
+    """
+    The full records of the library spectra in one segment, with the peaks and all "library-*" metadata, stored on
+    disk as OffsetRecords. The files are memory-mapped when the store is created, so the records can still be read
+    after the index is removed from the cache. Each access reads only the requested record, and the recently used
+    records are kept in a small LRU cache.
+
+    Pickling the store only keeps the path, so the records are never copied to other processes.
+    """
+
+    def __init__(self, path_data, name=LIBRARY_RECORDS_NAME, cache_size=None) -> None:
+        if cache_size is None:
+            cache_size = int(os.environ.get(ENV_LIBRARY_RECORD_CACHE_SIZE, DEFAULT_LIBRARY_RECORD_CACHE_SIZE))
+        self.path_data = Path(path_data)
+        self.name = name
+        self.cache_size = cache_size
+        self._records = OffsetRecords.load(self.path_data, self.name, mmap_mode="r")
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"path_data": self.path_data, "name": self.name, "cache_size": self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        with self._lock:
+            record = self._cache.get(idx)
+            if record is not None:
+                self._cache.move_to_end(idx)
+                return dict(record)
+
+        record = self._records[idx]
+        if self.cache_size > 0:
+            with self._lock:
+                self._cache[idx] = record
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return dict(record)
+
+    def save(self, path_data, name=LIBRARY_RECORDS_NAME):
+        self._records.save(Path(path_data), name)
+
+
+class LibrarySegment(FlashEntropySearch):
+    """
+    A FlashEntropySearch object read from disk, it only keeps the arrays used for searching in memory. The full
+    library records are read from library_records, a LibraryRecordStore, when a spectrum is requested.
+    """
+
+    def __init__(self, library_records, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.library_records = library_records
+
+    def __getitem__(self, index):
+        return self.library_records[index]
+
+
+def is_spectral_library_index(path_index):
+    return (Path(path_index) / "information.json").is_file()
+
+
+def write_spectral_library(path_index, spectral_library, information=None):
+    """
+    Write the spectral library to a directory, the directory will look like:
+        information.json
+        charge_0/
+            information.json
+            precursor_mz_array.npy
+            metadata.npy, metadata_loc.npy
+            abstract_library_spectra.npy, abstract_library_spectra_loc.npy
+            all_ions_mz_idx_start.npy, all_ions_mz.npy, ...
+
+    After spectra are appended or deleted with library_update, the information.json has a "segments" entry which
+    points to the current main segment, delta segment and deleted mask of each charge.
+
+    :param path_index: The path of the index directory.
+    :param spectral_library: A dict of {charge: FlashEntropySearch}.
+    :param information: Other information to save in the header.
+    """
+    path_index = Path(path_index)
+    # Write to a temporary directory first, so an interrupted writing will not leave a broken index.
+    path_index_tmp = path_index.parent / f"{path_index.name}.{os.getpid()}.tmp"
+    if path_index_tmp.exists():
+        shutil.rmtree(path_index_tmp)
+    path_index_tmp.mkdir(parents=True)
+
+    for charge, entropy_search in spectral_library.items():
+        write_library_segment(path_index_tmp / f"charge_{charge}", entropy_search)
+
+    information = dict(information or {})
+    information.update({"index_format_version": INDEX_FORMAT_VERSION, "charges": [int(c) for c in spectral_library.keys()]})
+    with open(path_index_tmp / "information.json", "w") as f:
+        json.dump(information, f)
+
+    if path_index.exists():
+        if path_index.is_dir():
+            shutil.rmtree(path_index)
+        else:
+            path_index.unlink()
+    try:
+        path_index_tmp.rename(path_index)
+    except OSError:
+        # Another process has written the same index at the same time
+        shutil.rmtree(path_index_tmp, ignore_errors=True)
+        if not is_spectral_library_index(path_index):
+            raise
+
+
+def write_library_segment(path_data, entropy_search):
+    """
+    Write one FlashEntropySearch object to path_data. If the object has a library_idx array, which is the stable
+    index of each spectrum, it is saved as library_idx.npy. The spectrum peaks index for the identity search is saved
+    if it is built.
+    """
+    path_data = Path(path_data)
+    path_data.mkdir(parents=True)
+    core = entropy_search.entropy_search
+    np.save(path_data / "precursor_mz_array.npy", np.asarray(entropy_search.precursor_mz_array))
+    library_records = getattr(entropy_search, "library_records", None)
+    if library_records is None:
+        library_records = OffsetRecords(entropy_search.metadata, entropy_search.metadata_loc)
+    library_records.save(path_data, LIBRARY_RECORDS_NAME)
+    for name, array in zip(core.index_names, core.index):
+        np.save(path_data / f"{name}.npy", np.asarray(array))
+    abstract_library_spectra = entropy_search.abstract_library_spectra
+    if not isinstance(abstract_library_spectra, OffsetRecords):
+        abstract_library_spectra = OffsetRecords.from_list(abstract_library_spectra)
+    abstract_library_spectra.save(path_data, "abstract_library_spectra")
+    library_idx = getattr(entropy_search, "library_idx", None)
+    if library_idx is not None:
+        np.save(path_data / "library_idx.npy", np.asarray(library_idx, dtype=np.int64))
+    spectrum_peaks_index = getattr(entropy_search, "spectrum_peaks_index", None)
+    if spectrum_peaks_index is not None:
+        for name, array in zip(SPECTRUM_PEAKS_INDEX_NAMES, spectrum_peaks_index):
+            np.save(path_data / f"{name}.npy", np.asarray(array))
+
+    with open(path_data / "information.json", "w") as f:
+        json.dump(
+            {
+                "mz_index_step": float(core.mz_index_step),
+                "total_spectra_num": int(core.total_spectra_num),
+                "total_peaks_num": int(core.total_peaks_num),
+                "max_ms2_tolerance_in_da": float(core.max_ms2_tolerance_in_da),
+                "intensity_weight": core.intensity_weight,
+                "index_names": list(core.index_names),
+            },
+            f,
+        )
+
+
+def get_resident_size(path_index):
+    """
+    Get the size of the files of an index which are used for searching, without the full library records which are
+    read on demand.
+    """
+    path_index = Path(path_index)
+    if path_index.is_file():
+        return path_index.stat().st_size
+    all_records_file = {f"{LIBRARY_RECORDS_NAME}.npy", f"{LIBRARY_RECORDS_NAME}_loc.npy"}
+    return sum(f.stat().st_size for f in path_index.rglob("*") if f.is_file() and f.name not in all_records_file)
+
+
+def read_index_information(path_index):
+    path_index = Path(path_index)
+    with open(path_index / "information.json", "r") as f:
+        information = json.load(f)
+    if information.get("index_format_version") != INDEX_FORMAT_VERSION:
+        raise ValueError(f"Unsupported index format: {path_index}")
+    return information
+
+
+def get_library_segments(information, charge):
+    """
+    Get the names of the main segment, the delta segment and the deleted mask of one charge, the latter two can be None.
+    """
+    segments = information.get("segments", {}).get(str(charge), {})
+    return segments.get("main", f"charge_{charge}"), segments.get("delta"), segments.get("deleted")
+
+
+def read_spectral_library(path_index, mmap_mode="r"):
+    """
+    Read the spectral library written by write_spectral_library. All the arrays are memory-mapped,
+    so the loading is fast, and processes reading the same index share the memory in page cache.
+
+    :return: A dict of {charge: FlashEntropySearch}, or {charge: IncrementalLibrary} for the charges with
+             appended or deleted spectra.
+    """
+    path_index = Path(path_index)
+    information = read_index_information(path_index)
+
+    spectral_library = {}
+    for charge in information["charges"]:
+        name_main, name_delta, name_deleted = get_library_segments(information, charge)
+        main = read_library_segment(path_index / name_main, mmap_mode=mmap_mode)
+        delta = read_library_segment(path_index / name_delta, mmap_mode=mmap_mode) if name_delta else None
+        deleted = np.load(path_index / name_deleted, mmap_mode=mmap_mode) if name_deleted else None
+        if delta is None and deleted is None and main.library_idx is None:
+            spectral_library[charge] = main
+        else:
+            spectral_library[charge] = IncrementalLibrary(main, delta, deleted)
+    return spectral_library
+
+
+def read_library_segment(path_data, mmap_mode="r"):
+    path_data = Path(path_data)
+    with open(path_data / "information.json", "r") as f:
+        information = json.load(f)
+
+    entropy_search = LibrarySegment(
+        LibraryRecordStore(path_data),
+        max_ms2_tolerance_in_da=information["max_ms2_tolerance_in_da"],
+        mz_index_step=information["mz_index_step"],
+        intensity_weight=information["intensity_weight"],
+    )
+    entropy_search.precursor_mz_array = np.load(path_data / "precursor_mz_array.npy", mmap_mode=mmap_mode)
+    entropy_search.abstract_library_spectra = OffsetRecords.load(path_data, "abstract_library_spectra", mmap_mode=mmap_mode)
+    entropy_search.library_idx = None
+    if (path_data / "library_idx.npy").exists():
+        entropy_search.library_idx = np.load(path_data / "library_idx.npy")
+    # The indexes written before the spectrum peaks index existed build it when it is first used
+    entropy_search.spectrum_peaks_index = None
+    if all((path_data / f"{name}.npy").exists() for name in SPECTRUM_PEAKS_INDEX_NAMES):
+        entropy_search.spectrum_peaks_index = [np.load(path_data / f"{name}.npy", mmap_mode=mmap_mode) for name in SPECTRUM_PEAKS_INDEX_NAMES]
+
+    core = entropy_search.entropy_search
+    if list(core.index_names) != information["index_names"]:
+        raise ValueError(f"The index {path_data} is built by an incompatible version of ms_entropy.")
+    core.index = [np.load(path_data / f"{name}.npy", mmap_mode=mmap_mode) for name in core.index_names]
+    core.total_spectra_num = information["total_spectra_num"]
+    core.total_peaks_num = information["total_peaks_num"]
+    # The memory-mapped arrays are already shared between processes, no need to copy them to shared memory.
+    core._init_for_multiprocessing = mmap_mode is not None
+    return entropy_search
+
+
+class IncrementalLibrary:
+    """
+    A spectral library of one charge made of a main segment, a delta segment with the appended spectra, and a mask of
+    deleted spectra. It has the same interface as FlashEntropySearch used by EntropySearch, but all spectra are
+    addressed by their stable library index, which does not change when spectra are appended, deleted, or when the
+    delta segment is merged into the main segment.
+
+    Deleted spectra are kept in the segments, so results reported before the deletion can still be displayed,
+    but they are never returned by search.
+    """
+
+    def __init__(self, main, delta=None, deleted=None) -> None:
+        self.main = main
+        self.delta = delta
+        self.all_segments = [x for x in (main, delta) if x is not None]
+        self.all_segment_library_idx = [_get_segment_library_idx(x) for x in self.all_segments]
+        total_spectra_num = max(int(x.max()) + 1 if len(x) > 0 else 0 for x in self.all_segment_library_idx)
+        if deleted is not None:
+            total_spectra_num = max(total_spectra_num, len(deleted))
+        self.total_spectra_num = total_spectra_num
+
+        # The segment and the position in the segment of each spectrum
+        self.segment_of_spectrum = np.full(total_spectra_num, -1, dtype=np.int8)
+        self.position_of_spectrum = np.zeros(total_spectra_num, dtype=np.int64)
+        self.precursor_mz_array = np.zeros(total_spectra_num, dtype=np.float32)
+        for segment_idx, (segment, library_idx) in enumerate(zip(self.all_segments, self.all_segment_library_idx)):
+            self.segment_of_spectrum[library_idx] = segment_idx
+            self.position_of_spectrum[library_idx] = np.arange(len(library_idx))
+            self.precursor_mz_array[library_idx] = segment.precursor_mz_array
+        self.deleted = np.zeros(total_spectra_num, dtype=bool)
+        if deleted is not None:
+            self.deleted[: len(deleted)] = deleted
+        self.deleted |= self.segment_of_spectrum < 0
+        self.abstract_library_spectra = _StableIndexRecords(self, "abstract_library_spectra")
+
+    def __len__(self):
+        return self.total_spectra_num
+
+    def __getitem__(self, library_idx):
+        segment, position = self._locate(library_idx)
+        return segment[position]
+
+    def search(self, **kwargs):
+        """
+        Search all segments with FlashEntropySearch.search, the scores are indexed by the stable library index.
+        """
+        result = {}
+        for segment, library_idx in zip(self.all_segments, self.all_segment_library_idx):
+            if len(library_idx) == 0:
+                continue
+            segment_result = segment.search(**kwargs)
+            for search_type, score in segment_result.items():
+                if search_type not in result:
+                    result[search_type] = np.zeros(self.total_spectra_num, dtype=np.float32)
+                result[search_type][library_idx] = score
+        for score in result.values():
+            score[self.deleted] = 0
+        return result
+
+    def search_identity_sparse(self, precursor_mz, peaks, ms1_tolerance_in_da, ms2_tolerance_in_da):
+        """
+        Identity search in the MS1 tolerance window of all segments, the library index is the stable library index.
+        """
+        return self._merge_segment_results(
+            [search_identity_sparse(segment, precursor_mz, peaks, ms1_tolerance_in_da, ms2_tolerance_in_da) for segment in self.all_segments]
+        )
+
+    def search_sparse(self, precursor_mz, peaks, ms2_tolerance_in_da, all_search_type):
+        """
+        Search all segments with sparse_search.search_sparse, the library index is the stable library index.
+        """
+        all_segment_result = [search_sparse(segment, precursor_mz, peaks, ms2_tolerance_in_da, all_search_type) for segment in self.all_segments]
+        return {search_type: self._merge_segment_results([x[search_type] for x in all_segment_result]) for search_type in all_search_type}
+
+    def _merge_segment_results(self, all_segment_result):
+        """
+        Convert the (index in segment, score) pairs of all segments to the stable library index, without the deleted spectra.
+        """
+        all_library_idx, all_score = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float32)]
+        for (idx, score), segment_library_idx in zip(all_segment_result, self.all_segment_library_idx):
+            library_idx = segment_library_idx[idx]
+            selected = ~self.deleted[library_idx]
+            all_library_idx.append(library_idx[selected])
+            all_score.append(score[selected])
+        return np.concatenate(all_library_idx), np.concatenate(all_score)
+
+    def save_memory_for_multiprocessing(self):
+        for segment in self.all_segments:
+            segment.save_memory_for_multiprocessing()
+
+    def _locate(self, library_idx):
+        library_idx = int(library_idx)
+        if library_idx < 0:
+            library_idx += self.total_spectra_num
+        if library_idx < 0 or library_idx >= self.total_spectra_num or self.segment_of_spectrum[library_idx] < 0:
+            raise IndexError("Library spectrum index out of range.")
+        return self.all_segments[self.segment_of_spectrum[library_idx]], int(self.position_of_spectrum[library_idx])
+
+
+class _StableIndexRecords:
+    def __init__(self, library, name) -> None:
+        self.library = library
+        self.name = name
+
+    def __len__(self):
+        return len(self.library)
+
+    def __getitem__(self, library_idx):
+        segment, position = self.library._locate(library_idx)
+        return getattr(segment, self.name)[position]
+
+
+def _get_segment_library_idx(entropy_search):
+    library_idx = getattr(entropy_search, "library_idx", None)
+    if library_idx is None:
+        return np.arange(len(entropy_search.precursor_mz_array), dtype=np.int64)
+    return np.asarray(library_idx, dtype=np.int64)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import os
+
+import numpy as np
+from library_index import read_index_information, read_spectral_library
+from sharded_library import ShardedLibrary, read_sharded_spectral_library
+
+# How the library index is partitioned by the precursor charge, can be changed with this environment variable:
+#   none: all spectra are in one partition, the charge of the spectra is not used
+#   polarity: one partition for the positive and one for the negative spectra
+#   charge: one partition for each precursor charge
+# The spectra with unknown charge are in partition 0, which is searched by all query spectra.
+ENV_CHARGE_PARTITION = "ENTROPY_SEARCH_CHARGE_PARTITION"
+DEFAULT_CHARGE_PARTITION = "polarity"
+CHARGE_PARTITIONS = ["none", "polarity", "charge"]
+# The library index of each partition is in a range of this size, see get_partition_offset
+PARTITION_SIZE = 2**26
+MAX_PARTITION_CHARGE = 31
+
+
+def get_default_charge_partition():
+    charge_partition = os.environ.get(ENV_CHARGE_PARTITION, DEFAULT_CHARGE_PARTITION)
+    check_charge_partition(charge_partition)
+    return charge_partition
+
+
+def check_charge_partition(charge_partition):
+    if charge_partition not in CHARGE_PARTITIONS:
+        raise ValueError(f"Unknown charge partition: {charge_partition}, it should be one of {CHARGE_PARTITIONS}.")
+
+
+def get_partition_charge(charge, charge_partition):
+    """
+    Get the partition of a spectrum with the precursor charge, 0 means the charge is unknown.
+    The partition of a partition is itself, so a spectrum can be assigned again. A charge larger than
+    MAX_PARTITION_CHARGE has no partition of its own, it is treated as unknown.
+    """
+    charge = int(charge)
+    if charge_partition == "none" or abs(charge) > MAX_PARTITION_CHARGE:
+        return 0
+    if charge_partition == "polarity":
+        return (charge > 0) - (charge < 0)
+    return charge
+
+
+def get_partition_offset(charge):
+    """
+    The first library index of a partition. Each partition has a fixed range of PARTITION_SIZE library indexes:
+    partition 0 first, then 1, -1, 2, -2 and so on, so the library index of a spectrum does not change when other
+    partitions grow, and it fits in the uint32 library index of the result store.
+    """
+    slot = 2 * charge - 1 if charge > 0 else -2 * charge
+    return slot * PARTITION_SIZE
+
+
+class PartitionedLibrary(dict):
+    """
+    The libraries searched by the query spectra of each partition, as a dict of {charge: library}.
+
+    A query spectrum with a known charge searches the partition of its charge and partition 0, a query spectrum
+    with unknown charge searches all partitions. The library index of a spectrum is the offset of its partition plus
+    its index in the partition, the same for the query spectra of all charges. The library of a charge which is not
+    in the index is created the first time it is used.
+    """
+
+    def __init__(self, all_partition, charge_partition) -> None:
+        super().__init__()
+        self.all_partition = dict(all_partition)
+        self.charge_partition = charge_partition
+        if charge_partition != "none":
+            for charge, partition in self.all_partition.items():
+                if len(partition.precursor_mz_array) > PARTITION_SIZE:
+                    raise ValueError(f"Partition {charge} has more than {PARTITION_SIZE} spectra, please index the library with charge partition none.")
+        for charge in self.all_partition:
+            self[charge]
+
+    def __missing__(self, charge):
+        all_charge = [charge] if charge in self.all_partition else []
+        if charge == 0:
+            all_charge += sorted(x for x in self.all_partition if x != 0)
+        elif 0 in self.all_partition:
+            all_charge.append(0)
+
+        # Partition 0 starts at library index 0, so it is used as it is
+        if all_charge == [0]:
+            library = self.all_partition[0]
+        else:
+            library = PartitionView(all_charge, [self.all_partition[x] for x in all_charge])
+        self[charge] = library
+        return library
+
+    def locate(self, library_idx):
+        """
+        Get the partition and the library index in the partition of a library index.
+        """
+        library_idx = int(library_idx)
+        if self.charge_partition == "none":
+            return 0, library_idx
+        slot = library_idx // PARTITION_SIZE
+        charge = (slot + 1) // 2 if slot % 2 == 1 else -(slot // 2)
+        return charge, library_idx - get_partition_offset(charge)
+
+    def get_library_idx(self, charge, all_idx):
+        """
+        Convert the index of spectra in the partition of charge to the library index.
+        """
+        if self.charge_partition == "none":
+            return [int(x) for x in all_idx]
+        return [get_partition_offset(charge) + int(x) for x in all_idx]
+
+
+class PartitionView(ShardedLibrary):
+    """
+    Several partitions searched together, each partition is a shard whose global library index starts at the offset
+    of the partition. The library spectra keep the library-file_name set when the library was built.
+    """
+
+    def __init__(self, all_charge, all_partition) -> None:
+        super().__init__([None] * len(all_partition), all_partition)
+        self.all_charge = list(all_charge)
+        self.shard_offset = np.array([get_partition_offset(x) for x in self.all_charge], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.precursor_mz_array)
+
+    def search(self, **kwargs):
+        raise NotImplementedError("The library index of partitions is not contiguous, use search_identity_sparse or search_sparse.")
+
+    def locate(self, library_idx):
+        library_idx = int(library_idx)
+        for partition_idx, (offset, partition) in enumerate(zip(self.shard_offset, self.all_shard)):
+            if offset <= library_idx < offset + len(partition.precursor_mz_array):
+                return partition_idx, library_idx - int(offset)
+        raise IndexError("Library spectrum index out of range.")
+
+
+def get_library_charge_partition(spectral_library):
+    """
+    The charge partition of a loaded library, the libraries read from the index of the old version are not partitioned.
+    """
+    return getattr(spectral_library, "charge_partition", "none")
+
+
+def read_partitioned_library(path_index):
+    """
+    Read a library index, or the indexes of all shards if path_index is a list.
+
+    :return: A PartitionedLibrary of the partitions of the index.
+    """
+    if isinstance(path_index, list):
+        return PartitionedLibrary(read_sharded_spectral_library(path_index), read_charge_partition(path_index))
+    return PartitionedLibrary(read_spectral_library(path_index), read_charge_partition([path_index]))
+
+
+def read_charge_partition(all_path_index):
+    """
+    Read the charge partition of the library indexes, all of them should be partitioned in the same way.
+    """
+    all_charge_partition = {read_index_information(path_index).get("charge_partition", "none") for path_index in all_path_index}
+    if len(all_charge_partition) > 1:
+        raise ValueError(f"The library indexes are partitioned by charge in different ways: {sorted(all_charge_partition)}, please index them again.")
+    return all_charge_partition.pop()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+import os
+import threading
+import time
+from pathlib import Path
+
+from entropy_search import EntropySearch
+from index_cache import touch_index
+from library_index import get_resident_size, read_index_information
+from library_partition import read_partitioned_library
+
+# The memory budget for all loaded libraries can be changed with this environment variable.
+ENV_LIBRARY_MEMORY_IN_GB = "ENTROPY_SEARCH_LIBRARY_MEMORY_IN_GB"
+DEFAULT_LIBRARY_MEMORY_IN_GB = 32
+
+
+class LibraryRegistry:
+    """
+    Keep loaded spectral libraries in memory, so different searches against the same library only load it once.
+
+    Each library is identified by its index key, which is calculated from the content of the library file and
+    the MS2 tolerance. When the total size of loaded libraries exceeds max_memory_in_bytes, the least recently
+    used libraries are unloaded. Searches that are still running keep their own reference to the library.
+
+    A library is loaded or updated while holding its own build_lock, so only the callers of the same library wait
+    for it, and a loaded library is returned without waiting for the other libraries.
+    """
+
+    def __init__(self, max_memory_in_bytes=None) -> None:
+        if max_memory_in_bytes is None:
+            max_memory_in_bytes = float(os.environ.get(ENV_LIBRARY_MEMORY_IN_GB, DEFAULT_LIBRARY_MEMORY_IN_GB)) * 1024**3
+        self.max_memory_in_bytes = max_memory_in_bytes
+        self.all_libraries = {}
+        self._lock = threading.Lock()
+
+    def get_library_id(self, file_library, ms2_tolerance_in_da):
+        return EntropySearch(ms2_tolerance_in_da).get_index_key(file_library)
+
+    def load(self, file_library, ms2_tolerance_in_da, entropy_search=None, library_id=None, cores=1):
+        """
+        Load the library if it is not loaded, and return its id.
+
+        :param entropy_search: The EntropySearch object used to load the library, its status shows the loading progress.
+        :param cores: The number of processes used to build the index if the library is not indexed.
+        """
+        if entropy_search is None:
+            entropy_search = EntropySearch(ms2_tolerance_in_da)
+        if library_id is None:
+            library_id = entropy_search.get_index_key(file_library)
+
+        with self._lock:
+            library = self.all_libraries.get(library_id)
+            if library is not None and library["status"] == "ready":
+                library["last_used"] = time.time()
+                return library_id
+        library = self.add_loading(file_library, ms2_tolerance_in_da, library_id)
+
+        with library["build_lock"]:
+            # Loaded by another caller while waiting for the lock
+            with self._lock:
+                if library["status"] == "ready":
+                    library["last_used"] = time.time()
+                    return library_id
+                if library["status"] == "error":
+                    raise ValueError(f"Library {library_id} failed to load: {library['message']}")
+
+            try:
+                entropy_search.load_spectral_library(file_library, cores=cores)
+                if entropy_search.path_index is not None:
+                    size = _get_size(entropy_search.path_index)
+                elif isinstance(file_library, (list, tuple)):
+                    size = sum(Path(x).stat().st_size for x in file_library)
+                else:
+                    size = Path(file_library).stat().st_size
+            except Exception as e:
+                with self._lock:
+                    library.update({"status": "error", "message": f"Error: {e}"})
+                library["loaded_event"].set()
+                raise
+
+            with self._lock:
+                # The library may be unloaded while loading
+                self.all_libraries[library_id] = library
+                library.update(
+                    {
+                        "status": "ready",
+                        "spectral_library": entropy_search.spectral_library,
+                        "path_index": entropy_search.path_index,
+                        "generation": _get_generation(entropy_search.path_index),
+                        "size": size,
+                        "last_used": time.time(),
+                    }
+                )
+                self._evict(keep=library_id)
+            library["loaded_event"].set()
+        return library_id
+
+    def add_loading(self, file_library, ms2_tolerance_in_da, library_id):
+        """
+        Mark the library as loading before it is loaded in the background, so the searches submitted with its id
+        wait for it in get instead of failing. A library which is loading or ready is not changed.
+
+        :return: The entry of the library.
+        """
+        with self._lock:
+            library = self.all_libraries.get(library_id)
+            if library is None or library["status"] == "error":
+                library = self.all_libraries[library_id] = {
+                    "library_id": library_id,
+                    "file_library": str(file_library),
+                    "ms2_tolerance_in_da": ms2_tolerance_in_da,
+                    "status": "loading",
+                    "message": "",
+                    "size": 0,
+                    "last_used": time.time(),
+                    "loaded_event": threading.Event(),
+                    "build_lock": threading.Lock(),
+                }
+            return library
+
+    def append(self, library_id, file_library):
+        """
+        Append the spectra in file_library to a loaded library. The first update of a library copies its index,
+        the copy is loaded with a new id, and the library with the old id still matches its library file.
+
+        :return: The id of the updated library, and a dict of {charge: list of the library index of the appended spectra}.
+        """
+        library = self.get(library_id)
+        with library["build_lock"]:
+            entropy_search = self._get_entropy_search(library_id)
+            all_library_idx = entropy_search.append_library_spectra(file_library)
+            library_id = self._update(library_id, entropy_search)
+        return library_id, all_library_idx
+
+    def delete(self, library_id, all_library_idx):
+        """
+        Mark the spectra of a loaded library as deleted, the library is copied as in append.
+
+        :return: The id of the updated library.
+        """
+        library = self.get(library_id)
+        with library["build_lock"]:
+            entropy_search = self._get_entropy_search(library_id)
+            entropy_search.delete_library_spectra(all_library_idx)
+            return self._update(library_id, entropy_search)
+
+    def get(self, library_id, timeout=None):
+        """
+        Get the loaded library, return a dict with keys "spectral_library", "path_index" and "ms2_tolerance_in_da".
+        If the library is still loading, wait until it is loaded, at most timeout seconds.
+        """
+        with self._lock:
+            library = self.all_libraries.get(library_id)
+        if library is not None and library["status"] == "loading":
+            library["loaded_event"].wait(timeout)
+
+        with self._lock:
+            library = self.all_libraries.get(library_id)
+            if library is None:
+                raise KeyError(f"Library {library_id} is not loaded.")
+            if library["status"] == "error":
+                raise ValueError(f"Library {library_id} failed to load: {library['message']}")
+            if library["status"] != "ready":
+                raise TimeoutError(f"Library {library_id} is still loading.")
+            library["last_used"] = time.time()
+            if library["path_index"] is not None:
+                touch_index(library["path_index"])
+            # The delta segment may be merged into the main segment in the background
+            if library["path_index"] is not None and _get_generation(library["path_index"]) != library["generation"]:
+                library["generation"] = _get_generation(library["path_index"])
+                library["spectral_library"] = read_partitioned_library(library["path_index"])
+            return library
+
+    def unload(self, library_id):
+        with self._lock:
+            return self.all_libraries.pop(library_id, None) is not None
+
+    def list_libraries(self):
+        with self._lock:
+            return [
+                {k: v for k, v in library.items() if k not in {"spectral_library", "path_index", "loaded_event", "build_lock"}} for library in self.all_libraries.values()
+            ]
+
+    def _get_entropy_search(self, library_id):
+        library = self.get(library_id)
+        entropy_search = EntropySearch(library["ms2_tolerance_in_da"])
+        entropy_search.set_spectral_library(library["spectral_library"], library["path_index"])
+        return entropy_search
+
+    def _update(self, library_id, entropy_search):
+        """
+        Keep the updated library, a copy of the index is added with its own id.
+
+        :return: The id of the updated library.
+        """
+        with self._lock:
+            library = self.all_libraries.get(library_id)
+            if library is None:
+                return library_id
+            if library["path_index"] != entropy_search.path_index:
+                library_id = entropy_search.get_index_key(entropy_search.path_index)
+                library = self.all_libraries[library_id] = {
+                    **library,
+                    "library_id": library_id,
+                    "file_library": str(entropy_search.path_index),
+                    "path_index": entropy_search.path_index,
+                    "build_lock": threading.Lock(),
+                }
+            library.update(
+                {
+                    "spectral_library": entropy_search.spectral_library,
+                    "generation": _get_generation(entropy_search.path_index),
+                    "size": _get_size(entropy_search.path_index),
+                    "last_used": time.time(),
+                }
+            )
+            self._evict(keep=library_id)
+        return library_id
+
+    def _evict(self, keep):
+        all_libraries = sorted((x for x in self.all_libraries.values() if x["status"] == "ready"), key=lambda x: x["last_used"])
+        total_size = sum(x["size"] for x in all_libraries)
+        for library in all_libraries:
+            if total_size <= self.max_memory_in_bytes:
+                break
+            if library["library_id"] == keep:
+                continue
+            self.all_libraries.pop(library["library_id"])
+            total_size -= library["size"]
+
+
+def _get_size(path_index):
+    if isinstance(path_index, list):
+        return sum(get_resident_size(x) for x in path_index)
+    return get_resident_size(path_index)
+
+
+def _get_generation(path_index):
+    if path_index is None:
+        return 0
+    if isinstance(path_index, list):
+        return [_get_generation(x) for x in path_index]
+    try:
+        return read_index_information(path_index).get("generation", 0)
+    except (OSError, ValueError):
+        return 0
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+from library_builder import merge_library_chunks, process_library_chunk, save_library_chunk_from_index
+from library_index import get_library_segments, read_index_information, read_library_segment, read_spectral_library, write_library_segment
+from ms_entropy import read_one_spectrum
+
+# The delta segment is merged into the main segment when it has more spectra than this
+MAX_DELTA_SPECTRA_NUM = 10000
+
+# Only one update of the same index runs at the same time
+_all_index_lock = {}
+_all_index_lock_lock = threading.Lock()
+
+
+def append_library_spectra(path_index, file_library, parse_library_spectrum):
+    """
+    Append the spectra in file_library to the index. The new spectra are indexed together with the current delta
+    segment of the same charge into a new delta segment, the main segment is not changed.
+
+    :param parse_library_spectrum: The same function used by build_spectral_library_index.
+    :return: A dict of {charge: array of the library index of the appended spectra}, in the same order as in file_library.
+    """
+    path_index = Path(path_index)
+    with _get_index_lock(path_index):
+        information = read_index_information(path_index)
+        generation = information.get("generation", 0) + 1
+        ms2_tolerance_in_da = _read_max_ms2_tolerance_in_da(path_index, information)
+        all_old_segments = []
+        all_new_library_idx = {}
+
+        path_tmp = Path(tempfile.mkdtemp(prefix=path_index.name + ".", suffix=".append", dir=path_index.parent))
+        try:
+            chunk = process_library_chunk(list(read_one_spectrum(file_library)), path_tmp / "new", ms2_tolerance_in_da, parse_library_spectrum)
+            for charge, path_chunk in chunk.items():
+                new_spectra_num = len(np.load(path_chunk / "precursor_mz.npy"))
+                if charge not in information["charges"]:
+                    # A new charge, the spectra are written as the main segment
+                    total_spectra_num = 0
+                    name_delta = None
+                else:
+                    total_spectra_num = len(read_spectral_library(path_index)[charge].precursor_mz_array)
+                    name_delta = get_library_segments(information, charge)[1]
+                new_library_idx = np.arange(total_spectra_num, total_spectra_num + new_spectra_num, dtype=np.int64)
+                np.save(path_chunk / "library_idx.npy", new_library_idx)
+                all_new_library_idx[charge] = new_library_idx
+
+                all_path_chunk = [path_chunk]
+                if name_delta is not None:
+                    delta = read_library_segment(path_index / name_delta)
+                    all_path_chunk.insert(0, save_library_chunk_from_index(delta, path_tmp / "delta"))
+                    all_old_segments.append(name_delta)
+                entropy_search = merge_library_chunks(all_path_chunk, ms2_tolerance_in_da)
+
+                segments = information.setdefault("segments", {}).setdefault(str(charge), {})
+                if charge not in information["charges"]:
+                    name_main = f"charge_{charge}.main.{generation}"
+                    write_library_segment(path_index / name_main, entropy_search)
+                    segments["main"] = name_main
+                    information["charges"].append(int(charge))
+                else:
+                    name_delta = f"charge_{charge}.delta.{generation}"
+                    write_library_segment(path_index / name_delta, entropy_search)
+                    segments["delta"] = name_delta
+                shutil.rmtree(path_tmp / "delta", ignore_errors=True)
+        finally:
+            shutil.rmtree(path_tmp, ignore_errors=True)
+
+        if all_new_library_idx:
+            _write_index_information(path_index, information, generation)
+            _remove_segments(path_index, all_old_segments)
+        return all_new_library_idx
+
+
+def delete_library_spectra(path_index, charge, all_library_idx):
+    """
+    Mark the spectra as deleted. They are not returned by search anymore, but their library index is not reused and
+    they can still be read by the library index.
+    """
+    path_index = Path(path_index)
+    with _get_index_lock(path_index):
+        information = read_index_information(path_index)
+        if charge not in information["charges"]:
+            raise KeyError(f"No library spectrum with charge {charge}.")
+        generation = information.get("generation", 0) + 1
+        total_spectra_num = len(read_spectral_library(path_index)[charge].precursor_mz_array)
+        all_library_idx = np.asarray(all_library_idx, dtype=np.int64)
+        if np.any(all_library_idx < 0) or np.any(all_library_idx >= total_spectra_num):
+            raise IndexError("Library spectrum index out of range.")
+
+        name_deleted_old = get_library_segments(information, charge)[2]
+        deleted = np.zeros(total_spectra_num, dtype=bool)
+        if name_deleted_old is not None:
+            deleted_old = np.load(path_index / name_deleted_old)
+            deleted[: len(deleted_old)] = deleted_old
+        deleted[all_library_idx] = True
+
+        name_deleted = f"charge_{charge}.deleted.{generation}.npy"
+        np.save(path_index / name_deleted, deleted)
+        information.setdefault("segments", {}).setdefault(str(charge), {})["deleted"] = name_deleted
+        _write_index_information(path_index, information, generation)
+        _remove_segments(path_index, [name_deleted_old])
+
+
+def merge_library_delta(path_index, min_delta_spectra_num=0):
+    """
+    Merge the delta segment into the main segment for all charges whose delta segment has at least
+    min_delta_spectra_num spectra. The library index of all spectra is kept.
+
+    :return: True if any delta segment is merged.
+    """
+    path_index = Path(path_index)
+    with _get_index_lock(path_index):
+        information = read_index_information(path_index)
+        generation = information.get("generation", 0) + 1
+        ms2_tolerance_in_da = _read_max_ms2_tolerance_in_da(path_index, information)
+        all_old_segments = []
+        for charge in information["charges"]:
+            name_main, name_delta, _ = get_library_segments(information, charge)
+            if name_delta is None:
+                continue
+            delta = read_library_segment(path_index / name_delta)
+            if len(delta.precursor_mz_array) < min_delta_spectra_num:
+                continue
+
+            main = read_library_segment(path_index / name_main)
+            path_tmp = Path(tempfile.mkdtemp(prefix=path_index.name + ".", suffix=".merge", dir=path_index.parent))
+            try:
+                all_path_chunk = [save_library_chunk_from_index(main, path_tmp / "main"), save_library_chunk_from_index(delta, path_tmp / "delta")]
+                del main, delta
+                entropy_search = merge_library_chunks(all_path_chunk, ms2_tolerance_in_da)
+                name_main_new = f"charge_{charge}.main.{generation}"
+                write_library_segment(path_index / name_main_new, entropy_search)
+            finally:
+                shutil.rmtree(path_tmp, ignore_errors=True)
+
+            segments = information.setdefault("segments", {}).setdefault(str(charge), {})
+            segments["main"] = name_main_new
+            segments["delta"] = None
+            all_old_segments += [name_main, name_delta]
+
+        if not all_old_segments:
+            return False
+        _write_index_information(path_index, information, generation)
+        _remove_segments(path_index, all_old_segments)
+        return True
+
+
+def get_delta_spectra_num(path_index):
+    """
+    Get the largest number of spectra in the delta segments of the index.
+    """
+    path_index = Path(path_index)
+    information = read_index_information(path_index)
+    delta_spectra_num = 0
+    for charge in information["charges"]:
+        name_delta = get_library_segments(information, charge)[1]
+        if name_delta is not None:
+            with open(path_index / name_delta / "information.json", "r") as f:
+                delta_spectra_num = max(delta_spectra_num, json.load(f)["total_spectra_num"])
+    return delta_spectra_num
+
+
+def _read_max_ms2_tolerance_in_da(path_index, information):
+    name_main = get_library_segments(information, information["charges"][0])[0]
+    with open(path_index / name_main / "information.json", "r") as f:
+        return json.load(f)["max_ms2_tolerance_in_da"]
+
+
+def _write_index_information(path_index, information, generation):
+    information["generation"] = generation
+    information["has_updates"] = True
+    file_tmp = path_index / f"information.json.{os.getpid()}.tmp"
+    with open(file_tmp, "w") as f:
+        json.dump(information, f)
+    os.replace(file_tmp, path_index / "information.json")
+
+
+def _remove_segments(path_index, all_name):
+    # The old segments may still be memory-mapped by running searches, on Linux they are kept until they are unmapped.
+    for name in all_name:
+        if name is None:
+            continue
+        path = path_index / name
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def _get_index_lock(path_index):
+    with _all_index_lock_lock:
+        return _all_index_lock.setdefault(str(Path(path_index).resolve()), threading.Lock())
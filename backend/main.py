@@ -1,21 +1,26 @@
 #!/usr/bin/env python3
 import asyncio
 import base64
-import copy
 import datetime
 import json
 import multiprocessing
 import os
 import signal
-import sys
+from typing import List, Union
 
+import msgpack
 import numpy as np
 import uvicorn
-from entropy_search import EntropySearch
-from fastapi import BackgroundTasks, Depends, FastAPI
+from fastapi import BackgroundTasks, Depends, FastAPI, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+from job_manager import JobManager
+from library_registry import LibraryRegistry
+from metrics import ENCODE_RESPONSE_DURATION, REGISTRY, MetricsMiddleware
+from request_executor import EventLoopMonitor, RequestExecutor
+
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -24,11 +29,27 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 ########################################################################################################################
 # Entropy search
-entropy_search_worker = None
-search_parameters = None
+library_registry = LibraryRegistry()
+job_manager = JobManager(library_registry)
+# The CPU-bound work of the requests runs in this executor, so /get/status is never blocked by a slow request.
+request_executor = RequestExecutor()
+event_loop_monitor = EventLoopMonitor()
+
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    event_loop_monitor.start()
+
+
+async def run_in_executor(key, function, *args):
+    try:
+        return await request_executor.run(key, function, *args)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"The request is not finished in {request_executor.timeout} seconds, please try again later.")
 
 
 class NumpyEncoder(json.JSONEncoder):
@@ -56,7 +77,8 @@ class NumpyEncoder(json.JSONEncoder):
 # Send parameters to start searching
 class InfoForEntropySearch(BaseModel):
     file_query: str = ""
-    file_library: str = ""
+    file_library: Union[str, List[str]] = ""  # A list of library files are searched together as shards
+    library_id: str = ""  # If set, use the library loaded by /library/load instead of file_library
     path_output: str = ""
 
     ms1_tolerance_in_da: float = 0.01
@@ -64,89 +86,312 @@ class InfoForEntropySearch(BaseModel):
     top_n: int = 100
     cores: int = 1
     charge: int = 0
+    search_types: List[str] = []  # A subset of "identity_search", "open_search", "neutral_loss_search", "hybrid_search", empty means all
+    resume: bool = False  # Continue from the checkpoint of the same search which was killed or cancelled
+    profile: bool = False  # Profile the job with cProfile, the profile is read by /job/profile/{job_id}
 
 
-def run_entropy_search(info: dict):
-    print(info)
-    global search_parameters
-    search_parameters = info.copy()
-    print("Start searching")
-    global entropy_search_worker
-    entropy_search_worker = EntropySearch(info["ms2_tolerance_in_da"])
-    entropy_search_worker.load_spectral_library(info["file_library"])
-    entropy_search_worker.search_file_single_core(
-        info["file_query"], info["top_n"], info["ms1_tolerance_in_da"], info["ms2_tolerance_in_da"], charge=info["charge"], cores=info["cores"]
-    )
-    print("Finish searching")
-    return None
+@app.post("/entropy_search")
+async def entropy_search(info: InfoForEntropySearch):
+    job = job_manager.submit(info.dict())
+    return {"file_query": info.file_query, "job_id": job.job_id}
 
 
-@app.post("/entropy_search")
-async def entropy_search(info: InfoForEntropySearch, background_tasks: BackgroundTasks):
-    background_tasks.add_task(run_entropy_search, info.dict())
-    return {"file_query": info.file_query}
+# Cancel a search job
+@app.post("/job/cancel/{job_id}")
+async def cancel_job(job_id: str):
+    try:
+        return job_manager.cancel(job_id).summary()
+    except Exception as e:
+        return {"status": f"Error: {e}", "is_error": True}
+
+
+# Get the profile of a search job submitted with profile=True, as the text of pstats sorted by sort_by
+@app.get("/job/profile/{job_id}")
+async def get_job_profile(job_id: str, sort_by: str = "cumulative", limit: int = 50):
+    try:
+        return Response(content=job_manager.get(job_id).get_profile(sort_by, limit), media_type="text/plain")
+    except Exception as e:
+        return {"status": f"Error: {e}", "is_error": True}
+
+
+# Get all search jobs
+@app.get("/get/jobs")
+async def get_jobs():
+    return job_manager.list_jobs()
+
+
+########################################################################################################################
+# Manage loaded libraries
+class InfoForLibrary(BaseModel):
+    file_library: Union[str, List[str]] = ""
+    ms2_tolerance_in_da: float = 0.02
+    cores: int = 1
+
+
+def run_load_library(info: dict, library_id: str):
+    try:
+        library_registry.load(info["file_library"], info["ms2_tolerance_in_da"], library_id=library_id, cores=info["cores"])
+    except Exception as e:
+        print("Error found when loading library: ", e)
+
+
+@app.post("/library/load")
+def load_library(info: InfoForLibrary, background_tasks: BackgroundTasks):
+    try:
+        library_id = library_registry.get_library_id(info.file_library, info.ms2_tolerance_in_da)
+        library_registry.add_loading(info.file_library, info.ms2_tolerance_in_da, library_id)
+        background_tasks.add_task(run_load_library, info.dict(), library_id)
+        return {"library_id": library_id}
+    except Exception as e:
+        return {"status": f"Error: {e}", "is_error": True}
+
+
+class InfoForLibraryUpdate(BaseModel):
+    file_library: str = ""  # The file with spectra to append
+    library_idx: list = []  # The library index of spectra to delete
+
+
+@app.post("/library/append/{library_id}")
+def append_library(library_id: str, info: InfoForLibraryUpdate):
+    try:
+        library_id, all_library_idx = library_registry.append(library_id, info.file_library)
+        return {"library_id": library_id, "library_idx": all_library_idx}
+    except Exception as e:
+        return {"status": f"Error: {e}", "is_error": True}
+
+
+@app.post("/library/delete/{library_id}")
+def delete_library_spectra(library_id: str, info: InfoForLibraryUpdate):
+    try:
+        library_id = library_registry.delete(library_id, info.library_idx)
+        return {"library_id": library_id, "is_deleted": True}
+    except Exception as e:
+        return {"status": f"Error: {e}", "is_error": True}
+
+
+@app.post("/library/unload/{library_id}")
+async def unload_library(library_id: str):
+    return {"library_id": library_id, "is_unloaded": library_registry.unload(library_id)}
+
+
+@app.get("/get/libraries")
+async def get_libraries():
+    return library_registry.list_libraries()
 
 
 ########################################################################################################################
+# The endpoints without job_id return the results of the latest submitted job.
 # Get one spectrum result
 @app.get("/get/one_spectrum/{scan}")
-async def get_one_spectrum(scan: int):
-    try:
-        spectrum_result = entropy_search_worker.get_one_spectrum_result(
-            scan, search_parameters["top_n"], search_parameters["ms1_tolerance_in_da"], search_parameters["ms2_tolerance_in_da"]
+@app.get("/get/one_spectrum/{job_id}/{scan}")
+async def get_one_spectrum(scan: int, job_id: str = None, response_format: str = "json"):
+    def run(job):
+        spectrum_result = job.entropy_search.get_one_spectrum_result(
+            scan, job.info["top_n"], job.info["ms1_tolerance_in_da"], job.info["ms2_tolerance_in_da"]
         )
-        json_str = json.dumps(spectrum_result, cls=NumpyEncoder)
-        return json.loads(json_str)
+        return encode_response(spectrum_result, response_format)
+
+    try:
+        job = job_manager.get(job_id)
+        return await run_in_executor(("one_spectrum", job.job_id, scan, response_format), run, job)
     except Exception as e:
         return {"status": f"Error: {e}", "is_error": True}
 
 
 # Get one library spectrum
 @app.get("/get/one_library_spectrum/{charge}/{idx}")
-async def get_one_library_spectrum(charge: int, idx: int):
+@app.get("/get/one_library_spectrum/{job_id}/{charge}/{idx}")
+async def get_one_library_spectrum(charge: int, idx: int, job_id: str = None, response_format: str = "json"):
+    def run(job):
+        return encode_response(job.entropy_search.get_one_library_spectrum(charge, idx), response_format)
+
     try:
-        spec_result = entropy_search_worker.get_one_library_spectrum(charge, idx)
-        json_str = json.dumps(spec_result, cls=NumpyEncoder)
-        return json.loads(json_str)
+        job = job_manager.get(job_id)
+        return await run_in_executor(("one_library_spectrum", job.job_id, charge, idx, response_format), run, job)
     except Exception as e:
         return {"status": f"Error: {e}", "is_error": True}
 
 
 # Get all spectra
 @app.get("/get/all_spectra")
-async def get_all_spectra():
+@app.get("/get/all_spectra/{job_id}")
+async def get_all_spectra(job_id: str = None, response_format: str = "json"):
+    def run(job):
+        _, all_spectra = job.entropy_search.get_spectra()
+        return encode_response(all_spectra, response_format)
+
     try:
-        all_spectra = entropy_search_worker.all_spectra
-        result = []
-        for i, spec in enumerate(all_spectra):
-            spec = copy.copy(spec)
-            if len(spec.pop("peaks", [])) == 0:
-                continue
-            spec.pop("identity_search", None)
-            spec.pop("open_search", None)
-            spec.pop("neutral_loss_search", None)
-            spec.pop("hybrid_search", None)
-            result.append(spec)
-
-        result_json = json.loads(json.dumps(result, cls=NumpyEncoder))
-        return result_json
+        job = job_manager.get(job_id)
+        return await run_in_executor(("all_spectra", job.job_id, response_format), run, job)
     except Exception as e:
         return {"status": f"Error: {e}", "is_error": True}
 
 
+# Get one page of spectra, filtered by retention time, precursor m/z and score, and sorted by one column
+@app.get("/get/spectra")
+@app.get("/get/spectra/{job_id}")
+async def get_spectra(
+    job_id: str = None,
+    offset: int = 0,
+    limit: int = 100,
+    rt_min: float = None,
+    rt_max: float = None,
+    precursor_mz_min: float = None,
+    precursor_mz_max: float = None,
+    score_min: float = None,
+    score_max: float = None,
+    score_type: str = "identity_search",
+    sort_by: str = None,
+    descending: bool = False,
+    response_format: str = "json",
+):
+    parameters = {
+        "offset": max(0, offset),
+        "limit": max(0, limit),
+        "rt_range": (rt_min, rt_max),
+        "precursor_mz_range": (precursor_mz_min, precursor_mz_max),
+        "score_range": (score_min, score_max),
+        "score_type": score_type,
+        "sort_by": sort_by,
+        "descending": descending,
+    }
+
+    def run(job):
+        total_num, spectra = job.entropy_search.get_spectra(**parameters)
+        if response_format == "arrow":
+            # The Arrow stream only has the table, the total number is in the header
+            response = encode_response(spectra, response_format)
+            response.headers["X-Total-Count"] = str(total_num)
+            return response
+        return encode_response({"total": total_num, "offset": offset, "limit": limit, "spectra": spectra}, response_format)
+
+    try:
+        job = job_manager.get(job_id)
+        key = ("spectra", job.job_id, response_format) + tuple(parameters.values())
+        return await run_in_executor(key, run, job)
+    except Exception as e:
+        return {"status": f"Error: {e}", "is_error": True}
+
+
+def encode_response(data, response_format="json"):
+    """
+    Encode the data as JSON, msgpack, or Arrow IPC stream (only for a list of flat dicts).
+    The data is encoded once, without the conversion by FastAPI.
+    """
+    with ENCODE_RESPONSE_DURATION.time(format=response_format):
+        return _encode_response(data, response_format)
+
+
+def _encode_response(data, response_format):
+    if response_format == "json":
+        return Response(content=json.dumps(data, cls=NumpyEncoder), media_type="application/json")
+    elif response_format == "msgpack":
+        return Response(content=msgpack.packb(data, default=NumpyEncoder().default), media_type="application/x-msgpack")
+    elif response_format == "arrow":
+        import pyarrow as pa
+
+        # The columns are the keys of all rows, a key missing in a row is null, such as "adduct" without identity hits
+        all_column = list(dict.fromkeys(k for row in data for k in row))
+        table = pa.Table.from_pydict({k: [row.get(k) for row in data] for k in all_column})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return Response(content=sink.getvalue().to_pybytes(), media_type="application/vnd.apache.arrow.stream")
+    raise ValueError(f"Unknown response format: {response_format}")
+
+
+# Stream the progress and the newly searched spectra of a job as server-sent events, instead of polling /get/status.
+# Each "results" event has the id of the next block, a client attaches late or reconnects with the offset parameter or
+# the Last-Event-ID header and replays the blocks from there. The blocks are read from the job when the client is ready
+# to receive them, so a slow client never makes the server buffer events.
+_STREAM_HEARTBEAT_IN_SECONDS = 1
+_STREAM_MAX_BLOCK_NUM = 8
+
+
+@app.get("/stream")
+@app.get("/stream/{job_id}")
+async def stream(job_id: str = None, offset: int = 0, last_event_id: str = Header(None)):
+    try:
+        job = job_manager.get(job_id)
+        if last_event_id:
+            offset = int(last_event_id)
+    except Exception as e:
+        return {"status": f"Error: {e}", "is_error": True}
+
+    def get_results(all_block):
+        spectra = [spec for spec_idx_start, spec_num in all_block for spec in job.entropy_search.get_block_spectra(spec_idx_start, spec_num)]
+        return json.dumps({"spectra": spectra}, cls=NumpyEncoder)
+
+    async def generate_events():
+        event_log = job.entropy_search.event_log
+        block_offset = max(0, offset)
+        last_progress = None
+        while True:
+            await event_log.wait(block_offset, _STREAM_HEARTBEAT_IN_SECONDS)
+            is_finished = job.finished_time is not None
+            status = job.status
+            progress = {
+                "job_id": job.job_id,
+                "state": job.state,
+                "status": status["message"],
+                "is_ready": status["ready"],
+                "is_running": status["running"],
+                "is_error": status["error"],
+                "read_spectra_num": len(job.entropy_search.all_spectra),
+                "searched_spectra_num": event_log.spectra_num,
+                "warnings": event_log.get_warnings(),
+            }
+            is_sent = False
+            if progress != last_progress:
+                yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+                last_progress, is_sent = progress, True
+
+            all_block = event_log.get_blocks(block_offset, _STREAM_MAX_BLOCK_NUM)
+            if all_block:
+                data = await asyncio.to_thread(get_results, all_block)
+                block_offset += len(all_block)
+                yield f"id: {block_offset}\nevent: results\ndata: {data}\n\n"
+                continue
+            if is_finished:
+                yield f"event: end\ndata: {json.dumps({'job_id': job.job_id, 'state': job.state})}\n\n"
+                return
+            if event_log.is_closed:
+                # The search is finished, wait for the job to set its final state
+                await asyncio.sleep(0.1)
+            elif not is_sent:
+                # Keep the connection alive, and find the disconnected clients
+                yield ": heartbeat\n\n"
+
+    return StreamingResponse(generate_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 # Get searching status
 @app.get("/get/status")
-async def get_status():
+@app.get("/get/status/{job_id}")
+async def get_status(job_id: str = None):
     try:
-        if entropy_search_worker is None:
+        if job_id is None and job_manager.latest_job_id is None:
             return {"status": "Preparing to start searching", "is_ready": False, "is_running": False, "is_error": False}
         else:
-            status = entropy_search_worker.status
+            status = job_manager.get(job_id).status
             return {"status": status["message"], "is_ready": status["ready"], "is_running": status["running"], "is_error": status["error"]}
     except Exception as e:
         return {"status": f"Error: {e}", "is_ready": False, "is_running": False, "is_error": True}
 
 
+# Get the latency of the event loop, in seconds
+@app.get("/get/event_loop_latency")
+async def get_event_loop_latency():
+    return {**event_loop_monitor.latency, "running_requests": len(request_executor.all_running), "coalesced_requests": request_executor.coalesced_request_num}
+
+
+# Get the timing of the search stages and the requests in the Prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 # Get maximum cpu cores
 @app.get("/get/cpu")
 async def get_cpu():
@@ -168,7 +413,8 @@ async def read_root():
 @app.get("/exit")
 async def exit():
     try:
-        entropy_search_worker.exit()
+        job_manager.exit()
+        request_executor.shutdown()
     except Exception as e:
         print("Error found when exiting: ", e)
         pass
@@ -176,9 +422,7 @@ async def exit():
 
 
 if __name__ == "__main__":
-    # Modify in case of Windows and MacOS
-    if sys.platform.startswith("win") or sys.platform.startswith("darwin"):
-        # On Windows calling this function is necessary.
-        multiprocessing.freeze_support()
+    # The worker processes are started by spawn or forkserver, which needs this function in the executable.
+    multiprocessing.freeze_support()
 
     uvicorn.run(app, host="localhost", port=8711)
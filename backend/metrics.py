@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import bisect
+import itertools
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+# The upper bounds of the histogram buckets in seconds, from 10 us to 1 min.
+DEFAULT_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+# All metrics, their locks are created again in a forked process, see _reset_locks_after_fork
+_ALL_METRIC = weakref.WeakSet()
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.all_value = {}
+        self._lock = threading.Lock()
+        _ALL_METRIC.add(self)
+
+    def inc(self, value=1, **labels):
+        key = tuple(labels.get(x, "") for x in self.labelnames)
+        with self._lock:
+            self.all_value[key] = self.all_value.get(key, 0) + value
+
+    def export_state(self, reset=False):
+        with self._lock:
+            state = dict(self.all_value)
+            if reset:
+                self.all_value = {}
+        return state
+
+    def merge_state(self, state):
+        with self._lock:
+            for key, value in state.items():
+                self.all_value[key] = self.all_value.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.export_state().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    A Prometheus histogram, the counts of each label set are kept in a list with one element for each bucket and
+    one for +Inf. Observing a value takes about 1 us, so it can be used for each query spectrum.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = [float(x) for x in buckets]
+        self.all_count = {}
+        self.all_sum = {}
+        self._lock = threading.Lock()
+        _ALL_METRIC.add(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(x, "") for x in self.labelnames)
+        bucket_idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            count = self.all_count.get(key)
+            if count is None:
+                count = self.all_count[key] = [0] * (len(self.buckets) + 1)
+                self.all_sum[key] = 0.0
+            count[bucket_idx] += 1
+            self.all_sum[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def export_state(self, reset=False):
+        with self._lock:
+            state = {key: (list(count), self.all_sum[key]) for key, count in self.all_count.items()}
+            if reset:
+                self.all_count, self.all_sum = {}, {}
+        return state
+
+    def merge_state(self, state):
+        with self._lock:
+            for key, (count, value_sum) in state.items():
+                if key not in self.all_count:
+                    self.all_count[key] = [0] * (len(self.buckets) + 1)
+                    self.all_sum[key] = 0.0
+                self.all_count[key] = [a + b for a, b in zip(self.all_count[key], count)]
+                self.all_sum[key] += value_sum
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (count, value_sum) in sorted(self.export_state().items()):
+            cumulative_count = list(itertools.accumulate(count))
+            for le, c in zip([f"{x:g}" for x in self.buckets] + ["+Inf"], cumulative_count):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames + ('le',), key + (le,))} {c}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {value_sum}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative_count[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.all_metric = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.all_metric.setdefault(name, Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.all_metric.setdefault(name, Histogram(name, documentation, labelnames, buckets))
+
+    def export_state(self, reset=False):
+        """
+        Get the values of all metrics, used to send the metrics of a worker process to the main process.
+
+        :param reset: Reset the metrics to zero, so the next state only has the new values.
+        """
+        return {name: metric.export_state(reset) for name, metric in self.all_metric.items()}
+
+    def merge_state(self, state):
+        for name, metric_state in state.items():
+            if name in self.all_metric:
+                self.all_metric[name].merge_state(metric_state)
+
+    def render(self):
+        """
+        The metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self.all_metric.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    all_label = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        all_label.append(f'{name}="{value}"')
+    return "{" + ",".join(all_label) + "}"
+
+
+def _reset_locks_after_fork():
+    """
+    A forked process only has the thread which forked it, so a lock held by another thread at that time would never
+    be released. The metrics of the forked process get new locks, their values are reset by the worker anyway.
+    """
+    for metric in list(_ALL_METRIC):
+        metric._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks_after_fork)
+
+
+class MetricsMiddleware:
+    """
+    An ASGI middleware which records the time to handle each HTTP request, labeled by the route path, so the requests
+    of all scans share one label. For streaming responses the time is until the stream ends.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - start_time, method=scope["method"], route=route)
+
+
+REGISTRY = MetricsRegistry()
+
+# The time of each stage of a search, the stages are:
+#   read_query: waiting for the next chunk of parsed query spectra
+#   parse_query: reading and parsing one chunk of query spectra
+#   clean_peaks: cleaning the peaks of one query spectrum
+#   identity_search: identity search of one query spectrum
+#   sparse_search: open, neutral loss and hybrid search of one query spectrum
+#   top_n: selecting the top N hits of one query spectrum
+#   result_cache: reading and writing the result cache for one block
+#   merge_result: saving the hits of one block
+STAGE_DURATION = REGISTRY.histogram("entropy_search_stage_duration_seconds", "Time spent in each stage of searching.", ["stage"])
+SEARCHED_SPECTRA = REGISTRY.counter("entropy_search_searched_spectra_total", "Number of query spectra searched.")
+HTTP_REQUEST_DURATION = REGISTRY.histogram("entropy_search_http_request_duration_seconds", "Time to handle HTTP requests.", ["method", "route"])
+ENCODE_RESPONSE_DURATION = REGISTRY.histogram("entropy_search_encode_response_duration_seconds", "Time to encode the responses.", ["format"])
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import numpy as np
+from metrics import STAGE_DURATION
+from ms_entropy import read_one_spectrum, standardize_spectrum
+
+# Number of raw spectra parsed by one worker at a time
+_CHUNK_SIZE = 1024
+# Number of bytes of a .mgf, .msp or .mzML file parsed by one worker at a time
+_BLOCK_SIZE = 4 * 1024**2
+_MGF_BEGIN_IONS = re.compile(rb"^[ \t]*BEGIN IONS[ \t]*\r?$", re.M)
+# A .msp record starts with the "Name:" line, and ends after the peaks counted by the "Num Peaks:" line
+_MSP_NAME = re.compile(rb"^[ \t]*name[ \t]*:", re.M | re.I)
+_MSP_NUM_PEAKS = re.compile(rb"^[ \t]*num peaks[ \t]*:", re.M | re.I)
+_MZML_SPECTRUM = re.compile(rb"<spectrum[\s>]")
+# Each block of a .mzML file is read by a new pyteomics reader, which loads the controlled vocabulary first,
+# so the blocks are larger, and a .mzML file is only cut into blocks when there are several workers.
+_MZML_BLOCK_SIZE = 16 * 1024**2
+
+
+def _convert_float(x):
+    try:
+        f = float(x)
+        if np.isnan(f):
+            return -1
+        else:
+            return f
+    except:
+        return -1
+
+
+def _convert_precursor_mz(x):
+    try:
+        f = float(x)
+        if np.isnan(f):
+            return -1
+        else:
+            return f
+    except:
+        try:
+            return float(x.split()[0])
+        except:
+            return -1
+
+
+_STANDARDIZE_INFO = {
+    "id": [["db#"], "", str],
+    "scan": [["_scan_number"], -1, int],
+    "name": [["title"], "", str],
+    "rt": [["retentiontime"], -1, _convert_float],
+    "precursor_mz": [["precursormz", "pepmass"], -1, _convert_precursor_mz],
+    "ion_mode": [["ionmode"], "", str],
+    "precursor_type": [["precursortype"], "", str],
+    "charge": [[], "", str],
+}
+
+
+def parse_spectrum(spec):
+    spec = standardize_spectrum(spec, standardize_info=_STANDARDIZE_INFO)
+    spec["charge"] = get_spectrum_charge(spec)
+    return spec
+
+
+def get_spectrum_charge(spec):
+    """
+    Get the precursor charge of a standardized spectrum from "charge", such as "2+", "-1" or 1, then from the first
+    letter of "ion_mode", then from the last character of "precursor_type". 0 means the charge is unknown.
+    """
+    charge = 0
+    charge_text = spec["charge"].strip()
+    if charge_text:
+        sign = 1
+        if charge_text[-1] in {"+", "-"}:
+            sign = -1 if charge_text[-1] == "-" else 1
+            charge_text = charge_text[:-1]
+        try:
+            charge = sign * int(float(charge_text))
+        except:
+            charge = 0
+
+    # Infer precursor charge from ion mode
+    if charge == 0 and spec["ion_mode"]:
+        charge = {"n": -1, "p": 1}.get(spec["ion_mode"].strip()[:1].lower(), 0)
+
+    # Guess precursor charge from adduct
+    if charge == 0 and spec["precursor_type"]:
+        charge = {"+": 1, "-": -1}.get(spec["precursor_type"].strip()[-1:], 0)
+    return charge
+
+
+def read_msp_chunk(data, scan_number_start, is_last):
+    """
+    Read a part of a .msp file which starts at a "Name:" line, the same as ms_entropy.read_one_spectrum.
+
+    :param scan_number_start: The scan number of the first spectrum in data.
+    :param is_last: If data is the end of the file, the information after the last peaks is also returned as a spectrum.
+    """
+    all_spec = []
+    scan_number = scan_number_start
+    spectrum_info = {"_ms_level": 2, "_scan_number": scan_number, "peaks": []}
+    peak_start = False
+    peak_num = 0
+    for line in data.decode("utf-8", errors="ignore").splitlines():
+        line = line.strip()
+        if peak_start:
+            items = line.split()
+            if len(items) >= 2:
+                spectrum_info["peaks"].append([items[0], items[1]])
+                peak_num -= 1
+            if peak_num == 0:
+                all_spec.append(spectrum_info)
+                scan_number += 1
+                spectrum_info = {"_ms_level": 2, "_scan_number": scan_number, "peaks": []}
+                peak_start = False
+        else:
+            items = line.split(":", maxsplit=1)
+            if len(items) == 2:
+                key, value = items
+                key = key.strip().lower()
+                spectrum_info[key] = value.strip()
+                if key == "num peaks":
+                    peak_start = True
+                    peak_num = int(value)
+    if is_last and (len(spectrum_info["peaks"]) > 0 or len(spectrum_info) > 3):
+        all_spec.append(spectrum_info)
+    return all_spec
+
+
+def read_mzml_chunk(data, scan_number_start):
+    """
+    Read a .mzML file with a part of the spectra of a file, with ms_entropy.read_one_spectrum.
+
+    :param scan_number_start: The scan number of the first spectrum in data.
+    """
+    fd, file_chunk = tempfile.mkstemp(suffix=".mzML")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        all_spec = []
+        for spec in read_one_spectrum(file_chunk, file_type="mzml"):
+            spec["_scan_number"] += scan_number_start - 1
+            all_spec.append(spec)
+    finally:
+        os.remove(file_chunk)
+    return all_spec
+
+
+def parse_query_chunk(all_spec):
+    """
+    Convert the peaks and standardize the information of a chunk of spectra from read_one_spectrum,
+    the spectra which are not MS/MS or can not be parsed are skipped.
+    """
+    all_parsed_spec = []
+    for spec in all_spec:
+        try:
+            if spec.pop("_ms_level", 2) != 2:
+                continue
+            spec["peaks"] = np.asarray(spec["peaks"], dtype=np.float32)
+            all_parsed_spec.append(parse_spectrum(spec))
+        except Exception:
+            continue
+    return all_parsed_spec
+
+
+def read_mgf_chunk(data, scan_number_start, is_last):
+    """
+    Read a part of a .mgf file which starts at a "BEGIN IONS" line, the same as ms_entropy.read_one_spectrum.
+
+    :param scan_number_start: The scan number of the first spectrum in data.
+    :param is_last: If data is the end of the file, a spectrum without "END IONS" at the end is also returned.
+    """
+    all_spec = []
+    scan_number = scan_number_start
+    spectrum_start = False
+    for line in data.decode("utf-8", errors="ignore").splitlines():
+        line = line.strip()
+        if line == "BEGIN IONS":
+            spectrum_start = True
+            spectrum_info = {"_ms_level": 2, "_scan_number": scan_number, "peaks": []}
+            scan_number += 1
+            continue
+        elif line == "END IONS":
+            spectrum_start = False
+            all_spec.append(spectrum_info)
+            continue
+
+        if spectrum_start:
+            if "=" in line:
+                key, value = line.split("=", maxsplit=1)
+                spectrum_info[key.strip().lower()] = value.strip()
+            else:
+                items = line.split()
+                if len(items) >= 2:
+                    spectrum_info["peaks"].append([items[0], items[1]])
+    if spectrum_start and is_last:
+        all_spec.append(spectrum_info)
+    return all_spec
+
+
+def read_query_spectra(file_query, cores=1, mp_context=None, max_queued_chunk_num=None):
+    """
+    Read and parse the query spectra, yield them in chunks in the order of the file.
+
+    A background thread reads the file and sends chunks of raw spectra to cores worker processes to be parsed,
+    or parses them itself when cores is 1. The chunks are handed to the caller through a bounded queue, so reading
+    and parsing run while the caller is searching the previous chunks, and only a few chunks are in memory.
+
+    Only .mgf, .msp and .mzML files are parsed by the workers, they are cut into blocks of bytes at the start of
+    a spectrum. The compressed files and the other formats are decoded by ms_entropy.read_one_spectrum in the reading
+    thread, and sending the decoded spectra to the workers costs about as much as parsing them there.
+
+    :param max_queued_chunk_num: The maximum number of chunks read ahead, default is 2 for each worker.
+    """
+    if max_queued_chunk_num is None:
+        max_queued_chunk_num = 2 * max(1, cores)
+    queue_chunk = queue.Queue(maxsize=max_queued_chunk_num)
+    stopped = threading.Event()
+    executor = None
+    if cores > 1 and _get_block_file_type(file_query, cores) is not None:
+        executor = ProcessPoolExecutor(max_workers=cores, mp_context=mp_context)
+        # Start the workers now, forking later from the reading thread is not safe
+        executor.submit(parse_query_chunk, []).result()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue_chunk.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_chunks():
+        try:
+            for function, args in _get_chunk_tasks(file_query, cores):
+                if not put(_submit(executor, _run_timed, function, *args)):
+                    return
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+            put(future)
+        finally:
+            put(None)
+
+    thread = threading.Thread(target=read_chunks, name="read_query", daemon=True)
+    thread.start()
+    try:
+        for future in iter(queue_chunk.get, None):
+            with STAGE_DURATION.time(stage="read_query"):
+                all_spec, parse_time = future.result()
+            STAGE_DURATION.observe(parse_time, stage="parse_query")
+            yield all_spec
+    finally:
+        stopped.set()
+        thread.join()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _get_chunk_tasks(file_query, cores=1):
+    """
+    Cut the query file into chunks, yield the function and the arguments to read and parse each chunk.
+    """
+    for read_chunk, args in get_raw_chunk_tasks(file_query, cores):
+        yield _parse_raw_chunk, (read_chunk, args)
+
+
+def _parse_raw_chunk(read_chunk, args):
+    return parse_query_chunk(read_chunk(*args))
+
+
+def get_raw_chunk_tasks(file_spectra, cores=1):
+    """
+    Cut a spectra file into chunks, yield the function and the arguments to read each chunk, the function returns
+    the spectra of the chunk as ms_entropy.read_one_spectrum does.
+
+    A plain .mgf, .msp or .mzML file is cut into blocks of bytes which are read by the workers, other files are
+    read by ms_entropy.read_one_spectrum in the current process, and the function only returns the chunk of spectra.
+    """
+    file_type = _get_block_file_type(file_spectra, cores)
+    if file_type == "mgf":
+        for data, scan_number_start, is_last in _read_blocks(file_spectra, _MGF_BEGIN_IONS, _MGF_BEGIN_IONS):
+            yield read_mgf_chunk, (data, scan_number_start, is_last)
+        return
+    if file_type == "msp":
+        for data, scan_number_start, is_last in _read_blocks(file_spectra, _MSP_NAME, _MSP_NUM_PEAKS):
+            yield read_msp_chunk, (data, scan_number_start, is_last)
+        return
+    if file_type == "mzml":
+        yield from _get_mzml_chunk_tasks(file_spectra)
+        return
+
+    chunk = []
+    for spec in read_one_spectrum(file_spectra):
+        chunk.append(spec)
+        if len(chunk) == _CHUNK_SIZE:
+            yield _get_chunk, (chunk,)
+            chunk = []
+    if chunk:
+        yield _get_chunk, (chunk,)
+
+
+def _get_chunk(all_spec):
+    return all_spec
+
+
+def _get_mzml_chunk_tasks(file_spectra):
+    """
+    Cut a .mzML file into blocks of <spectrum> elements. Each block is put between the header of the file, which is
+    everything before the first spectrum, and the closing tags, so it is a .mzML file with only these spectra.
+    """
+    header = None
+    for data, scan_number_start, is_last in _read_blocks(file_spectra, _MZML_SPECTRUM, _MZML_SPECTRUM, _MZML_BLOCK_SIZE):
+        if header is None:
+            spectrum_start = _MZML_SPECTRUM.search(data)
+            header = data[: spectrum_start.start()] if spectrum_start is not None else data
+            footer = b"</spectrumList></run></mzML>" + (b"</indexedmzML>" if b"<indexedmzML" in header else b"")
+            data = data[len(header) :]
+        if is_last:
+            # The chromatograms and the index after the spectra are not needed
+            spectrum_list_end = data.find(b"</spectrumList>")
+            if spectrum_list_end >= 0:
+                data = data[:spectrum_list_end]
+        yield read_mzml_chunk, (header + data + footer, scan_number_start)
+
+
+def _get_block_file_type(file_spectra, cores):
+    """
+    The type of a file which is cut into blocks of bytes to be read by the workers, None for other files.
+    """
+    file_type = {".mgf": "mgf", ".msp": "msp", ".mzml": "mzml"}.get(os.path.splitext(str(file_spectra))[1].lower())
+    if file_type == "mzml" and cores <= 1:
+        return None
+    return file_type
+
+
+def _read_blocks(file_spectra, pattern_start, pattern_spectrum, block_size=None):
+    """
+    Read a file in blocks which start at a match of pattern_start, yield (data, scan number of the first spectrum, is_last).
+    The number of spectra in a block is the number of matches of pattern_spectrum.
+
+    :param block_size: The number of bytes read at a time, default is _BLOCK_SIZE.
+    """
+    if block_size is None:
+        block_size = _BLOCK_SIZE
+    scan_number = 1
+    rest = b""
+    with open(file_spectra, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            data = rest + block
+            all_spectrum_start = [m.start() for m in pattern_start.finditer(data)]
+            # Keep the last spectrum for the next block, as it may be incomplete
+            if len(all_spectrum_start) < 2:
+                rest = data
+                continue
+            yield data[: all_spectrum_start[-1]], scan_number, False
+            scan_number += len(pattern_spectrum.findall(data, 0, all_spectrum_start[-1]))
+            rest = data[all_spectrum_start[-1] :]
+    yield rest, scan_number, True
+
+
+def _run_timed(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+def _submit(executor, function, *args):
+    if executor is not None:
+        return executor.submit(function, *args)
+    future = Future()
+    future.set_result(function(*args))
+    return future
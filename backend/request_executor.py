@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# The number of threads for the requests and the timeout of one request can be changed with these environment variables.
+ENV_REQUEST_WORKERS = "ENTROPY_SEARCH_REQUEST_WORKERS"
+ENV_REQUEST_TIMEOUT = "ENTROPY_SEARCH_REQUEST_TIMEOUT"
+DEFAULT_REQUEST_WORKERS = 4
+DEFAULT_REQUEST_TIMEOUT = 60
+
+_LATENCY_CHECK_INTERVAL = 0.1
+
+
+class RequestExecutor:
+    """
+    Run the CPU-bound work of the requests in a thread pool, so the event loop is free to answer other requests.
+
+    Identical requests which are running at the same time share one computation: the key of a request identifies
+    its result, the later requests with the same key wait for the running one instead of starting a new one.
+    """
+
+    def __init__(self, max_workers=None, timeout=None) -> None:
+        if max_workers is None:
+            max_workers = int(os.environ.get(ENV_REQUEST_WORKERS, DEFAULT_REQUEST_WORKERS))
+        if timeout is None:
+            timeout = float(os.environ.get(ENV_REQUEST_TIMEOUT, DEFAULT_REQUEST_TIMEOUT))
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="request")
+        self.all_running = {}
+        self.coalesced_request_num = 0
+
+    async def run(self, key, function, *args, timeout=None):
+        """
+        Run function(*args) in the thread pool and return its result.
+
+        :param key: The requests with the same key share the result, None means never sharing.
+        :raise asyncio.TimeoutError: The result is not ready in timeout seconds, the computation continues in
+                                     the background so the requests with the same key can still use it.
+        """
+        loop = asyncio.get_running_loop()
+        future = self.all_running.get(key) if key is not None else None
+        if future is None:
+            future = loop.run_in_executor(self.executor, function, *args)
+            if key is not None:
+                self.all_running[key] = future
+                future.add_done_callback(lambda _: self.all_running.pop(key, None))
+        else:
+            self.coalesced_request_num += 1
+        return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class EventLoopMonitor:
+    """
+    Measure the latency of the event loop: a task sleeps for a short interval and records how much later than
+    expected it wakes up. A high latency means some work is blocking the event loop.
+    """
+
+    def __init__(self, interval=_LATENCY_CHECK_INTERVAL) -> None:
+        self.interval = interval
+        self.task = None
+        self.latency = {"last": 0.0, "mean": 0.0, "max": 0.0, "count": 0}
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            time_start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            delay = max(0.0, time.perf_counter() - time_start - self.interval)
+            latency = self.latency
+            latency["count"] += 1
+            latency["last"] = delay
+            latency["max"] = max(latency["max"], delay)
+            # Exponential moving average over about the last 100 checks
+            latency["mean"] += (delay - latency["mean"]) / min(latency["count"], 100)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from index_cache import get_cache_dir
+
+# The size limit of the result cache can be changed with this environment variable, 0 disables the cache.
+ENV_RESULT_CACHE_SIZE_IN_GB = "ENTROPY_SEARCH_RESULT_CACHE_SIZE_IN_GB"
+DEFAULT_RESULT_CACHE_SIZE_IN_GB = 2
+
+# The hits of one query spectrum, search_type is the index in EntropySearch.SEARCH_TYPES.
+CACHED_HIT_DTYPE = np.dtype([("search_type", np.uint8), ("library_idx", np.int64), ("score", np.float32)])
+
+# Maximum number of keys in one SQL query
+_QUERY_BATCH_SIZE = 500
+# The cache is shrunk to this fraction of the size limit when it is full
+_EVICT_TARGET_RATIO = 0.9
+# How long a connection waits for the other processes to release the lock of the database, and how many times a
+# transaction is retried after that, with the interval doubled each time
+_BUSY_TIMEOUT_IN_SECONDS = 10
+_MAX_RETRY_NUM = 3
+_RETRY_INTERVAL_IN_SECONDS = 0.5
+
+
+class ResultCache:
+    """
+    A persistent cache of the hits of single query spectra, stored in <cache directory>/result_cache.sqlite.
+
+    The key of a spectrum is calculated by get_result_cache_key from its cleaned peaks, its precursor m/z and the
+    search parameters including the library index, so a spectrum searched again with the same library and
+    parameters, in the same file or in another one, is not scored again. When the total size exceeds
+    max_size_in_bytes, the least recently used results are removed.
+
+    The cache can be used from several threads and processes, each process opens its own connection. The errors of
+    the database are raised to the caller, which can search the spectra without the cache.
+    """
+
+    def __init__(self, file_cache=None, max_size_in_bytes=None) -> None:
+        if file_cache is None:
+            file_cache = get_cache_dir() / "result_cache.sqlite"
+        if max_size_in_bytes is None:
+            max_size_in_bytes = float(os.environ.get(ENV_RESULT_CACHE_SIZE_IN_GB, DEFAULT_RESULT_CACHE_SIZE_IN_GB)) * 1024**3
+        self.file_cache = Path(file_cache)
+        self.max_size_in_bytes = max_size_in_bytes
+        self._connection = None
+        self._pid = None
+        self._total_size = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"file_cache": self.file_cache, "max_size_in_bytes": self.max_size_in_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def enabled(self):
+        return self.max_size_in_bytes > 0
+
+    def get_many(self, all_key):
+        """
+        Get the cached hits of the keys, the results are marked as recently used.
+
+        :return: A dict of {key: structured array with CACHED_HIT_DTYPE} for the keys found in the cache.
+        :raises sqlite3.Error: The cache can not be read, such as it is still locked by other processes after retrying.
+        """
+        if not self.enabled or len(all_key) == 0:
+            return {}
+
+        def get(connection):
+            result = {}
+            now = time.time()
+            for i in range(0, len(all_key), _QUERY_BATCH_SIZE):
+                all_key_batch = all_key[i : i + _QUERY_BATCH_SIZE]
+                placeholders = ",".join("?" * len(all_key_batch))
+                for key, value in connection.execute(f"SELECT key, value FROM result WHERE key IN ({placeholders})", all_key_batch):
+                    result[bytes(key)] = np.frombuffer(value, dtype=CACHED_HIT_DTYPE)
+                connection.execute(f"UPDATE result SET last_used = ? WHERE key IN ({placeholders})", [now] + list(all_key_batch))
+            return result
+
+        return self._write(get)
+
+    def put_many(self, all_key_hits):
+        """
+        Save the hits of the spectra, then remove the least recently used results if the cache is too large.
+
+        :param all_key_hits: A dict of {key: structured array with CACHED_HIT_DTYPE}.
+        :raises sqlite3.Error: The cache can not be written, such as it is still locked by other processes after retrying.
+        """
+        if not self.enabled or len(all_key_hits) == 0:
+            return
+        now = time.time()
+        all_row = []
+        for key, hits in all_key_hits.items():
+            value = np.asarray(hits, dtype=CACHED_HIT_DTYPE).tobytes()
+            all_row.append((key, value, len(key) + len(value), now))
+
+        def put(connection):
+            connection.executemany("INSERT OR REPLACE INTO result (key, value, size, last_used) VALUES (?, ?, ?, ?)", all_row)
+            total_size = self._total_size + sum(row[2] for row in all_row)
+            if total_size > self.max_size_in_bytes:
+                total_size = self._evict(connection)
+            return total_size
+
+        self._total_size = self._write(put)
+
+    def _evict(self, connection):
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM result").fetchone()[0]
+        target_size = self.max_size_in_bytes * _EVICT_TARGET_RATIO
+        while total_size > target_size:
+            all_row = connection.execute("SELECT key, size FROM result ORDER BY last_used LIMIT ?", (_QUERY_BATCH_SIZE,)).fetchall()
+            if not all_row:
+                break
+            all_removed = []
+            for key, size in all_row:
+                all_removed.append(key)
+                total_size -= size
+                if total_size <= target_size:
+                    break
+            connection.execute(f"DELETE FROM result WHERE key IN ({','.join('?' * len(all_removed))})", all_removed)
+        return total_size
+
+    def _write(self, function):
+        """
+        Run function(connection) in a write transaction and return its result.
+
+        The transaction takes the write lock at the start with BEGIN IMMEDIATE, so it waits for the other writers with
+        the busy timeout instead of failing when it changes from reading to writing. If the database is still locked,
+        the whole transaction is retried a few times before the error is raised.
+        """
+        for retry_num in range(_MAX_RETRY_NUM + 1):
+            try:
+                with self._lock:
+                    connection = self._get_connection()
+                    connection.execute("BEGIN IMMEDIATE")
+                    try:
+                        result = function(connection)
+                        connection.execute("COMMIT")
+                    except BaseException:
+                        connection.rollback()
+                        raise
+                return result
+            except sqlite3.OperationalError as e:
+                if retry_num == _MAX_RETRY_NUM or not _is_locked_error(e):
+                    raise
+                time.sleep(_RETRY_INTERVAL_IN_SECONDS * 2**retry_num)
+
+    def _get_connection(self):
+        # A connection can not be used after fork, the child process opens a new one.
+        if self._connection is None or self._pid != os.getpid():
+            self.file_cache.parent.mkdir(parents=True, exist_ok=True)
+            # The transactions are started by _write, not by the sqlite3 module
+            connection = sqlite3.connect(self.file_cache, timeout=_BUSY_TIMEOUT_IN_SECONDS, isolation_level=None, check_same_thread=False)
+            try:
+                connection.execute(f"PRAGMA busy_timeout = {int(_BUSY_TIMEOUT_IN_SECONDS * 1000)}")
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS result (key BLOB PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS result_last_used ON result (last_used)")
+                self._total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM result").fetchone()[0]
+            except BaseException:
+                connection.close()
+                raise
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+
+def _is_locked_error(e):
+    message = str(e).lower()
+    return "locked" in message or "busy" in message
+
+
+def get_result_cache_key(peaks, precursor_mz, parameters):
+    """
+    Get the key of a query spectrum in the result cache.
+
+    :param peaks: The cleaned peaks of the query spectrum.
+    :param parameters: A dict of the search parameters and the library, it should be JSON serializable.
+    """
+    key = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode())
+    key.update(np.float64(precursor_mz).tobytes())
+    key.update(np.ascontiguousarray(peaks, dtype=np.float32).tobytes())
+    return key.digest()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+import csv
+from pathlib import Path
+
+from result_store import get_hit_rank
+
+# Number of hits written to the output file at a time, also the row group size of the Parquet file.
+_ROW_GROUP_SIZE = 100000
+
+COLUMNS = [
+    "scan",
+    "query_name",
+    "query_precursor_mz",
+    "query_rt",
+    "charge",
+    "search_type",
+    "rank",
+    "score",
+    "library_idx",
+    "library-id",
+    "library-name",
+    "library-precursor_type",
+    "library-precursor_mz",
+    "library-file_name",
+]
+
+
+def get_output_file(path_output, file_query):
+    """
+    Get the file to write the results. If path_output is a .parquet or .csv file, use it directly. Otherwise
+    path_output is treated as a directory, and the results are written to <query name>.parquet in it, or to a CSV
+    file if pyarrow is not installed.
+    """
+    path_output = Path(path_output)
+    if path_output.suffix.lower() in {".parquet", ".csv"}:
+        return path_output
+    suffix = ".parquet" if _has_pyarrow() else ".csv"
+    return path_output / (Path(file_query).stem + "_entropy_search" + suffix)
+
+
+class ResultWriter:
+    """
+    Write the hits of a search to a Parquet or CSV file while searching, one row for each hit, with the information
+    of the query spectrum and the library spectrum. The hits are buffered and written in row groups, so the memory
+    usage does not depend on the number of query spectra.
+    """
+
+    def __init__(self, file_output, all_search_type, row_group_size=_ROW_GROUP_SIZE) -> None:
+        self.file_output = Path(file_output)
+        self.all_search_type = list(all_search_type)
+        self.row_group_size = row_group_size
+        self.file_output.parent.mkdir(parents=True, exist_ok=True)
+        self._buffer = {k: [] for k in COLUMNS}
+        self._buffer_size = 0
+
+        if self.file_output.suffix.lower() == ".parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            self._schema = pa.schema(
+                [
+                    ("scan", pa.int64()),
+                    ("query_name", pa.string()),
+                    ("query_precursor_mz", pa.float64()),
+                    ("query_rt", pa.float64()),
+                    ("charge", pa.int32()),
+                    ("search_type", pa.string()),
+                    ("rank", pa.int32()),
+                    ("score", pa.float32()),
+                    ("library_idx", pa.int64()),
+                    ("library-id", pa.string()),
+                    ("library-name", pa.string()),
+                    ("library-precursor_type", pa.string()),
+                    ("library-precursor_mz", pa.float64()),
+                    ("library-file_name", pa.string()),
+                ]
+            )
+            self._parquet_writer = pq.ParquetWriter(self.file_output, self._schema)
+            self._csv_file = None
+        else:
+            self._parquet_writer = None
+            self._csv_file = open(self.file_output, "w", newline="")
+            self._csv_writer = csv.writer(self._csv_file)
+            self._csv_writer.writerow(COLUMNS)
+
+    def add_batch_result(self, all_spec, batch_result, spectral_library):
+        """
+        Add the result of EntropySearch.search_spectra for the query spectra all_spec.
+
+        :param spectral_library: The dict of {charge: library} used to search, to read the library spectra information.
+        """
+        rank = get_hit_rank(batch_result["query_idx"], batch_result["search_type"])
+
+        all_library_spec = {}
+        buffer = self._buffer
+        for query_idx, library_idx, score, search_type_idx, hit_rank in zip(
+            batch_result["query_idx"].tolist(),
+            batch_result["library_idx"].tolist(),
+            batch_result["score"].tolist(),
+            batch_result["search_type"].tolist(),
+            rank.tolist(),
+        ):
+            spec = all_spec[query_idx]
+            charge = spec["charge"]
+            library_spec = all_library_spec.get((charge, library_idx))
+            if library_spec is None:
+                library_spec = spectral_library[charge].abstract_library_spectra[library_idx]
+                all_library_spec[(charge, library_idx)] = library_spec
+
+            buffer["scan"].append(spec["scan"])
+            buffer["query_name"].append(str(spec.get("query_name", "")))
+            buffer["query_precursor_mz"].append(float(spec["precursor_mz"]))
+            buffer["query_rt"].append(float(spec["rt"]))
+            buffer["charge"].append(charge)
+            buffer["search_type"].append(self.all_search_type[search_type_idx])
+            buffer["rank"].append(hit_rank)
+            buffer["score"].append(score)
+            buffer["library_idx"].append(library_idx)
+            buffer["library-id"].append(str(library_spec.get("library-id", "")))
+            buffer["library-name"].append(str(library_spec.get("library-name", "")))
+            buffer["library-precursor_type"].append(str(library_spec.get("library-precursor_type", "")))
+            buffer["library-precursor_mz"].append(float(library_spec.get("precursor_mz", -1)))
+            buffer["library-file_name"].append(str(library_spec.get("library-file_name", "")))
+        self._buffer_size += len(rank)
+
+        if self._buffer_size >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer_size == 0:
+            return
+        if self._parquet_writer is not None:
+            import pyarrow as pa
+
+            self._parquet_writer.write_table(pa.table(self._buffer, schema=self._schema), row_group_size=self.row_group_size)
+        else:
+            self._csv_writer.writerows(zip(*(self._buffer[k] for k in COLUMNS)))
+        self._buffer = {k: [] for k in COLUMNS}
+        self._buffer_size = 0
+
+    def close(self):
+        self.flush()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._csv_file is not None:
+            self._csv_file.close()
+            self._csv_file = None
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow.parquet
+
+        return True
+    except ImportError:
+        return False
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import numpy as np
+
+# One hit of a query spectrum, the library index is the same as the spec_idx in the FlashEntropySearch index.
+HIT_DTYPE = np.dtype([("library_idx", np.uint32), ("score", np.float32)])
+
+_INITIAL_CAPACITY = 1024
+
+
+class ResultStore:
+    """
+    The top N hits of all query spectra, stored in one preallocated NumPy structured array for each search type.
+
+    Row i of the arrays holds the hits of the i-th query spectrum sorted by descending score, only the first
+    hit_num[search_type][i] hits of the row are valid, and searched[i] is True once the spectrum is searched.
+    The arrays grow by doubling when more query spectra are added.
+    """
+
+    def __init__(self, all_search_type, top_n, capacity=_INITIAL_CAPACITY) -> None:
+        self.all_search_type = list(all_search_type)
+        self.top_n = max(1, int(top_n))
+        self.capacity = 0
+        self.all_hits = {}
+        self.hit_num = {}
+        self.searched = np.zeros(0, dtype=bool)
+        self._grow(capacity)
+
+    def __len__(self):
+        return self.capacity
+
+    def add_batch_result(self, spec_idx_start, spec_num, batch_result):
+        """
+        Save the result of EntropySearch.search_spectra, the query_idx in batch_result is relative to spec_idx_start.
+        """
+        if spec_idx_start + spec_num > self.capacity:
+            self._grow(max(2 * self.capacity, spec_idx_start + spec_num))
+
+        rank = get_hit_rank(batch_result["query_idx"], batch_result["search_type"])
+        selected = rank < self.top_n
+        row = batch_result["query_idx"][selected] + spec_idx_start
+        rank = rank[selected]
+        search_type_idx = batch_result["search_type"][selected]
+        library_idx = batch_result["library_idx"][selected]
+        score = batch_result["score"][selected]
+        for i, search_type in enumerate(self.all_search_type):
+            is_search_type = search_type_idx == i
+            hits = self.all_hits[search_type]
+            hits["library_idx"][row[is_search_type], rank[is_search_type]] = library_idx[is_search_type]
+            hits["score"][row[is_search_type], rank[is_search_type]] = score[is_search_type]
+            hit_num = np.zeros(spec_num, dtype=np.int32)
+            np.add.at(hit_num, row[is_search_type] - spec_idx_start, 1)
+            self.hit_num[search_type][spec_idx_start : spec_idx_start + spec_num] = hit_num
+        self.searched[spec_idx_start : spec_idx_start + spec_num] = True
+
+    def is_searched(self, spec_idx):
+        return spec_idx < self.capacity and bool(self.searched[spec_idx])
+
+    def get_hits(self, spec_idx, search_type):
+        """
+        Get the hits of one query spectrum, as a structured array with fields "library_idx" and "score".
+        """
+        if spec_idx >= self.capacity:
+            return np.zeros(0, dtype=HIT_DTYPE)
+        return self.all_hits[search_type][spec_idx, : self.hit_num[search_type][spec_idx]]
+
+    def _grow(self, capacity):
+        for search_type in self.all_search_type:
+            hits = np.zeros((capacity, self.top_n), dtype=HIT_DTYPE)
+            hit_num = np.zeros(capacity, dtype=np.int32)
+            if search_type in self.all_hits:
+                hits[: self.capacity] = self.all_hits[search_type]
+                hit_num[: self.capacity] = self.hit_num[search_type]
+            self.all_hits[search_type] = hits
+            self.hit_num[search_type] = hit_num
+        searched = np.zeros(capacity, dtype=bool)
+        searched[: self.capacity] = self.searched
+        self.searched = searched
+        self.capacity = capacity
+
+
+def get_hit_rank(query_idx, search_type):
+    """
+    Get the rank of each hit in its query spectrum and search type, the hits should be sorted by query_idx, search_type,
+    then descending score, as returned by EntropySearch.search_spectra.
+    """
+    if len(query_idx) == 0:
+        return np.zeros(0, dtype=np.int64)
+    group_key = np.asarray(query_idx, dtype=np.int64) * 256 + search_type
+    group_start = np.flatnonzero(np.r_[True, group_key[1:] != group_key[:-1]])
+    return np.arange(len(group_key)) - np.repeat(group_start, np.diff(np.r_[group_start, len(group_key)]))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+from index_cache import get_cache_dir
+
+# The results are written to the checkpoint at most every this many seconds.
+ENV_CHECKPOINT_INTERVAL_IN_SECONDS = "ENTROPY_SEARCH_CHECKPOINT_INTERVAL_IN_SECONDS"
+DEFAULT_CHECKPOINT_INTERVAL_IN_SECONDS = 30
+
+_MAGIC = b"ESCKPT01"
+_BLOCK_HEADER_DTYPE = np.dtype([("spec_idx_start", "<i8"), ("spec_num", "<i8"), ("hit_num", "<i8")])
+# The query_idx is relative to the first spectrum of the block
+_CHECKPOINT_HIT_DTYPE = np.dtype([("query_idx", "<u4"), ("search_type", "u1"), ("library_idx", "<i8"), ("score", "<f4")])
+
+
+class SearchCheckpoint:
+    """
+    Save the results of the searched blocks of a query file to an append-only file, so a search killed in the middle
+    can be resumed without searching these blocks again.
+
+    The file starts with _MAGIC, followed by one record for each block: a header with the index of the first spectrum
+    of the block, the number of spectra and the number of hits, then the hits. The records are buffered and written
+    every interval_in_seconds, an incomplete record at the end of the file is ignored.
+    """
+
+    def __init__(self, file_checkpoint, interval_in_seconds=None) -> None:
+        if interval_in_seconds is None:
+            interval_in_seconds = float(os.environ.get(ENV_CHECKPOINT_INTERVAL_IN_SECONDS, DEFAULT_CHECKPOINT_INTERVAL_IN_SECONDS))
+        self.file_checkpoint = Path(file_checkpoint)
+        self.interval_in_seconds = interval_in_seconds
+        self._file = None
+        self._buffer = []
+        self._last_flush_time = time.time()
+
+    def open(self, resume=False):
+        """
+        Open the checkpoint for writing.
+
+        :param resume: Keep the blocks saved before and return them, otherwise the checkpoint is started again.
+        :return: A dict of {spec_idx_start: (spec_num, batch_result)} of the saved blocks, the batch_result has the
+                 same format as EntropySearch.search_spectra.
+        """
+        all_block, valid_size = {}, 0
+        if resume:
+            all_block, valid_size = _read_checkpoint(self.file_checkpoint)
+        self.file_checkpoint.parent.mkdir(parents=True, exist_ok=True)
+        if valid_size > 0:
+            self._file = open(self.file_checkpoint, "r+b")
+            self._file.truncate(valid_size)
+            self._file.seek(valid_size)
+        else:
+            self._file = open(self.file_checkpoint, "wb")
+            self._file.write(_MAGIC)
+        self._buffer = []
+        self._last_flush_time = time.time()
+        return all_block
+
+    def add_block(self, spec_idx_start, spec_num, batch_result):
+        header = np.array([(spec_idx_start, spec_num, len(batch_result["query_idx"]))], dtype=_BLOCK_HEADER_DTYPE)
+        hits = np.zeros(len(batch_result["query_idx"]), dtype=_CHECKPOINT_HIT_DTYPE)
+        for name in _CHECKPOINT_HIT_DTYPE.names:
+            hits[name] = batch_result[name]
+        self._buffer.append(header.tobytes() + hits.tobytes())
+        if time.time() - self._last_flush_time >= self.interval_in_seconds:
+            self.flush()
+
+    def flush(self):
+        if self._file is None:
+            return
+        if self._buffer:
+            self._file.write(b"".join(self._buffer))
+            self._buffer = []
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._last_flush_time = time.time()
+
+    def close(self, remove=False):
+        """
+        Write the buffered blocks and close the file, or remove the checkpoint if remove is True.
+        """
+        if self._file is None:
+            return
+        if not remove:
+            self.flush()
+        self._file.close()
+        self._file = None
+        self._buffer = []
+        if remove:
+            try:
+                self.file_checkpoint.unlink()
+            except OSError:
+                pass
+
+
+def get_checkpoint_file(file_query, parameters, path_checkpoint=None):
+    """
+    Get the checkpoint file of searching file_query with the parameters, a modified query file has another checkpoint.
+
+    :param parameters: A dict of the search parameters and the library, it should be JSON serializable.
+    """
+    if path_checkpoint is None:
+        path_checkpoint = get_cache_dir() / "checkpoints"
+    file_query = Path(file_query).resolve()
+    stat = file_query.stat()
+    key = json.dumps({"file_query": str(file_query), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, **parameters}, sort_keys=True)
+    return Path(path_checkpoint) / (hashlib.sha256(key.encode()).hexdigest()[:32] + ".ckpt")
+
+
+def _read_checkpoint(file_checkpoint):
+    """
+    Read the complete records of a checkpoint file.
+
+    :return: The saved blocks, and the size of the file up to the last complete record, 0 if the file is not valid.
+    """
+    all_block = {}
+    try:
+        with open(file_checkpoint, "rb") as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                return {}, 0
+            valid_size = f.tell()
+            while True:
+                data = f.read(_BLOCK_HEADER_DTYPE.itemsize)
+                if len(data) < _BLOCK_HEADER_DTYPE.itemsize:
+                    break
+                header = np.frombuffer(data, dtype=_BLOCK_HEADER_DTYPE)[0]
+                data = f.read(int(header["hit_num"]) * _CHECKPOINT_HIT_DTYPE.itemsize)
+                if len(data) < int(header["hit_num"]) * _CHECKPOINT_HIT_DTYPE.itemsize:
+                    break
+                hits = np.frombuffer(data, dtype=_CHECKPOINT_HIT_DTYPE)
+                batch_result = {
+                    "query_idx": hits["query_idx"].astype(np.int64),
+                    "library_idx": hits["library_idx"].astype(np.int64),
+                    "score": hits["score"].astype(np.float32),
+                    "search_type": hits["search_type"].astype(np.uint8),
+                }
+                all_block[int(header["spec_idx_start"])] = (int(header["spec_num"]), batch_result)
+                valid_size = f.tell()
+    except OSError:
+        return {}, 0
+    return all_block, valid_size
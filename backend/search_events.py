@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+
+
+class SearchEventLog:
+    """
+    The blocks of query spectra finished by a search, in the order they are finished, for the clients following the
+    search with /stream. The log only keeps (spec_idx_start, spec_num) of each block, the results are read from the
+    query spectra when they are sent.
+
+    Each client keeps its own offset in the log, so a client can attach late and replay from any offset, and a slow
+    client only reads the log later instead of making the search buffer events for it.
+
+    The log also keeps the warnings of the search, such as the result cache can not be used, each message only once.
+    """
+
+    def __init__(self) -> None:
+        self.all_block = []
+        self.all_warning = []
+        self.spectra_num = 0
+        self.is_closed = False
+        self._lock = threading.Lock()
+        self._all_waiter = set()
+
+    def __len__(self):
+        return len(self.all_block)
+
+    def reset(self):
+        with self._lock:
+            self.all_block = []
+            self.all_warning = []
+            self.spectra_num = 0
+            self.is_closed = False
+        self._notify()
+
+    def add_block(self, spec_idx_start, spec_num):
+        with self._lock:
+            self.all_block.append((spec_idx_start, spec_num))
+            self.spectra_num += spec_num
+        self._notify()
+
+    def add_warning(self, message):
+        with self._lock:
+            if message in self.all_warning:
+                return
+            self.all_warning.append(message)
+        self._notify()
+
+    def get_warnings(self):
+        with self._lock:
+            return list(self.all_warning)
+
+    def close(self):
+        """
+        Mark the search as finished, cancelled or failed, no block will be added.
+        """
+        with self._lock:
+            self.is_closed = True
+        self._notify()
+
+    def get_blocks(self, offset, max_block_num=None):
+        with self._lock:
+            return self.all_block[offset : None if max_block_num is None else offset + max_block_num]
+
+    async def wait(self, offset, timeout):
+        """
+        Wait until there are blocks after offset or the log is closed, at most timeout seconds.
+        Called from the event loop, the search threads wake it up with call_soon_threadsafe.
+        """
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self._lock:
+            if len(self.all_block) > offset or self.is_closed:
+                return
+            self._all_waiter.add(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                self._all_waiter.discard(waiter)
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def _notify(self):
+        with self._lock:
+            all_waiter = list(self._all_waiter)
+        for loop, event in all_waiter:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The event loop is closed
+                pass
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+from pathlib import Path
+
+import numpy as np
+from identity_search import search_identity_sparse
+from library_index import read_index_information, read_spectral_library
+from sparse_search import search_sparse
+
+
+class ShardedLibrary:
+    """
+    The spectral library of one charge made of several library files (shards), each shard is built and cached on its own.
+
+    The spectra are addressed by a global library index, which is the offset of the shard plus the index of the
+    spectrum in the shard. The spectra returned by this object are copies with "library-idx" set to the global library
+    index, and "library-file_name" set to the name of the shard.
+    """
+
+    def __init__(self, all_shard_name, all_shard) -> None:
+        self.all_shard_name = list(all_shard_name)
+        self.all_shard = list(all_shard)
+        self.shard_offset = np.concatenate([[0], np.cumsum([len(x.precursor_mz_array) for x in self.all_shard])]).astype(np.int64)
+        self.precursor_mz_array = np.concatenate([np.zeros(0, dtype=np.float32)] + [np.asarray(x.precursor_mz_array, dtype=np.float32) for x in self.all_shard])
+        self.abstract_library_spectra = _ShardRecords(self, "abstract_library_spectra")
+
+    def __len__(self):
+        return int(self.shard_offset[-1])
+
+    def __getitem__(self, library_idx):
+        shard_idx, idx = self.locate(library_idx)
+        return self._convert_record(self.all_shard[shard_idx][idx], shard_idx, idx)
+
+    def search(self, **kwargs):
+        """
+        Search all shards with FlashEntropySearch.search, the scores are indexed by the global library index.
+        """
+        result = {}
+        for shard_idx, shard in enumerate(self.all_shard):
+            shard_result = shard.search(**kwargs)
+            for search_type, score in shard_result.items():
+                if search_type not in result:
+                    result[search_type] = np.zeros(len(self), dtype=np.float32)
+                result[search_type][self.shard_offset[shard_idx] : self.shard_offset[shard_idx + 1]] = score
+        return result
+
+    def search_identity_sparse(self, precursor_mz, peaks, ms1_tolerance_in_da, ms2_tolerance_in_da):
+        """
+        Identity search in the MS1 tolerance window of all shards, the library index is the global library index.
+        """
+        return self._merge_shard_results(
+            [search_identity_sparse(shard, precursor_mz, peaks, ms1_tolerance_in_da, ms2_tolerance_in_da) for shard in self.all_shard]
+        )
+
+    def search_sparse(self, precursor_mz, peaks, ms2_tolerance_in_da, all_search_type):
+        """
+        Search all shards with sparse_search.search_sparse, the library index is the global library index.
+        """
+        all_shard_result = [search_sparse(shard, precursor_mz, peaks, ms2_tolerance_in_da, all_search_type) for shard in self.all_shard]
+        return {search_type: self._merge_shard_results([x[search_type] for x in all_shard_result]) for search_type in all_search_type}
+
+    def _merge_shard_results(self, all_shard_result):
+        all_library_idx, all_score = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float32)]
+        for shard_idx, (library_idx, score) in enumerate(all_shard_result):
+            all_library_idx.append(library_idx + self.shard_offset[shard_idx])
+            all_score.append(score)
+        return np.concatenate(all_library_idx), np.concatenate(all_score)
+
+    def save_memory_for_multiprocessing(self):
+        for shard in self.all_shard:
+            shard.save_memory_for_multiprocessing()
+
+    def _convert_record(self, record, shard_idx, idx):
+        record = dict(record)
+        if "library-idx" in record:
+            record["library-idx"] = int(self.shard_offset[shard_idx]) + idx
+        if self.all_shard_name[shard_idx] is not None:
+            record.setdefault("library-file_name", self.all_shard_name[shard_idx])
+        return record
+
+    def locate(self, library_idx):
+        """
+        Get the index of the shard and the index in the shard of a global library index.
+        """
+        library_idx = int(library_idx)
+        if library_idx < 0:
+            library_idx += len(self)
+        if library_idx < 0 or library_idx >= len(self):
+            raise IndexError("Library spectrum index out of range.")
+        shard_idx = int(np.searchsorted(self.shard_offset, library_idx, side="right")) - 1
+        return shard_idx, library_idx - int(self.shard_offset[shard_idx])
+
+
+class _ShardRecords:
+    def __init__(self, library, name) -> None:
+        self.library = library
+        self.name = name
+
+    def __len__(self):
+        return len(self.library)
+
+    def __getitem__(self, library_idx):
+        shard_idx, idx = self.library.locate(library_idx)
+        return self.library._convert_record(getattr(self.library.all_shard[shard_idx], self.name)[idx], shard_idx, idx)
+
+
+def combine_library_shards(all_shard_name, all_spectral_library):
+    """
+    Combine the spectral libraries of all shards.
+
+    :param all_spectral_library: A list of {charge: FlashEntropySearch}, one for each shard.
+    :return: A dict of {charge: ShardedLibrary}.
+    """
+    all_charges = sorted({charge for spectral_library in all_spectral_library for charge in spectral_library})
+    spectral_library = {}
+    for charge in all_charges:
+        all_name, all_shard = [], []
+        for name, shard in zip(all_shard_name, all_spectral_library):
+            if charge in shard:
+                all_name.append(name)
+                all_shard.append(shard[charge])
+        spectral_library[charge] = ShardedLibrary(all_name, all_shard)
+    return spectral_library
+
+
+def read_sharded_spectral_library(all_path_index):
+    """
+    Read the indexes of all shards written by write_spectral_library.
+
+    :return: A dict of {charge: ShardedLibrary}.
+    """
+    all_shard_name = [get_shard_name(path) for path in all_path_index]
+    return combine_library_shards(all_shard_name, [read_spectral_library(path) for path in all_path_index])
+
+
+def get_shard_name(path_index):
+    return read_index_information(path_index).get("library_name", Path(path_index).stem)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import threading
+
+import numpy as np
+from ms_entropy import FlashEntropySearch
+
+# The score buffer of each thread, reused by all queries. The buffer is all zero between two searches.
+_thread_local = threading.local()
+
+
+def search_sparse(library, precursor_mz, peaks, ms2_tolerance_in_da, all_search_type):
+    """
+    Open, neutral loss and hybrid search with the same scores as FlashEntropySearch.search, but only the library
+    spectra with score > 0 are returned. The scores are accumulated in a buffer reused by all queries of the thread,
+    and only the entries touched by the query are read and reset, so there is no library-length array per query.
+
+    :param library: A FlashEntropySearch object, or an object with the method search_sparse.
+    :param peaks: The query peaks cleaned by identity_search.clean_query_peaks.
+    :param all_search_type: A list of "open_search", "neutral_loss_search" and "hybrid_search".
+    :return: A dict of {search_type: (library_idx, score)}.
+    """
+    if not isinstance(library, FlashEntropySearch):
+        return library.search_sparse(precursor_mz, peaks, ms2_tolerance_in_da, all_search_type)
+
+    core = library.entropy_search
+    if not core.index or core.total_spectra_num == 0 or len(peaks) == 0:
+        return {search_type: (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for search_type in all_search_type}
+
+    peaks = core._preprocess_peaks(peaks)
+    score_buffer = _get_score_buffer(core.total_spectra_num)
+    result = {}
+    try:
+        for search_type in all_search_type:
+            if search_type == "open_search":
+                all_modified_idx = _score_peaks(core, peaks, ms2_tolerance_in_da, "open", score_buffer)
+            elif search_type == "neutral_loss_search":
+                peaks_nl = peaks.copy()
+                peaks_nl[:, 0] = precursor_mz - peaks_nl[:, 0]
+                all_modified_idx = _score_peaks(core, peaks_nl, ms2_tolerance_in_da, "neutral_loss", score_buffer)
+            elif search_type == "hybrid_search":
+                all_modified_idx = _score_peaks_hybrid(core, precursor_mz, peaks, ms2_tolerance_in_da, score_buffer)
+            else:
+                raise ValueError(f"Unknown search type: {search_type}")
+            result[search_type] = _collect_scores(score_buffer, all_modified_idx)
+    except BaseException:
+        score_buffer.fill(0)
+        raise
+    return result
+
+
+def _get_score_buffer(spectra_num):
+    score_buffer = getattr(_thread_local, "score_buffer", None)
+    if score_buffer is None or len(score_buffer) < spectra_num:
+        score_buffer = np.zeros(spectra_num, dtype=np.float32)
+        _thread_local.score_buffer = score_buffer
+    return score_buffer[:spectra_num]
+
+
+def _collect_scores(score_buffer, all_modified_idx):
+    """
+    Read the scores of the touched library spectra and reset them to zero.
+    """
+    if len(all_modified_idx) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    library_idx = np.unique(np.concatenate(all_modified_idx)).astype(np.int64)
+    score = score_buffer[library_idx]
+    score_buffer[library_idx] = 0
+    selected = score > 0
+    return library_idx[selected], score[selected]
+
+
+def _score_peaks(core, peaks, ms2_tolerance_in_da, method, score_buffer):
+    """
+    The same as FlashEntropySearchCore.search with search_type 0, but the scores are added to score_buffer.
+
+    :return: The list of the library spectra touched by each query peak.
+    """
+    index = dict(zip(core.index_names, core.index))
+    if method == "open":
+        library_mz_idx_start, library_mz = index["all_ions_mz_idx_start"], index["all_ions_mz"]
+        library_peaks_intensity, library_spec_idx = index["all_ions_intensity"], index["all_ions_spec_idx"]
+    else:
+        library_mz_idx_start, library_mz = index["all_nl_mass_idx_start"], index["all_nl_mass"]
+        library_peaks_intensity, library_spec_idx = index["all_nl_intensity"], index["all_nl_spec_idx"]
+
+    all_modified_idx = []
+    for mz_query, intensity_query in peaks:
+        product_mz_idx_min = core._find_location_from_array_with_index(mz_query - ms2_tolerance_in_da, library_mz, library_mz_idx_start, "left")
+        product_mz_idx_max = core._find_location_from_array_with_index(mz_query + ms2_tolerance_in_da, library_mz, library_mz_idx_start, "right")
+        modified_idx = library_spec_idx[product_mz_idx_min:product_mz_idx_max]
+        score_buffer[modified_idx] += core._score_peaks_with_cpu(intensity_query, library_peaks_intensity[product_mz_idx_min:product_mz_idx_max])
+        all_modified_idx.append(modified_idx)
+    return all_modified_idx
+
+
+def _score_peaks_hybrid(core, precursor_mz, peaks, ms2_tolerance_in_da, score_buffer):
+    """
+    The same as FlashEntropySearchCore.search_hybrid on CPU, but the scores are added to score_buffer.
+
+    :return: The list of the library spectra touched by each query peak.
+    """
+    (
+        all_ions_mz_idx_start,
+        all_ions_mz,
+        all_ions_intensity,
+        all_ions_spec_idx,
+        all_nl_mass_idx_start,
+        all_nl_mass,
+        all_nl_intensity,
+        all_nl_spec_idx,
+        all_ions_idx_for_nl,
+    ) = core.index
+
+    product_peak_match_idx_min = np.zeros(peaks.shape[0], dtype=np.uint64)
+    product_peak_match_idx_max = np.zeros(peaks.shape[0], dtype=np.uint64)
+    for peak_idx, (mz_query, _) in enumerate(peaks):
+        product_peak_match_idx_min[peak_idx] = core._find_location_from_array_with_index(mz_query - ms2_tolerance_in_da, all_ions_mz, all_ions_mz_idx_start, "left")
+        product_peak_match_idx_max[peak_idx] = core._find_location_from_array_with_index(mz_query + ms2_tolerance_in_da, all_ions_mz, all_ions_mz_idx_start, "right")
+
+    all_modified_idx = []
+    for peak_idx, (mz, intensity) in enumerate(peaks):
+        # Match the product ions
+        product_mz_idx_min = product_peak_match_idx_min[peak_idx]
+        product_mz_idx_max = product_peak_match_idx_max[peak_idx]
+        modified_idx_product = all_ions_spec_idx[product_mz_idx_min:product_mz_idx_max]
+        score_buffer[modified_idx_product] += core._score_peaks_with_cpu(intensity, all_ions_intensity[product_mz_idx_min:product_mz_idx_max])
+
+        # Match the neutral losses
+        mz_nl = precursor_mz - mz
+        neutral_loss_mz_idx_min = core._find_location_from_array_with_index(mz_nl - ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "left")
+        neutral_loss_mz_idx_max = core._find_location_from_array_with_index(mz_nl + ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "right")
+        modified_idx_nl = all_nl_spec_idx[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
+        modified_value_nl = core._score_peaks_with_cpu(intensity, all_nl_intensity[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max])
+
+        # Skip the neutral losses whose product ion is already matched to another query peak
+        nl_matched_product_ion_idx = all_ions_idx_for_nl[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
+        s1 = np.searchsorted(product_peak_match_idx_min, nl_matched_product_ion_idx, side="right")
+        s2 = np.searchsorted(product_peak_match_idx_max - 1, nl_matched_product_ion_idx, side="left")
+        modified_value_nl[s1 > s2] = 0
+
+        # Skip the library spectra where this query peak is already matched to a product ion
+        duplicate_idx_in_nl = core._remove_duplicate_with_cpu(modified_idx_product, modified_idx_nl, core.total_spectra_num)
+        modified_value_nl[duplicate_idx_in_nl] = 0
+
+        score_buffer[modified_idx_nl] += modified_value_nl
+        all_modified_idx.append(modified_idx_product)
+        all_modified_idx.append(modified_idx_nl)
+    return all_modified_idx
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# The identity and sparse searches use private functions of ms_entropy, this test checks that the results are still
+# the same as FlashEntropySearch.search after ms_entropy is upgraded.
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from entropy_search import SEARCH_TYPES, EntropySearch  # noqa: E402
+from index_cache import IndexCache  # noqa: E402
+from ms_entropy import FlashEntropySearch  # noqa: E402
+from result_cache import ResultCache  # noqa: E402
+
+MS1_TOLERANCE_IN_DA = 0.01
+MS2_TOLERANCE_IN_DA = 0.02
+
+
+def _generate_library(file_library, spectra_num=300, seed=0):
+    random = np.random.default_rng(seed)
+    all_spec = []
+    with open(file_library, "w") as f:
+        for i in range(spectra_num):
+            precursor_mz = float(np.round(random.uniform(150, 800), 4))
+            peaks_mz = np.sort(np.round(random.uniform(50, precursor_mz - 2, random.integers(3, 20)), 4))
+            peaks_intensity = np.round(random.uniform(1, 100, len(peaks_mz)), 2)
+            f.write(f"BEGIN IONS\nTITLE=spec{i}\nPEPMASS={precursor_mz}\n")
+            f.writelines(f"{mz} {intensity}\n" for mz, intensity in zip(peaks_mz, peaks_intensity))
+            f.write("END IONS\n")
+            all_spec.append({"title": f"spec{i}", "precursor_mz": precursor_mz, "peaks": np.array([peaks_mz, peaks_intensity], dtype=np.float32).T})
+    return all_spec
+
+
+def _generate_queries(all_library_spec, seed=1):
+    random = np.random.default_rng(seed)
+    all_query = []
+    for spec in all_library_spec[::10]:
+        peaks = spec["peaks"].copy()
+        peaks[:, 0] += random.uniform(-0.005, 0.005, len(peaks))
+        # The same precursor m/z for identity search, and a shifted one for open, neutral loss and hybrid search
+        all_query.append({"precursor_mz": spec["precursor_mz"] + 0.003, "peaks": peaks})
+        all_query.append({"precursor_mz": spec["precursor_mz"] + 14.0157, "peaks": peaks})
+    return all_query
+
+
+@pytest.fixture(scope="module")
+def library(tmp_path_factory):
+    path = tmp_path_factory.mktemp("library")
+    file_library = path / "library.mgf"
+    all_library_spec = _generate_library(file_library)
+    entropy_search = EntropySearch(
+        MS2_TOLERANCE_IN_DA, index_cache=IndexCache(path / "cache"), result_cache=ResultCache(max_size_in_bytes=0), charge_partition="none"
+    )
+    entropy_search.load_spectral_library(file_library)
+    assert not entropy_search.status["error"], entropy_search.status["message"]
+
+    reference = FlashEntropySearch(max_ms2_tolerance_in_da=MS2_TOLERANCE_IN_DA)
+    reference.build_index([dict(spec) for spec in all_library_spec], min_ms2_difference_in_da=2 * MS2_TOLERANCE_IN_DA)
+    return entropy_search, reference, all_library_spec
+
+
+def test_search_is_the_same_as_flash_entropy_search(library):
+    entropy_search, reference, all_library_spec = library
+    all_query = _generate_queries(all_library_spec)
+    top_n = len(all_library_spec)
+    result = entropy_search.search_spectra([dict(spec) for spec in all_query], top_n, MS1_TOLERANCE_IN_DA, MS2_TOLERANCE_IN_DA)
+
+    for query_idx, query in enumerate(all_query):
+        all_reference_score = reference.search(
+            precursor_mz=query["precursor_mz"],
+            peaks=query["peaks"],
+            ms1_tolerance_in_da=MS1_TOLERANCE_IN_DA,
+            ms2_tolerance_in_da=MS2_TOLERANCE_IN_DA,
+            method="all",
+        )
+        for search_type_idx, search_type in enumerate(SEARCH_TYPES):
+            is_hit = (result["query_idx"] == query_idx) & (result["search_type"] == search_type_idx)
+            hits = {
+                entropy_search.get_one_library_spectrum(0, int(library_idx))["library-name"]: float(score)
+                for library_idx, score in zip(result["library_idx"][is_hit], result["score"][is_hit])
+                if score > 0
+            }
+            reference_score = all_reference_score[search_type]
+            expected = {reference[int(i)]["title"]: float(reference_score[i]) for i in np.flatnonzero(reference_score > 0)}
+            assert hits.keys() == expected.keys(), (query_idx, search_type)
+            for name, score in expected.items():
+                assert hits[name] == pytest.approx(score, abs=1e-4), (query_idx, search_type, name)